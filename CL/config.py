@@ -18,6 +18,8 @@ def get_arg_parser():
         help="Name of the environments to periodically evaluate the agent on")
     arg("--no_test", default=False, action='store_true', help="If True, no test environments will be used")
     arg('--seed', type=int, default=0, help='Seed for randomness')
+    arg('--num_seeds', type=int, default=1,
+        help='Number of consecutive seeds, starting from --seed, trained together in a single process')
     arg('--gpu', '-g', default=None, type=int, help='Which GPU to use')
     arg("--sparse_rewards", default=False, action='store_true', help="Whether to use the sparse reward setting")
 
@@ -62,6 +64,10 @@ def get_arg_parser():
     arg("--use_layer_norm", type=str2bool, default=True, help="Whether to use layer normalization")
     arg("--multihead_archs", type=str2bool, default=True, help="Whether to use multi-head architecture")
     arg("--hide_task_id", action='store_true', default=False, help="Whether the model knows the task during test time")
+    arg("--shared_encoder", default=False, action='store_true',
+        help="Whether the actor and the critics share a single CNN encoder")
+    arg("--encoder_gradients", type=str, default="critic", choices=["critic", "actor"],
+        help="Loss which trains the shared CNN encoder")
 
     # Learning rate
     arg("--lr", type=float, default=1e-3, help="Learning rate for the optimizer")
@@ -74,17 +80,39 @@ def get_arg_parser():
     arg("--replay_size", type=sci2int, default=int(5e4), help="Size of the replay buffer")
     arg("--buffer_type", type=str, default="fifo", choices=[b.value for b in BufferType],
         help="Strategy of inserting examples into the buffer")
+    arg("--buffer_dir", type=str, default=None,
+        help="Directory where the reservoir buffer keeps its observations in memory-mapped files. "
+             "If None, they are kept in RAM")
     arg("--episodic_memory_from_buffer", type=str2bool, default=True)
 
     # Training
     arg("--steps_per_env", type=sci2int, default=int(2e5),
         help="Number of steps the algorithm will run per environment")
+    arg("--num_envs", type=int, default=1,
+        help="Number of environment copies stepped in parallel subprocesses to collect the experience")
+    arg("--num_collectors", type=int, default=0,
+        help="Number of collector processes which gather the experience while the learner updates the agent. "
+             "0 collects the experience in the training loop")
+    arg("--sync_weights_every", type=int, default=100,
+        help="Number of steps of a collector between the checks for new weights of the actor")
+    arg("--max_update_lag", type=int, default=50,
+        help="Number of updates the learner may lag behind the update schedule before the collectors are stalled")
     arg("--update_after", type=sci2int, default=int(5000),
         help="Number of env interactions to collect before starting to do update the gradient")
     arg("--update_every", type=sci2int, default=int(500), help="Number of env interactions to do between every update")
     arg("--n_updates", type=sci2int, default=int(50),
         help="Number of consecutive policy gradient descent updates to perform")
     arg("--batch_size", type=int, default=128, help="Minibatch size for the optimization")
+    arg("--prefetch_batches", type=int, default=0,
+        help="Number of batches to sample ahead on a background thread during the updates. 0 disables prefetching")
+    arg("--fused_updates", type=int, default=1,
+        help="Number of consecutive updates performed in a single graph call. 1 disables fusing")
+    arg("--concat_next_obs", default=False, action='store_true',
+        help="Whether to run the actor on the observations and the next observations in a single forward pass")
+    arg("--mixed_precision", default=False, action='store_true',
+        help="Whether the networks compute in bfloat16 with float32 weights")
+    arg("--jit_compile", default=False, action='store_true',
+        help="Whether to compile the update steps with XLA and cache them across task changes")
     arg("--gamma", type=float, default=0.99, help="Discount factor")
     arg("--alpha", type=float_or_str, default="auto",
         help="Entropy regularization coefficient. "
@@ -100,6 +128,10 @@ def get_arg_parser():
     arg("--test", type=str2bool, default=True, help="Whether to test the model")
     arg("--test_only", default=False, action='store_true', help="Whether to only test the model")
     arg("--test_episodes", default=3, type=int, help="Number of episodes to test the model")
+    arg("--parallel_test", default=False, action='store_true',
+        help="Whether to step the test environments in parallel subprocesses with batched inference")
+    arg("--async_test", default=False, action='store_true',
+        help="Whether the parallel evaluation runs in the background while the training continues")
 
     # Exploration
     arg("--start_steps", type=sci2int, default=int(10000),
@@ -126,10 +158,20 @@ def get_arg_parser():
         help="Regularization strength for continual learning methods. Valid for 'l2', 'ewc', 'mas' continual learning methods.")
     arg("--vcl_first_task_kl", type=str2bool, default=False,
         help="If True, use KL regularization also for the first task in 'vcl' continual learning method.")
+    arg("--importance_samples", type=int, default=320,
+        help="Number of examples on which the parameter importance is estimated in 'ewc', 'mas' and 'owl' methods.")
+    arg("--importance_batch_size", type=int, default=32,
+        help="Number of examples whose per-example gradients are computed together for the parameter importance.")
+    arg("--importance_time_budget", type=float, default=None,
+        help="Number of seconds after which the estimation of the parameter importance stops early. "
+             "If None, all importance_samples examples are used.")
     arg("--episodic_mem_per_task", type=int, default=10000,
         help="Number of examples to keep in additional memory per task. Valid for 'agem' continual learning method.")
     arg("--episodic_batch_size", type=int, default=128,
         help="Minibatch size to compute additional loss in 'agem' continual learning method.")
+    arg("--episodic_mem_frames", default=False, action='store_true',
+        help="Keep the observations of the episodic memory of 'agem' and 'clonex' as uint8 frames. "
+             "This takes a quarter of the memory, but is lossy for augmented observations.")
 
     # Observation
     arg('--frame_stack', type=int, default=4, help='Number of frames to stack')
@@ -7,7 +7,8 @@ from CL.rl.sac import SAC
 
 class AGEM_SAC(SAC):
     def __init__(
-            self, episodic_mem_per_task: int = 0, episodic_batch_size: int = 0, **vanilla_sac_kwargs
+            self, episodic_mem_per_task: int = 0, episodic_batch_size: int = 0, episodic_mem_frames: bool = False,
+            **vanilla_sac_kwargs
     ):
         """AGEM method. See https://arxiv.org/abs/1812.00420 .
 
@@ -16,6 +17,8 @@ class AGEM_SAC(SAC):
             Valid for 'agem' continual learning method.
           episodic_batch_size: Minibatch size to compute additional loss in 'agem' continual
             learning method.
+          episodic_mem_frames: If True, the observations in the episodic memory are kept as uint8
+            frames, which is lossy for augmented observations.
         """
         super().__init__(**vanilla_sac_kwargs)
         self.episodic_mem_per_task = episodic_mem_per_task
@@ -23,7 +26,8 @@ class AGEM_SAC(SAC):
 
         episodic_mem_size = self.episodic_mem_per_task * self.env.num_tasks
         self.episodic_memory = EpisodicMemory(
-            obs_shape=self.obs_shape, act_dim=self.act_dim, size=episodic_mem_size, num_tasks=self.env.num_tasks
+            obs_shape=self.obs_shape, act_dim=self.act_dim, size=episodic_mem_size, num_tasks=self.env.num_tasks,
+            store_frames=episodic_mem_frames
         )
 
     def adjust_gradients(
@@ -66,8 +70,7 @@ class AGEM_SAC(SAC):
     def on_task_start(self, current_task_idx: int) -> None:
         super(AGEM_SAC, self).on_task_start(current_task_idx)
         if current_task_idx > 0:
-            new_episodic_mem = self.replay_buffer.sample_batch(self.episodic_mem_per_task)
-            self.episodic_memory.store_multiple(**new_episodic_mem)
+            self.episodic_memory.store_from(self.replay_buffer, self.episodic_mem_per_task)
 
     def get_episodic_batch(self, current_task_idx: int) -> Optional[Dict[str, tf.Tensor]]:
         if current_task_idx > 0:
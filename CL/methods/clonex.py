@@ -4,19 +4,22 @@ import tensorflow as tf
 import tensorflow_probability as tfp
 from tensorflow_probability.python.distributions import Categorical
 
-from CL.replay.buffers import EpisodicMemory, ReplayBuffer
+from CL.replay.buffers import CompactReplayBuffer, EpisodicMemory, ReplayBuffer
 from CL.rl.sac import SAC
 from CL.utils.running import create_one_hot_vec
 
 
 class ClonExSAC(SAC):
     def __init__(self, episodic_mem_per_task: int = 0, episodic_batch_size: int = 0, regularize_critic: bool = False,
-                 cl_reg_coef: float = 0., episodic_memory_from_buffer: bool = True, **vanilla_sac_kwargs):
+                 cl_reg_coef: float = 0., episodic_memory_from_buffer: bool = True, episodic_mem_frames: bool = False,
+                 **vanilla_sac_kwargs):
         """Episodic replay.
 
         Args:
           episodic_mem_per_task: Number of examples to keep in additional memory per task.
           episodic_batch_size: Minibatch size to compute additional loss.
+          episodic_mem_frames: If True, the observations in the episodic memory and in the gathered rollouts
+            are kept as uint8 frames, which is lossy for augmented observations.
         """
         super().__init__(**vanilla_sac_kwargs)
 
@@ -25,11 +28,14 @@ class ClonExSAC(SAC):
         self.regularize_critic = regularize_critic
         self.cl_reg_coef = cl_reg_coef
         self.episodic_memory_from_buffer = episodic_memory_from_buffer
+        self.episodic_mem_frames = episodic_mem_frames
 
         num_tasks = self.env.num_tasks
         episodic_mem_size = self.episodic_mem_per_task * num_tasks
+        # The behavioral cloning loss never reads the next observations
         self.episodic_memory = EpisodicMemory(obs_shape=self.obs_shape, act_dim=self.act_dim, size=episodic_mem_size,
-                                              num_tasks=num_tasks, save_targets=True)
+                                              num_tasks=num_tasks, save_targets=True, store_next_obs=False,
+                                              store_frames=episodic_mem_frames)
 
     def behavioral_cloning_gradients(
             self,
@@ -100,8 +106,12 @@ class ClonExSAC(SAC):
             final_grads += [(new_grad + ref_grad) / 2]
         return final_grads
 
-    def gather_buffer(self, task_idx):
-        tmp_replay_buffer = ReplayBuffer(self.obs_shape, self.episodic_mem_per_task, self.num_tasks)
+    def gather_buffer(self, task_idx: int) -> ReplayBuffer:
+        if self.episodic_mem_frames:
+            # Each transition takes at most two slots of the compact buffer, so none of them is overwritten
+            tmp_replay_buffer = CompactReplayBuffer(self.obs_shape, 2 * self.episodic_mem_per_task, self.num_tasks)
+        else:
+            tmp_replay_buffer = ReplayBuffer(self.obs_shape, self.episodic_mem_per_task, self.num_tasks)
         one_hot_vec = create_one_hot_vec(self.env.num_tasks, self.env.task_id)
         env_to_gather = self.env.envs[task_idx]
         obs, _ = env_to_gather.reset()
@@ -120,28 +130,24 @@ class ClonExSAC(SAC):
                 episode_len = 0
             else:
                 obs = next_obs
-        return tmp_replay_buffer.sample_batch(self.episodic_mem_per_task)
+        return tmp_replay_buffer
+
+    def get_cloning_targets(self, batch: Dict[str, tf.Tensor]) -> Dict[str, tf.Tensor]:
+        obs, one_hot_task_ids = batch["obs"], batch["one_hot"]
+        return dict(
+            actor_logits=self.actor(obs, one_hot_task_ids),
+            critic1_preds=self.critic1(obs, one_hot_task_ids),
+            critic2_preds=self.critic2(obs, one_hot_task_ids),
+        )
 
     def on_task_start(self, current_task_idx: int) -> None:
         super(ClonExSAC, self).on_task_start(current_task_idx)
         if current_task_idx > 0:
             if self.episodic_memory_from_buffer:
-                new_episodic_mem = self.replay_buffer.sample_batch(self.episodic_mem_per_task)
+                buffer = self.replay_buffer
             else:
-                new_episodic_mem = self.gather_buffer(current_task_idx - 1)
-
-            obs = new_episodic_mem["obs"]
-            one_hot_task_ids = new_episodic_mem["one_hot"]
-            logits = self.actor(obs, one_hot_task_ids)
-            critic1_preds = self.critic1(obs, one_hot_task_ids)
-            critic2_preds = self.critic2(obs, one_hot_task_ids)
-
-            new_episodic_mem = {k: v.numpy() for k, v in new_episodic_mem.items()}
-            new_episodic_mem["actor_logits"] = logits.numpy()
-            new_episodic_mem["critic1_preds"] = critic1_preds.numpy()
-            new_episodic_mem["critic2_preds"] = critic2_preds.numpy()
-
-            self.episodic_memory.store_multiple(**new_episodic_mem)
+                buffer = self.gather_buffer(current_task_idx - 1)
+            self.episodic_memory.store_from(buffer, self.episodic_mem_per_task, get_targets=self.get_cloning_targets)
 
     def get_episodic_batch(self, current_task_idx: int) -> Optional[Dict[str, tf.Tensor]]:
         return None if current_task_idx == 0 else self.episodic_memory.sample_batch(self.episodic_batch_size)
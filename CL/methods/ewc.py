@@ -1,6 +1,6 @@
 import numpy as np
 import tensorflow as tf
-from typing import List, Tuple
+from typing import List
 
 from CL.methods.regularization import Regularization_SAC
 
@@ -13,35 +13,27 @@ class EWC_SAC(Regularization_SAC):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
-    @tf.function
-    def _get_grads(
+    def _get_importance_sums(
             self,
             obs: tf.Tensor,
             one_hot: tf.Tensor
-    ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    ) -> List[tf.Tensor]:
+        """Diagonal of the Fisher matrix, summed over the examples of the batch.
+
+        The per-example gradients are vectorized over the batch by the jacobian, and reduced in the same graph, so only
+        tensors of the size of the model are accumulated. The critics are only differentiated if they are regularized.
+        """
         with tf.GradientTape(persistent=True) as g:
             # Main outputs from computation graph
             logits = self.actor(obs, one_hot)
             logits = tf.reduce_sum(logits, -1)
 
-            q1 = self.critic1(obs, one_hot)
-            q2 = self.critic2(obs, one_hot)
-
-            q1 = tf.reduce_sum(q1, -1)
-            q2 = tf.reduce_sum(q2, -1)
-
-        # Compute diagonal of the Fisher matrix
-        actor_gs = g.jacobian(logits, self.actor_common_variables)
-        q1_gs = g.jacobian(q1, self.critic1.common_variables)
-        q2_gs = g.jacobian(q2, self.critic2.common_variables)
-        del g
-        return actor_gs, q1_gs, q2_gs
-
-    def _get_importance_weights(self, **batch) -> List[tf.Tensor]:
-        actor_gs, q1_gs, q2_gs = self._get_grads(batch['obs'], batch['one_hot'])
+            if self.regularize_critic:
+                q1 = tf.reduce_sum(self.critic1(obs, one_hot), -1)
+                q2 = tf.reduce_sum(self.critic2(obs, one_hot), -1)
 
-        reg_weights = []
-        for gs in actor_gs:
+        fisher_sums = []
+        for gs in g.jacobian(logits, self.actor_common_variables):
             if gs is None:
                 raise ValueError("Actor gradients are None!")
 
@@ -50,17 +42,11 @@ class EWC_SAC(Regularization_SAC):
 
             # Clip from below
             fisher = tf.clip_by_value(fisher, 1e-5, np.inf)
+            fisher_sums += [tf.reduce_sum(fisher, 0)]
 
-            # Average over the examples in the batch
-            reg_weights += [tf.reduce_mean(fisher, 0)]
-
-        critic_coef = 1.0 if self.regularize_critic else 0.0
-        for q_g in q1_gs:
-            fisher = q_g**2
-            reg_weights += [critic_coef * tf.reduce_mean(fisher, 0)]
-
-        for q_g in q2_gs:
-            fisher = q_g**2
-            reg_weights += [critic_coef * tf.reduce_mean(fisher, 0)]
-
-        return reg_weights
+        if self.regularize_critic:
+            for q, critic in ((q1, self.critic1), (q2, self.critic2)):
+                for q_g in g.jacobian(q, critic.common_variables):
+                    fisher_sums += [tf.reduce_sum(q_g**2, 0)]
+        del g
+        return fisher_sums
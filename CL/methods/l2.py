@@ -10,9 +10,7 @@ class L2_SAC(Regularization_SAC):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
-    def _update_reg_weights(
-        self, replay_buffer: ReplayBuffer, batches_num: int = 10, batch_size: int = 256
-    ) -> None:
+    def _update_reg_weights(self, replay_buffer: ReplayBuffer) -> None:
         if self.regularize_critic:
             new_weights = list(tf.ones_like(param) for param in self.all_common_variables)
         else:
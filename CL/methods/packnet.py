@@ -1,7 +1,10 @@
 import time
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import tensorflow as tf
+from tensorflow.python.framework import dtypes
+from tensorflow_probability.python.distributions import Categorical
 
 from CL.rl.sac import SAC
 from CL.utils.running import reset_optimizer
@@ -20,6 +23,11 @@ class PackNet_SAC(SAC):
             each task.
         """
         super().__init__(**vanilla_sac_kwargs)
+        if self.env.num_tasks > 256:
+            raise ValueError("PackNet stores the owner task of each weight in a byte and supports up to 256 tasks")
+        if self.critic_owns_encoder and not regularize_critic:
+            raise ValueError("PackNet manages the encoder shared with the critics only if the critics are regularized, "
+                             "otherwise it keeps training and changes the weights of the previous tasks")
         self.regularize_critic = regularize_critic
         self.retrain_steps = retrain_steps
 
@@ -27,23 +35,30 @@ class PackNet_SAC(SAC):
         if self.regularize_critic:
             packnet_models.extend([self.critic1, self.critic2])
 
+        # The task which owns each kernel weight, and whether the weight is trained in the current task
         self.owner = {}
-        self.saved_variables = {}
-        self.current_view = tf.Variable(-1, trainable=False)
+        self.train_masks = {}
+        # Copy of the actor with the weights of a previous task, on which it is evaluated, and the task whose
+        # kernels it holds
+        self.view_actor = None
+        self.view_task = None
+        self.test_actor = None
+        self.trained_task = self.start_from_task
         self.managed_variable_refs = set()
         for model in packnet_models:
             if model.num_heads == 1:
                 variables_to_manage = model.trainable_variables
             else:
                 # If there are more heads, do not touch them with PackNet.
-                variables_to_manage = model.core.trainable_variables
+                variables_to_manage = model.core.trainable_variables + model.encoder_variables
             for v in variables_to_manage:
                 self.managed_variable_refs.add(v.ref())
                 if "kernel" in v.name:
                     self.owner[v.ref()] = tf.Variable(
-                        tf.zeros_like(v, dtype=tf.int32), trainable=False
+                        tf.zeros_like(v, dtype=tf.uint8), trainable=False
                     )
-                    self.saved_variables[v.ref()] = tf.Variable(tf.zeros_like(v), trainable=False)
+                    self.train_masks[v.ref()] = tf.Variable(tf.zeros_like(v, dtype=tf.bool), trainable=False)
+        self._update_train_masks(self.start_from_task)
         self.freeze_biases_and_normalization = tf.Variable(False, trainable=False)
 
     def adjust_gradients(
@@ -55,20 +70,41 @@ class PackNet_SAC(SAC):
         metrics: dict,
         episodic_batch: Dict[str, tf.Tensor] = None,
     ) -> Tuple[List[tf.Tensor], List[tf.Tensor], List[tf.Tensor]]:
-        actor_gradients = self._adjust_gradients_list(
-            actor_gradients, self.actor.trainable_variables, tf.convert_to_tensor(current_task_idx)
-        )
+        actor_gradients = self._adjust_gradients_list(actor_gradients, self.actor.trainable_variables)
         if self.regularize_critic:
-            critic_gradients = self._adjust_gradients_list(
-                critic_gradients, self.critic_variables, tf.convert_to_tensor(current_task_idx)
-            )
+            critic_gradients = self._adjust_gradients_list(critic_gradients, self.critic_variables)
         return actor_gradients, critic_gradients, alpha_gradient
 
-    def on_test_start(self, seq_idx: tf.Tensor) -> None:
-        self._set_view(seq_idx)
+    def on_test_start(self, seq_idx: int) -> None:
+        self.test_actor = self._get_view_actor(seq_idx)
 
-    def on_test_end(self, seq_idx: tf.Tensor) -> None:
-        self._set_view(-1)
+    def on_test_end(self, seq_idx: int) -> None:
+        self.test_actor = None
+
+    def get_action_test(
+            self, obs: tf.Tensor, one_hot_task_id: tf.Tensor, deterministic: tf.Tensor = tf.constant(False)
+    ) -> tf.Tensor:
+        if self.test_actor is None:
+            return super().get_action_test(obs, one_hot_task_id, deterministic)
+        return self._get_view_action(self.test_actor, obs, one_hot_task_id, deterministic).numpy()[0]
+
+    @tf.function
+    def _get_view_action(self, actor: tf.keras.Model, obs: tf.Tensor, one_hot_task_id: tf.Tensor,
+                         deterministic: tf.Tensor = tf.constant(False)) -> tf.Tensor:
+        logits = actor(tf.expand_dims(obs, 0), tf.expand_dims(one_hot_task_id, 0))
+        dist = Categorical(logits=logits)
+        return tf.math.argmax(logits, axis=-1, output_type=dtypes.int32) if deterministic else dist.sample()
+
+    def _test_weights(self, seq_idx: int) -> List[np.ndarray]:
+        view_actor = self._get_view_actor(seq_idx)
+        if view_actor is None:
+            return self._actor_weights()
+        return view_actor.get_weights()
+
+    def on_task_start(self, current_task_idx: int) -> None:
+        super(PackNet_SAC, self).on_task_start(current_task_idx)
+        self.trained_task = current_task_idx
+        self._update_train_masks(current_task_idx)
 
     def on_task_end(self, current_task_idx: int) -> None:
         super(PackNet_SAC, self).on_task_end(current_task_idx)
@@ -80,6 +116,7 @@ class PackNet_SAC(SAC):
             num_tasks_left = self.env.num_tasks - current_task_idx - 1
             prune_perc = num_tasks_left / (num_tasks_left + 1)
             self._prune(prune_perc, current_task_idx)
+            self._update_train_masks(current_task_idx)
 
             self.logger.log(f"Resetting the optimizer", color='cyan')
             reset_optimizer(self.optimizer)
@@ -94,16 +131,18 @@ class PackNet_SAC(SAC):
             self.logger.log(f"Resetting the optimizer", color='cyan')
             reset_optimizer(self.optimizer)
 
+    def _update_train_masks(self, seq_idx: int) -> None:
+        """Cache the masks of the kernel weights owned by the given task, which are the only ones it trains."""
+        for ref, owner in self.owner.items():
+            self.train_masks[ref].assign(owner == seq_idx)
+
     @tf.function
-    def _adjust_gradients_list(
-        self, grads: List[tf.Tensor], variables: List[tf.Variable], seq_idx: int
-    ) -> List[tf.Tensor]:
+    def _adjust_gradients_list(self, grads: List[tf.Tensor], variables: List[tf.Variable]) -> List[tf.Tensor]:
         """Computes PackNet adjustment to the gradients to be used in gradient step.
 
         Args:
           grads: original gradients
           variables: variables corresponding to the original gradients
-          seq_idx: number of the task we are currently in
 
         Returns:
           List[tf.Tensor]: adjusted gradients
@@ -113,7 +152,7 @@ class PackNet_SAC(SAC):
         for g, v in zip(grads, variables):
             if v.ref() in self.managed_variable_refs:
                 if "kernel" in v.name:
-                    res.append(g * tf.cast(self.owner[v.ref()] == seq_idx, tf.float32))
+                    res.append(tf.where(self.train_masks[v.ref()], g, tf.zeros_like(g)))
                 else:
                     res.append(
                         g * (1.0 - tf.cast(self.freeze_biases_and_normalization, tf.float32))
@@ -125,42 +164,55 @@ class PackNet_SAC(SAC):
     def _prune(self, prune_perc: float, seq_idx: int) -> None:
         """Prune given percentage of weights previously used by a given task.
 
+        The pruned weights are set to zero and handed over to the next task. The threshold of each kernel is found
+        with a single top-k over the magnitudes of its weights, where the weights of other tasks rank last.
+
         Args:
           prune_perc: percentage to prune
           seq_idx: number of the task to prune weights from
         """
         for ref, owner in self.owner.items():
             v = ref.deref()
-            vals = v[owner == seq_idx]
-            vals = tf.sort(tf.abs(vals))
-            threshold_index = tf.cast(tf.cast(tf.shape(vals)[0], tf.float32) * prune_perc, tf.int32)
-            threshold = vals[threshold_index]
-            keep_mask = (tf.abs(v) > threshold) | (owner != seq_idx)
-            v.assign(v * tf.cast(keep_mask, tf.float32))
-            owner.assign(
-                owner * tf.cast(keep_mask, tf.int32) + (seq_idx + 1) * tf.cast(~keep_mask, tf.int32)
-            )
-
-    def _set_view(self, seq_idx: int) -> None:
-        """Bring back the version of the models from a moment corresponding to a given task.
+            owned = owner == seq_idx
+            magnitudes = tf.where(owned, tf.abs(v), -tf.ones_like(v))
+            num_owned = tf.reduce_sum(tf.cast(owned, tf.int32))
+            num_kept = num_owned - tf.cast(tf.cast(num_owned, tf.float32) * prune_perc, tf.int32)
+            threshold = tf.math.top_k(tf.reshape(magnitudes, [-1]), num_kept, sorted=False).values
+            threshold = tf.reduce_min(threshold)
+            keep_mask = (tf.abs(v) > threshold) | ~owned
+            v.assign(tf.where(keep_mask, v, tf.zeros_like(v)))
+            owner.assign(tf.where(keep_mask, owner, tf.cast(seq_idx + 1, tf.uint8)))
+        self.view_task = None
+
+    def _get_view_actor(self, seq_idx: int) -> Optional[tf.keras.Model]:
+        """Bring back the version of the actor from a moment corresponding to a given task, without modifying it.
+
+        The kernel weights owned by tasks after the given one are set to 0. A task trains its own kernel weights
+        until it ends, and those of the later tasks stay 0 until then, so the current and later tasks use the actor
+        itself. The earlier tasks share a single copy of the actor, so the memory does not grow with the tasks. Its
+        kernels are masked again only when it switches to another task or after a pruning, as they are frozen in the
+        meantime. The other variables are copied from the actor on every use, as some of them, like the heads of
+        the other tasks, are not frozen.
 
         Args:
-          seq_idx: Number of a task. If this value is N >= 0, then the weights corresponding to
-            tasks 0, 1, ..., N will be set to their real values, and the rest will be set to 0. This
-            is used to do inference on task N.
-            If seq_idx is -1, all weights will be set to their current values. This mode is used in
-            training.
+          seq_idx: Number of a task.
+
+        Returns:
+          The copy of the actor for the task, or None if it uses the actor.
         """
-        if seq_idx == -1:
-            for ref, saved_variable in self.saved_variables.items():
-                v = ref.deref()
-                v.assign(saved_variable)
-        else:
-            for ref, owner in self.owner.items():
-                v = ref.deref()
-                self.saved_variables[ref].assign(v)
-                v.assign(v * tf.cast(owner <= seq_idx, tf.float32))
-        self.current_view.assign(seq_idx)
+        if seq_idx >= self.trained_task:
+            return None
+        if self.view_actor is None:
+            self.view_actor = self._new_actor()
+
+        for view_v, v in zip(self.view_actor.weights, self._actor_variables()):
+            owner = self.owner.get(v.ref())
+            if owner is None:
+                view_v.assign(v)
+            elif self.view_task != seq_idx:
+                view_v.assign(tf.where(owner <= seq_idx, v, tf.zeros_like(v)))
+        self.view_task = seq_idx
+        return self.view_actor
 
     def _set_freeze_biases_and_normalization(self, value: bool) -> None:
         self.freeze_biases_and_normalization.assign(value)
@@ -1,12 +1,16 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
 import tensorflow as tf
-from typing import List
 
 from CL.replay.buffers import ReplayBuffer
 from CL.rl.sac import SAC
 
 
 class Regularization_SAC(SAC):
-    def __init__(self, cl_reg_coef=1.0, regularize_critic=False, **vanilla_sac_kwargs):
+    def __init__(self, cl_reg_coef=1.0, regularize_critic=False, importance_samples: int = 320,
+                 importance_batch_size: int = 32, importance_time_budget: Optional[float] = None,
+                 **vanilla_sac_kwargs):
         """Class for regularization methods.
 
         Args:
@@ -14,75 +18,149 @@ class Regularization_SAC(SAC):
             Valid for 'l2', 'ewc', 'mas' continual learning methods.
           regularize_critic: If True, both actor and critic are regularized; if False, only actor
             is regularized.
+          importance_samples: Maximum number of examples on which the importance of the parameters
+            is estimated.
+          importance_batch_size: Number of examples whose per-example gradients are computed together.
+          importance_time_budget: If set, the estimation stops after the first batch which exceeds
+            this many seconds.
         """
+        if importance_samples <= 0 or importance_batch_size <= 0:
+            raise ValueError("The importance of the parameters must be estimated on positive numbers of examples")
+        if importance_time_budget is not None and importance_time_budget <= 0:
+            raise ValueError("The time budget of the importance estimation must be positive")
         super().__init__(**vanilla_sac_kwargs)
         self.cl_reg_coef = cl_reg_coef
         self.regularize_critic = regularize_critic
-        self.old_params = list(
-            tf.Variable(tf.identity(param), trainable=False) for param in self.all_common_variables
-        )
+        self.importance_samples = importance_samples
+        self.importance_batch_size = importance_batch_size
+        self.importance_time_budget = importance_time_budget
+        # The previous parameters and their weights are packed into flat tensors, in the order of
+        # all_common_variables, so the regularization takes a few fused ops instead of several per variable
+        self.old_params = tf.Variable(self._flatten(self.all_common_variables), trainable=False)
 
         self.actor_common_variables = self.actor.common_variables
         self.critic_common_variables = self.critic1.common_variables + self.critic2.common_variables
 
-        self.reg_weights = list(
+        self.reg_weights = tf.Variable(tf.zeros_like(self.old_params), trainable=False)
+        # Importance weights of the current task, summed over the examples seen so far
+        self.importance_sums = list(
             tf.Variable(tf.zeros_like(param), trainable=False)
             for param in self.all_common_variables
         )
 
-    def get_auxiliary_loss(self, seq_idx: tf.Tensor) -> tf.Tensor:
-        aux_loss = self._regularize(self.old_params)
-        aux_loss_coef = tf.cond(seq_idx > 0, lambda: self.cl_reg_coef, lambda: 0.0)
-        aux_loss *= aux_loss_coef
+    def adjust_gradients(
+            self,
+            actor_gradients: List[tf.Tensor],
+            critic_gradients: List[tf.Tensor],
+            alpha_gradient: List[tf.Tensor],
+            current_task_idx: int,
+            metrics: dict,
+            episodic_batch: Dict[str, tf.Tensor] = None,
+    ) -> Tuple[List[tf.Tensor], List[tf.Tensor], List[tf.Tensor]]:
+        """Add the gradients of the regularization loss, which are computed analytically instead of
+        through the gradient tape."""
+        if current_task_idx > 0:
+            reg_loss, reg_gradients = self._regularize()
+
+            # A variable which appears several times among the common variables, like a shared encoder,
+            # gets the sum of the gradients of its occurrences
+            variable_reg_gradients = {}
+            for param, reg_gradient in zip(self.all_common_variables, reg_gradients):
+                if param.ref() in variable_reg_gradients:
+                    reg_gradient += variable_reg_gradients[param.ref()]
+                variable_reg_gradients[param.ref()] = reg_gradient
+
+            actor_gradients = self._add_reg_gradients(
+                actor_gradients, self.actor.trainable_variables, variable_reg_gradients
+            )
+            critic_gradients = self._add_reg_gradients(
+                critic_gradients, self.critic_variables, variable_reg_gradients
+            )
+            metrics["reg_loss"] = reg_loss
 
-        return aux_loss
+        return actor_gradients, critic_gradients, alpha_gradient
 
     def on_task_start(self, current_task_idx: int) -> None:
         super(Regularization_SAC, self).on_task_start(current_task_idx)
         if current_task_idx > 0:
-            for old_param, new_param in zip(self.old_params, self.all_common_variables):
-                old_param.assign(new_param)
-            self._update_reg_weights(self.replay_buffer, batch_size=32)
+            self.old_params.assign(self._flatten(self.all_common_variables))
+            self._update_reg_weights(self.replay_buffer)
 
-    def _merge_weights(self, new_weights: List[tf.Variable]) -> None:
+    def _merge_weights(self, new_weights: List[tf.Tensor]) -> None:
         """Merge the parameter importance weights for current task with the importance weights
         of previous tasks."""
-        if self.reg_weights is not None:
-            merged_weights = list(
-                old_reg + new_reg for old_reg, new_reg in zip(self.reg_weights, new_weights)
-            )
-        else:
-            merged_weights = new_weights
+        self.reg_weights.assign_add(self._flatten(new_weights))
 
-        for old_weight, new_weight in zip(self.reg_weights, merged_weights):
-            old_weight.assign(new_weight)
+    @tf.function
+    def _accumulate_importance(self, obs: tf.Tensor, one_hot: tf.Tensor) -> None:
+        # The critics get no sums when they are not regularized, so their importance stays zero
+        for importance_sum, batch_sum in zip(self.importance_sums, self._get_importance_sums(obs, one_hot)):
+            importance_sum.assign_add(tf.broadcast_to(batch_sum, importance_sum.shape))
 
-    def _update_reg_weights(
-            self, replay_buffer: ReplayBuffer, batches_num: int = 10, batch_size: int = 256
-    ) -> None:
+    def _update_reg_weights(self, replay_buffer: ReplayBuffer) -> None:
         """Calculate importance weights representing how important each weight is for the current
-        task."""
-        all_weights = []
-        for batch_idx in range(batches_num):
+        task.
+
+        The examples are processed importance_batch_size at a time, and only the running sums of
+        their importance weights are kept, until importance_samples examples or the time budget
+        are used up.
+        """
+        start_time = time.time()
+        for importance_sum in self.importance_sums:
+            importance_sum.assign(tf.zeros_like(importance_sum))
+
+        num_samples = 0
+        while num_samples < self.importance_samples:
+            if self.importance_time_budget is not None and num_samples > 0 and \
+                    time.time() - start_time > self.importance_time_budget:
+                break
+            batch_size = min(self.importance_batch_size, self.importance_samples - num_samples)
             batch = replay_buffer.sample_batch(batch_size)
-            all_weights += [self._get_importance_weights(**batch)]
-
-        mean_weights = []
-        for weights in zip(*all_weights):
-            mean_weights += [tf.reduce_mean(tf.stack(weights, 0), 0)]
-
-        self._merge_weights(mean_weights)
-
-    def _regularize(self, old_params: List[tf.Tensor]) -> tf.Tensor:
-        """Calculate the regularization loss based on previous parameters and parameter weights."""
-        reg_loss = tf.zeros([])
-        for new_param, old_param, weight in zip(
-                self.all_common_variables, old_params, self.reg_weights
-        ):
-            diffs = (new_param - old_param)**2
-            weighted_diffs = weight * diffs
-            reg_loss += tf.reduce_sum(weighted_diffs)
-        return reg_loss
-
-    def _get_importance_weights(self, **batch) -> List[tf.Tensor]:
+            self._accumulate_importance(batch['obs'], batch['one_hot'])
+            num_samples += batch_size
+
+        # Average over the examples
+        self._merge_weights([importance_sum / num_samples for importance_sum in self.importance_sums])
+        self.logger.log(f"Importance of the parameters estimated on {num_samples} examples "
+                        f"in {time.time() - start_time:.2f} seconds", color='cyan')
+
+    @staticmethod
+    def _flatten(tensors: List[tf.Tensor]) -> tf.Tensor:
+        return tf.concat([tf.reshape(tensor, [-1]) for tensor in tensors], 0)
+
+    @tf.function(jit_compile=True)
+    def _regularize(self) -> Tuple[tf.Tensor, List[tf.Tensor]]:
+        """Calculate the regularization loss based on previous parameters and parameter weights, and
+        its gradient with respect to each of the common variables.
+
+        XLA fuses the flattening of the parameters, the weighted differences and the reduction into a
+        few kernels.
+        """
+        new_params = self._flatten(self.all_common_variables)
+        weighted_diffs = self.cl_reg_coef * self.reg_weights * (new_params - self.old_params)
+        reg_loss = tf.reduce_sum(weighted_diffs * (new_params - self.old_params))
+
+        sizes = [param.shape.num_elements() for param in self.all_common_variables]
+        reg_gradients = tf.split(2 * weighted_diffs, sizes)
+        return reg_loss, [tf.reshape(gradient, param.shape)
+                          for param, gradient in zip(self.all_common_variables, reg_gradients)]
+
+    @staticmethod
+    def _add_reg_gradients(
+            gradients: List[tf.Tensor],
+            variables: List[tf.Variable],
+            reg_gradients: Dict,
+    ) -> List[tf.Tensor]:
+        """Add the gradients of the regularization loss, keyed by the references of the variables."""
+        new_gradients = []
+        for gradient, variable in zip(gradients, variables):
+            reg_gradient = reg_gradients.get(variable.ref())
+            if reg_gradient is not None:
+                gradient = reg_gradient if gradient is None else gradient + reg_gradient
+            new_gradients += [gradient]
+        return new_gradients
+
+    def _get_importance_sums(self, obs: tf.Tensor, one_hot: tf.Tensor) -> List[tf.Tensor]:
+        """Importance weights summed over the examples of the batch, for the common variables of the
+        actor, followed by those of the critics if they are regularized."""
         raise NotImplementedError
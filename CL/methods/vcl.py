@@ -163,6 +163,8 @@ class BayesianDense(Layer):
 
         weights = eps_w * tf.exp(0.5 * self.posterior_w_logvar) + self.posterior_w_mean
         biases = eps_b * tf.exp(0.5 * self.posterior_b_logvar) + self.posterior_b_mean
+        # The sampled parameters follow the compute dtype, the posterior variables stay in float32
+        weights, biases = tf.cast(weights, inputs.dtype), tf.cast(biases, inputs.dtype)
         output = tf.matmul(inputs, weights) + biases
 
         if self.activation is not None:
@@ -231,7 +233,7 @@ class VclMlpActor(Model):
         mus = []
         for sample_idx in range(samples_num):
             logits = self.core(obs) if self.hide_task_id else self.core((obs, one_hot_task_id))
-            mu = self.head_mu(logits)
+            mu = tf.cast(self.head_mu(logits), tf.float32)
 
             if self.num_heads > 1:
                 mu = _choose_head(mu, self.num_heads, one_hot_task_id)
@@ -1,11 +1,18 @@
+import mmap
+import multiprocessing as mp
 import numpy as np
+import os
 import random
+import shutil
+import tempfile
+import weakref
 import tensorflow as tf
 from enum import Enum
-from typing import Dict, Tuple, Optional
+from typing import Callable, Dict, List, Tuple, Optional
 from typing import Union
 
 from CL.replay.tree import SumTree, SegmentTree
+from CL.utils.shared_memory import SharedArrays
 
 
 class BufferType(Enum):
@@ -13,6 +20,27 @@ class BufferType(Enum):
     RESERVOIR = "reservoir"
     PRIORITY = "priority"
     PER = "per"
+    COMPACT = "compact"
+    FRAME = "frame"
+    SHARED = "shared"
+
+
+def to_frames(obs: np.ndarray) -> np.ndarray:
+    """Map observations rescaled to [-1, 1] back to their uint8 pixel values.
+
+    Observations outside of [-1, 1], e.g. from an environment without the ``Rescale`` wrapper, cannot be stored as
+    frames and raise a ValueError. Values off by up to half a pixel step are clipped.
+    """
+    pixels = (np.asarray(obs) + 1.) * 127.5
+    if pixels.size and (pixels.min() < -.5 or pixels.max() > 255.5):
+        raise ValueError(f"Observations must be rescaled to [-1, 1] to be stored as uint8 frames, got values in "
+                         f"[{pixels.min() / 127.5 - 1.}, {pixels.max() / 127.5 - 1.}]")
+    return np.clip(np.rint(pixels, out=pixels), 0, 255, out=pixels).astype(np.uint8)
+
+
+def to_obs(frames: np.ndarray) -> tf.Tensor:
+    """Convert uint8 pixel values to float32 observations in [-1, 1]."""
+    return tf.cast(tf.convert_to_tensor(frames), tf.float32) / 127.5 - 1.
 
 
 class ReplayBuffer:
@@ -40,6 +68,25 @@ class ReplayBuffer:
         self.ptr = (self.ptr + 1) % self.max_size
         self.size = min(self.size + 1, self.max_size)
 
+    def batch_idxs(self, batch_size: int) -> np.ndarray:
+        """Slots which the next batch_size stored transitions will occupy."""
+        return (self.ptr + np.arange(batch_size)) % self.max_size
+
+    def store_batch(
+            self, obs: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_obs: np.ndarray, done: np.ndarray,
+            one_hot: np.ndarray
+    ) -> None:
+        """Store one transition for each of a batch of environments stepped together."""
+        idxs = self.batch_idxs(len(obs))
+        self.obs_buf[idxs] = obs
+        self.next_obs_buf[idxs] = next_obs
+        self.actions_buf[idxs] = actions
+        self.rewards_buf[idxs] = rewards
+        self.done_buf[idxs] = done
+        self.one_hot_buf[idxs] = one_hot
+        self.ptr = (self.ptr + len(obs)) % self.max_size
+        self.size = min(self.size + len(obs), self.max_size)
+
     def sample_batch(self, batch_size: int) -> Dict[str, tf.Tensor]:
         idxs = np.random.randint(0, self.size, size=batch_size)
         return dict(
@@ -51,14 +98,380 @@ class ReplayBuffer:
             one_hot=tf.convert_to_tensor(self.one_hot_buf[idxs])
         )
 
+    def clear(self) -> None:
+        """Drop the stored transitions, keeping the memory for the next ones."""
+        self.ptr, self.size = 0, 0
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes allocated for the stored transitions."""
+        return sum(v.nbytes for v in vars(self).values() if isinstance(v, np.ndarray))
+
+    @property
+    def bytes_per_transition(self) -> float:
+        return self.nbytes / self.max_size
+
+
+class CompactReplayBuffer(ReplayBuffer):
+    """A FIFO buffer which keeps the observations as raw uint8 frames and stores each of them only once.
+
+    The observations are expected to be rescaled to [-1, 1] by the ``Rescale`` wrapper, so they can be mapped
+    back to their original pixel values without loss. Each slot holds an observation and the transition which starts
+    from it, whose next observation is in the slot given by ``next_idxs_buf``. The next observation of the latest
+    transition of each environment is pending: it becomes the observation of the following transition of the same
+    environment, so a transition takes a single slot even when several environments store their transitions in
+    turns. When a new trajectory starts, the final observation of the previous one stays behind in its own slot,
+    which is excluded from sampling. The conversion to float and the rescaling to [-1, 1] only happen in
+    ``sample_batch``.
+    """
+
+    def __init__(self, obs_shape: Optional[Tuple[int, ...]], size: int, num_tasks: int) -> None:
+        self.obs_buf = np.zeros([size, *obs_shape], dtype=np.uint8)
+        self.next_idxs_buf = np.zeros(size, dtype=np.int64)
+        self.actions_buf = np.zeros(size, dtype=np.int32)
+        self.rewards_buf = np.zeros(size, dtype=np.float32)
+        self.done_buf = np.zeros(size, dtype=np.float32)
+        self.one_hot_buf = np.zeros([size, num_tasks], dtype=np.float32)
+        # Whether the slot holds a complete transition, i.e. its next observation is stored
+        self.valid_buf = np.zeros(size, dtype=bool)
+        self.ptr, self.size, self.max_size = 0, 0, size
+        # Slot of the next observation of the latest transition of each environment
+        self.pending: Dict[int, int] = {}
+
+    def _new_slot(self, frame: np.ndarray) -> int:
+        """Store an observation in the oldest slot of the ring, which drops the transition it held."""
+        idx = self.ptr
+        self.obs_buf[idx] = frame
+        self.valid_buf[idx] = False
+        # An environment which still had its pending observation there starts its next trajectory anew
+        self.pending = {env_idx: slot for env_idx, slot in self.pending.items() if slot != idx}
+        self.ptr = (self.ptr + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+        return idx
+
+    def store(
+            self, obs: np.ndarray, action: np.ndarray, reward: float, next_obs: np.ndarray, done: bool,
+            one_hot: np.ndarray, env_idx: int = 0
+    ) -> None:
+        frame = to_frames(obs)
+        idx = self.pending.get(env_idx)
+        if idx is None or not np.array_equal(self.obs_buf[idx], frame):
+            # Keep the last observation of the previous trajectory in place and start a new one
+            idx = self._new_slot(frame)
+        next_idx = self._new_slot(to_frames(next_obs))
+        self.next_idxs_buf[idx] = next_idx
+        self.actions_buf[idx] = action
+        self.rewards_buf[idx] = reward
+        self.done_buf[idx] = done
+        self.one_hot_buf[idx] = one_hot
+        self.valid_buf[idx] = True
+        self.pending[env_idx] = next_idx
+
+    def store_batch(
+            self, obs: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_obs: np.ndarray, done: np.ndarray,
+            one_hot: np.ndarray
+    ) -> None:
+        """Store one transition for each of a batch of environments stepped together.
+
+        The pending observations are looked up per environment, so each transition still takes a single slot.
+        """
+        for env_idx, transition in enumerate(zip(obs, actions, rewards, next_obs, done, one_hot)):
+            self.store(*transition, env_idx=env_idx)
+
+    def clear(self) -> None:
+        super().clear()
+        self.valid_buf.fill(False)
+        self.pending = {}
+
+    def sample_idxs(self, batch_size: int) -> np.ndarray:
+        idxs = np.random.randint(0, self.size, size=batch_size)
+        invalid = ~self.valid_buf[idxs]
+        while invalid.any():
+            idxs[invalid] = np.random.randint(0, self.size, size=invalid.sum())
+            invalid = ~self.valid_buf[idxs]
+        return idxs
+
+    def sample_batch(self, batch_size: int) -> Dict[str, tf.Tensor]:
+        idxs = self.sample_idxs(batch_size)
+        return dict(
+            obs=to_obs(self.obs_buf[idxs]),
+            next_obs=to_obs(self.obs_buf[self.next_idxs_buf[idxs]]),
+            actions=tf.convert_to_tensor(self.actions_buf[idxs]),
+            rewards=tf.convert_to_tensor(self.rewards_buf[idxs]),
+            done=tf.convert_to_tensor(self.done_buf[idxs]),
+            one_hot=tf.convert_to_tensor(self.one_hot_buf[idxs])
+        )
+
+
+class FrameReplayBuffer(ReplayBuffer):
+    """A FIFO buffer which stores every single frame of the FrameStack windows only once.
+
+    The observations are expected to be ``frame_stack`` RGB frames combined along the channel dimension and rescaled
+    to [-1, 1]. The frames are kept as uint8 in a separate ring, and each transition only stores the ids of the frames
+    its observation and next observation are made of. The stacks are rebuilt in ``sample_batch``. At the start of an
+    episode the stack is padded with the first frame, which is then stored once.
+
+    Frame ids are increasing counters, the slot of a frame in the ring is its id modulo the ring capacity. A transition
+    becomes invalid once its oldest frame has been overwritten.
+    """
+
+    def __init__(self, obs_shape: Optional[Tuple[int, ...]], size: int, num_tasks: int, frame_stack: int = 4,
+                 frame_capacity: Optional[int] = None) -> None:
+        assert obs_shape[-1] % frame_stack == 0, f"Cannot split {obs_shape} into {frame_stack} frames"
+        self.frame_stack = frame_stack
+        self.frame_shape = (*obs_shape[:-1], obs_shape[-1] // frame_stack)
+        # Every transition adds a single frame, every episode start adds at least one more
+        self.frame_capacity = frame_capacity or size + size // 4 + frame_stack
+        self.frames_buf = np.zeros([self.frame_capacity, *self.frame_shape], dtype=np.uint8)
+        self.frame_ids_buf = np.zeros([size, 2, frame_stack], dtype=np.int64)
+        self.actions_buf = np.zeros(size, dtype=np.int32)
+        self.rewards_buf = np.zeros(size, dtype=np.float32)
+        self.done_buf = np.zeros(size, dtype=np.float32)
+        self.one_hot_buf = np.zeros([size, num_tasks], dtype=np.float32)
+        self.ptr, self.size, self.max_size = 0, 0, size
+        self.num_frames = 0
+        # Frames and ids of the next observation of the latest transition of each environment
+        self.last_stacks: Dict[int, Tuple[np.ndarray, List[int]]] = {}
+
+    def _split(self, obs: np.ndarray) -> np.ndarray:
+        frames = to_frames(obs).reshape(*self.frame_shape[:-1], self.frame_stack, self.frame_shape[-1])
+        return np.moveaxis(frames, -2, 0)
+
+    def _add_frame(self, frame: np.ndarray) -> int:
+        frame_id = self.num_frames
+        self.frames_buf[frame_id % self.frame_capacity] = frame
+        self.num_frames += 1
+        return frame_id
+
+    def _add_stack(self, frames: np.ndarray) -> List[int]:
+        ids = [self._add_frame(frames[0])]
+        for prev_frame, frame in zip(frames[:-1], frames[1:]):
+            # Frames repeated at the start of the episode are stored once
+            ids.append(ids[-1] if np.array_equal(prev_frame, frame) else self._add_frame(frame))
+        return ids
+
+    def store(
+            self, obs: np.ndarray, action: np.ndarray, reward: float, next_obs: np.ndarray, done: bool,
+            one_hot: np.ndarray, env_idx: int = 0
+    ) -> None:
+        frames = self._split(obs)
+        next_frames = self._split(next_obs)
+        last_frames, last_ids = self.last_stacks.get(env_idx, (None, None))
+        if last_frames is not None and np.array_equal(last_frames, frames):
+            ids = last_ids
+        else:
+            ids = self._add_stack(frames)
+
+        if np.array_equal(frames[1:], next_frames[:-1]):
+            next_ids = ids[1:] + [self._add_frame(next_frames[-1])]
+        else:
+            # The windows do not overlap, e.g. with augmented observations
+            next_ids = self._add_stack(next_frames)
+
+        self.frame_ids_buf[self.ptr] = ids, next_ids
+        self.actions_buf[self.ptr] = action
+        self.rewards_buf[self.ptr] = reward
+        self.done_buf[self.ptr] = done
+        self.one_hot_buf[self.ptr] = one_hot
+        self.ptr = (self.ptr + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+        self.last_stacks[env_idx] = next_frames, next_ids
+
+    def store_batch(
+            self, obs: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_obs: np.ndarray, done: np.ndarray,
+            one_hot: np.ndarray
+    ) -> None:
+        """Store one transition for each of a batch of environments stepped together.
+
+        The frames shared with the previous transition are looked up per environment, so they are still stored once.
+        """
+        for env_idx, transition in enumerate(zip(obs, actions, rewards, next_obs, done, one_hot)):
+            self.store(*transition, env_idx=env_idx)
+
+    def clear(self) -> None:
+        super().clear()
+        self.num_frames = 0
+        self.last_stacks = {}
+
+    def sample_idxs(self, batch_size: int) -> np.ndarray:
+        oldest_frame_id = self.num_frames - self.frame_capacity
+        idxs = np.random.randint(0, self.size, size=batch_size)
+        invalid = self.frame_ids_buf[idxs].min(axis=(1, 2)) < oldest_frame_id
+        while invalid.any():
+            idxs[invalid] = np.random.randint(0, self.size, size=invalid.sum())
+            invalid = self.frame_ids_buf[idxs].min(axis=(1, 2)) < oldest_frame_id
+        return idxs
+
+    def _stack(self, frame_ids: np.ndarray) -> tf.Tensor:
+        """Rebuild the observations from a [batch_size, frame_stack] array of frame ids."""
+        frames = self.frames_buf[frame_ids % self.frame_capacity]
+        # [batch, stack, h, w, c] -> [batch, h, w, stack * c], as combined by the RGBStack wrapper
+        frames = np.moveaxis(frames, 1, -2).reshape(len(frame_ids), *self.frame_shape[:-1], -1)
+        return to_obs(frames)
+
+    def sample_batch(self, batch_size: int) -> Dict[str, tf.Tensor]:
+        idxs = self.sample_idxs(batch_size)
+        frame_ids = self.frame_ids_buf[idxs]
+        return dict(
+            obs=self._stack(frame_ids[:, 0]),
+            next_obs=self._stack(frame_ids[:, 1]),
+            actions=tf.convert_to_tensor(self.actions_buf[idxs]),
+            rewards=tf.convert_to_tensor(self.rewards_buf[idxs]),
+            done=tf.convert_to_tensor(self.done_buf[idxs]),
+            one_hot=tf.convert_to_tensor(self.one_hot_buf[idxs])
+        )
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """A FIFO buffer whose transitions live in shared memory, so that several processes can store them.
+
+    Pickling the buffer, e.g. to pass it to a subprocess, attaches to the same memory without copying it. A producer
+    reserves its slots under a lock and copies its transitions without holding it, so several producers write
+    concurrently. It then commits them once all the transitions reserved before its own are committed, so the
+    transitions are committed in the order of their slots. The numbers of reserved and committed transitions are kept
+    in the shared block and only change under the lock. ``sample_batch`` only reads committed transitions whose slots
+    are not reserved again, and draws again those whose slots get reserved while they are read.
+    """
+
+    def __init__(self, obs_shape: Optional[Tuple[int, ...]], size: int, num_tasks: int) -> None:
+        self.arrays = SharedArrays({
+            "obs": ((size, *obs_shape), np.float32),
+            "next_obs": ((size, *obs_shape), np.float32),
+            "actions": ((size,), np.int32),
+            "rewards": ((size,), np.float32),
+            "done": ((size,), np.float32),
+            "one_hot": ((size, num_tasks), np.float32),
+            "counters": ((2,), np.int64),
+        })
+        # The processes of the repository are spawned, and a lock of the fork context cannot be sent to them
+        self.lock = mp.get_context("spawn").Lock()
+        self.committed = mp.get_context("spawn").Condition(self.lock)
+        self.max_size = size
+        self._attach()
+
+    def _attach(self) -> None:
+        self.obs_buf = self.arrays["obs"]
+        self.next_obs_buf = self.arrays["next_obs"]
+        self.actions_buf = self.arrays["actions"]
+        self.rewards_buf = self.arrays["rewards"]
+        self.done_buf = self.arrays["done"]
+        self.one_hot_buf = self.arrays["one_hot"]
+        # Numbers of reserved and committed transitions since the buffer was created or cleared
+        self.counters = self.arrays["counters"]
+
+    def __getstate__(self) -> Dict:
+        return {"arrays": self.arrays, "lock": self.lock, "committed": self.committed, "max_size": self.max_size}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._attach()
+
+    @property
+    def ptr(self) -> int:
+        return int(self.counters[0]) % self.max_size
+
+    @property
+    def size(self) -> int:
+        return min(int(self.counters[1]), self.max_size)
+
+    def _reserve(self, num_transitions: int) -> int:
+        """Reserve the slots of the next transitions, and return the number of transitions reserved before them."""
+        with self.lock:
+            start = int(self.counters[0])
+            self.counters[0] = start + num_transitions
+        return start
+
+    def _commit(self, start: int, num_transitions: int) -> None:
+        """Make written transitions available for sampling, after all the transitions reserved before them."""
+        with self.committed:
+            self.committed.wait_for(lambda: self.counters[1] == start)
+            self.counters[1] = start + num_transitions
+            self.committed.notify_all()
+
+    def store(
+            self, obs: np.ndarray, action: np.ndarray, reward: float, next_obs: np.ndarray, done: bool,
+            one_hot: np.ndarray
+    ) -> None:
+        self.store_batch(obs[None], np.array([action]), np.array([reward]), next_obs[None], np.array([done]),
+                         one_hot[None])
+
+    def store_batch(
+            self, obs: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_obs: np.ndarray, done: np.ndarray,
+            one_hot: np.ndarray
+    ) -> None:
+        start = self._reserve(len(obs))
+        idxs = (start + np.arange(len(obs))) % self.max_size
+        self.obs_buf[idxs] = obs
+        self.next_obs_buf[idxs] = next_obs
+        self.actions_buf[idxs] = actions
+        self.rewards_buf[idxs] = rewards
+        self.done_buf[idxs] = done
+        self.one_hot_buf[idxs] = one_hot
+        self._commit(start, len(obs))
+
+    def _sample_transitions(self, num_transitions: int) -> np.ndarray:
+        """Numbers of committed transitions whose slots are not reserved again by a producer."""
+        with self.lock:
+            num_reserved, num_committed = int(self.counters[0]), int(self.counters[1])
+        return np.random.randint(max(num_reserved - self.max_size, 0), num_committed, size=num_transitions)
+
+    def _gather(self, transitions: np.ndarray) -> Dict[str, np.ndarray]:
+        idxs = transitions % self.max_size
+        return dict(
+            obs=self.obs_buf[idxs],
+            next_obs=self.next_obs_buf[idxs],
+            actions=self.actions_buf[idxs],
+            rewards=self.rewards_buf[idxs],
+            done=self.done_buf[idxs],
+            one_hot=self.one_hot_buf[idxs]
+        )
+
+    def sample_batch(self, batch_size: int) -> Dict[str, tf.Tensor]:
+        transitions = self._sample_transitions(batch_size)
+        batch = self._gather(transitions)
+        while True:
+            # The transitions whose slots were reserved while they were read may be partly overwritten
+            with self.lock:
+                num_reserved = int(self.counters[0])
+            overwritten = transitions < num_reserved - self.max_size
+            if not overwritten.any():
+                break
+            transitions[overwritten] = self._sample_transitions(overwritten.sum())
+            for key, values in self._gather(transitions[overwritten]).items():
+                batch[key][overwritten] = values
+        return {key: tf.convert_to_tensor(values) for key, values in batch.items()}
+
+    def clear(self) -> None:
+        """Drop the stored transitions, keeping the memory for the next ones."""
+        with self.lock:
+            self.counters[:] = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.arrays.nbytes
+
+    def close(self) -> None:
+        for key in ("obs_buf", "next_obs_buf", "actions_buf", "rewards_buf", "done_buf", "one_hot_buf", "counters"):
+            delattr(self, key)
+        self.arrays.close()
+
 
 class EpisodicMemory:
-    """Buffer which does not support overwriting old samples."""
+    """Buffer which does not support overwriting old samples.
+
+    With store_frames, the observations are kept as uint8 frames, as in CompactReplayBuffer, and they are converted
+    back to float32 observations in [-1, 1] in ``sample_batch``. This is lossy for observations which are not
+    quantized, such as augmented ones. Methods which never read the next observations may skip storing them.
+    """
 
     def __init__(self, obs_shape: Optional[Tuple[int, ...]], act_dim: int, size: int, num_tasks: int,
-                 save_targets: bool = False) -> None:
-        self.obs_buf = np.zeros([size, *obs_shape], dtype=np.float32)
-        self.next_obs_buf = np.zeros([size, *obs_shape], dtype=np.float32)
+                 save_targets: bool = False, store_next_obs: bool = True, store_frames: bool = False) -> None:
+        self.store_frames = store_frames
+        obs_dtype = np.uint8 if self.store_frames else np.float32
+        self.obs_buf = np.zeros([size, *obs_shape], dtype=obs_dtype)
+        self.store_next_obs = store_next_obs
+        if self.store_next_obs:
+            self.next_obs_buf = np.zeros([size, *obs_shape], dtype=obs_dtype)
         self.actions_buf = np.zeros(size, dtype=np.int32)
         self.rewards_buf = np.zeros(size, dtype=np.float32)
         self.done_buf = np.zeros(size, dtype=np.float32)
@@ -75,18 +488,19 @@ class EpisodicMemory:
             obs: np.ndarray,
             actions: np.ndarray,
             rewards: np.ndarray,
-            next_obs: np.ndarray,
+            next_obs: Optional[np.ndarray],
             done: np.ndarray,
             one_hot: np.ndarray,
             **kwargs: Dict[str, np.ndarray]
     ) -> None:
-        assert len(obs) == len(actions) == len(rewards) == len(next_obs) == len(done)
+        assert len(obs) == len(actions) == len(rewards) == len(done)
         assert self.size + len(obs) <= self.max_size
 
         range_start = self.size
         range_end = self.size + len(obs)
-        self.obs_buf[range_start:range_end] = obs
-        self.next_obs_buf[range_start:range_end] = next_obs
+        self.obs_buf[range_start:range_end] = self._to_stored(obs)
+        if self.store_next_obs:
+            self.next_obs_buf[range_start:range_end] = self._to_stored(next_obs)
         self.actions_buf[range_start:range_end] = actions
         self.rewards_buf[range_start:range_end] = rewards
         self.done_buf[range_start:range_end] = done
@@ -97,6 +511,24 @@ class EpisodicMemory:
             self.critic2_pred_buf[range_start:range_end] = kwargs['critic2_preds']
         self.size = self.size + len(obs)
 
+    def store_from(
+            self,
+            buffer: ReplayBuffer,
+            num_samples: int,
+            batch_size: int = 256,
+            get_targets: Optional[Callable[[Dict[str, tf.Tensor]], Dict[str, tf.Tensor]]] = None,
+    ) -> None:
+        """Store transitions sampled from a replay buffer, batch_size of them at a time.
+
+        Only a single batch of sampled transitions exists at any time. get_targets computes the targets stored
+        along with each batch.
+        """
+        for start in range(0, num_samples, batch_size):
+            batch = buffer.sample_batch(min(batch_size, num_samples - start))
+            if get_targets is not None:
+                batch.update(get_targets(batch))
+            self.store_multiple(**{k: v.numpy() for k, v in batch.items()})
+
     def sample_batch(self, batch_size: int, task_weights: Optional[np.ndarray] = None) -> Dict[str, tf.Tensor]:
         batch_size = min(batch_size, self.size)
         if task_weights is not None:
@@ -107,13 +539,14 @@ class EpisodicMemory:
         else:
             idxs = np.random.choice(self.size, size=batch_size, replace=False)
         batch_dict = dict(
-            obs=tf.convert_to_tensor(self.obs_buf[idxs]),
-            next_obs=tf.convert_to_tensor(self.next_obs_buf[idxs]),
+            obs=self._to_sampled(self.obs_buf[idxs]),
             actions=tf.convert_to_tensor(self.actions_buf[idxs]),
             rewards=tf.convert_to_tensor(self.rewards_buf[idxs]),
             done=tf.convert_to_tensor(self.done_buf[idxs]),
             one_hot=tf.convert_to_tensor(self.one_hot_buf[idxs])
         )
+        if self.store_next_obs:
+            batch_dict["next_obs"] = self._to_sampled(self.next_obs_buf[idxs])
 
         if self.save_targets:
             batch_dict["actor_logits"] = tf.convert_to_tensor(self.actor_logits_buf[idxs])
@@ -122,6 +555,12 @@ class EpisodicMemory:
 
         return batch_dict
 
+    def _to_stored(self, obs: np.ndarray) -> np.ndarray:
+        return to_frames(obs) if self.store_frames else np.asarray(obs)
+
+    def _to_sampled(self, obs: np.ndarray) -> tf.Tensor:
+        return to_obs(obs) if self.store_frames else tf.convert_to_tensor(obs)
+
 
 class ReservoirReplayBuffer(ReplayBuffer):
     """Buffer for SAC agents implementing reservoir sampling."""
@@ -152,6 +591,66 @@ class ReservoirReplayBuffer(ReplayBuffer):
         self.one_hot_buf[buffer_idx] = one_hot
         self.size = min(self.size + 1, self.max_size)
 
+    def store_batch(
+            self, obs: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_obs: np.ndarray, done: np.ndarray,
+            one_hot: np.ndarray
+    ) -> None:
+        for transition in zip(obs, actions, rewards, next_obs, done, one_hot):
+            self.store(*transition)
+
+    def clear(self) -> None:
+        super().clear()
+        self.timestep = 0
+
+
+class DiskReplayBuffer(ReservoirReplayBuffer):
+    """A reservoir buffer which keeps the observations in memory-mapped files, so that its capacity is bounded by the
+    disk rather than the RAM.
+
+    As in CompactReplayBuffer, the observations are stored as uint8 frames, which also divides the disk reads by four.
+    Each of the observations and the next observations is a ``.npy`` file in a new subdirectory of ``directory``,
+    which is removed together with the buffer. The rest of the transitions is small and stays in RAM. The OS page
+    cache keeps the recently used pages in RAM. Since the slots are sampled at random, readahead is disabled, and the
+    sampled slots are read in increasing order, i.e. in a single forward pass over the files.
+    """
+
+    def __init__(self, obs_shape: Optional[Tuple[int, ...]], size: int, num_tasks: int, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="replay_", dir=directory)
+        weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+        self.obs_buf = self._memmap("obs", [size, *obs_shape])
+        self.next_obs_buf = self._memmap("next_obs", [size, *obs_shape])
+        self.actions_buf = np.zeros(size, dtype=np.int32)
+        self.rewards_buf = np.zeros(size, dtype=np.float32)
+        self.done_buf = np.zeros(size, dtype=np.float32)
+        self.one_hot_buf = np.zeros([size, num_tasks], dtype=np.float32)
+        self.ptr, self.size, self.max_size = 0, 0, size
+        self.timestep = 0
+
+    def _memmap(self, name: str, shape: List[int]) -> np.memmap:
+        array = np.lib.format.open_memmap(os.path.join(self.directory, f"{name}.npy"), mode="w+", dtype=np.uint8,
+                                          shape=tuple(shape))
+        if hasattr(mmap, "MADV_RANDOM"):
+            array._mmap.madvise(mmap.MADV_RANDOM)
+        return array
+
+    def store(
+            self, obs: np.ndarray, action: np.ndarray, reward: float, next_obs: np.ndarray, done: bool,
+            one_hot: np.ndarray
+    ) -> None:
+        super().store(to_frames(obs), action, reward, to_frames(next_obs), done, one_hot)
+
+    def sample_batch(self, batch_size: int) -> Dict[str, tf.Tensor]:
+        idxs = np.sort(np.random.randint(0, self.size, size=batch_size))
+        return dict(
+            obs=to_obs(self.obs_buf[idxs]),
+            next_obs=to_obs(self.next_obs_buf[idxs]),
+            actions=tf.convert_to_tensor(self.actions_buf[idxs]),
+            rewards=tf.convert_to_tensor(self.rewards_buf[idxs]),
+            done=tf.convert_to_tensor(self.done_buf[idxs]),
+            one_hot=tf.convert_to_tensor(self.one_hot_buf[idxs])
+        )
+
 
 class PrioritizedReplayBuffer(ReplayBuffer):
     PER_e = 0.01  # Avoid some experiences to have 0 probability of being taken
@@ -172,33 +671,37 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         """
         Store the transitions of the designated previous n steps in a replay buffer
         Pop the leftmost transitions as the oldest in case the experience replay capacity is breached
-        In case of prioritized replay find the max priority of the SumTree and add the experiences
-        to the tree buffer with that priority value
+        In case of prioritized replay find the max priority of the SumTree and give the experience
+        stored in the columnar buffers that priority value
         """
         # Find the maximum priority of the tree
-        max_priority = np.max(self.buffer.tree[-self.buffer.capacity:])
+        max_priority = self.buffer.max_priority
 
         # Use minimum priority if the priority is 0, otherwise this experience will never have a chance to be selected
         if max_priority == 0:
             max_priority = self.absolute_error_upper
 
-        experience = (obs, next_obs, action, reward, done, one_hot)
-
-        # Add the new experience to the tree with the maximum priority
-        self.buffer.add(max_priority, experience)
-        self.ptr = (self.ptr + 1) % self.max_size
-        self.size = min(self.size + 1, self.max_size)
-
-    def sample_batch(self, batch_size: int) -> Dict[str, tf.Tensor]:
-        # Create a sample array that will contain the mini-batch
-        memory_b = []
+        # The leaf of the experience corresponds to its position in the columnar buffers
+        self.buffer.update(self.ptr + self.buffer.capacity - 1, max_priority)
+        super().store(obs, action, reward, next_obs, done, one_hot)
 
-        # Create placeholders for the tree indexes and importance sampling weights
-        b_idx = np.empty((batch_size,), dtype=np.int32)
-        b_ISWeights = np.empty((batch_size, 1), dtype=np.float32)
+    def store_batch(
+            self, obs: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_obs: np.ndarray, done: np.ndarray,
+            one_hot: np.ndarray
+    ) -> None:
+        max_priority = self.buffer.max_priority
+        if max_priority == 0:
+            max_priority = self.absolute_error_upper
+        self.buffer.update_many(self.batch_idxs(len(obs)) + self.buffer.capacity - 1, max_priority)
+        super().store_batch(obs, actions, rewards, next_obs, done, one_hot)
 
-        # Calculate the priority segment
+    def clear(self) -> None:
+        super().clear()
+        self.buffer.clear()
+        # The importance-sampling exponent anneals again from its initial value
+        self.PER_b = PrioritizedReplayBuffer.PER_b
 
+    def sample_batch(self, batch_size: int) -> Dict[str, tf.Tensor]:
         # Divide the Range[0, p_total] into n ranges
         priority_segment = self.buffer.total_priority / batch_size  # Priority segment
 
@@ -206,43 +709,30 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         self.PER_b = np.min([1., self.PER_b + self.PER_b_increment])  # Max = 1
 
         # Calculate the max_weight. Set it to a small value to avoid division by zero
-        p_min = np.min(self.buffer.tree[-self.buffer.capacity:]) / self.buffer.total_priority
+        p_min = self.buffer.min_priority / self.buffer.total_priority
         max_weight = 1e-7 if p_min == 0 else (p_min * batch_size)**(-self.PER_b)
 
-        for i in range(batch_size):
-            """
-            Uniformly sample a value from each range
-            """
-            a, b = priority_segment * i, priority_segment * (i + 1)
-            value = np.random.uniform(a, b)
-
-            """
-            Experience that corresponds to each value that is retrieved
-            """
-            index, priority, data = self.buffer.get_leaf(value)
+        # Uniformly sample a value from each range and retrieve the corresponding experiences
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * priority_segment
+        b_idx, priorities = self.buffer.get_leaves(values)
+        idxs = b_idx - self.buffer.capacity + 1
 
-            # P(j)
-            sampling_probabilities = priority / self.buffer.total_priority
+        # P(j)
+        sampling_probabilities = priorities / self.buffer.total_priority
 
-            #  IS = (1/N * 1/P(i))**b /max wi == (N*P(i))**-b  /max wi
-            b_ISWeights[i, 0] = np.power(batch_size * sampling_probabilities, -self.PER_b) / max_weight
+        #  IS = (1/N * 1/P(i))**b /max wi == (N*P(i))**-b  /max wi
+        b_ISWeights = np.power(batch_size * sampling_probabilities, -self.PER_b) / max_weight
 
-            b_idx[i] = index
-
-            memory_b.append(data)
-
-        memory_b = np.array(memory_b)
-        batch = dict(
-            obs=tf.convert_to_tensor(memory_b[:, 0].tolist(), dtype=tf.float32),
-            next_obs=tf.convert_to_tensor(memory_b[:, 1].tolist(), dtype=tf.float32),
-            actions=tf.convert_to_tensor(memory_b[:, 2].tolist(), dtype=tf.int32),
-            rewards=tf.convert_to_tensor(memory_b[:, 3].tolist(), dtype=tf.float32),
-            done=tf.convert_to_tensor(memory_b[:, 4].tolist(), dtype=tf.float32),
-            one_hot=tf.convert_to_tensor(memory_b[:, 5].tolist(), dtype=tf.float32),
+        return dict(
+            obs=tf.convert_to_tensor(self.obs_buf[idxs]),
+            next_obs=tf.convert_to_tensor(self.next_obs_buf[idxs]),
+            actions=tf.convert_to_tensor(self.actions_buf[idxs]),
+            rewards=tf.convert_to_tensor(self.rewards_buf[idxs]),
+            done=tf.convert_to_tensor(self.done_buf[idxs]),
+            one_hot=tf.convert_to_tensor(self.one_hot_buf[idxs]),
             idxs=tf.convert_to_tensor(b_idx, dtype=tf.int32),
-            weights=tf.convert_to_tensor(b_ISWeights, dtype=tf.float32)
+            weights=tf.convert_to_tensor(b_ISWeights[:, None], dtype=tf.float32)
         )
-        return batch
 
     def update_weights(self, tree_idx: np.ndarray, abs_errors: tf.Tensor) -> None:
         """
@@ -252,8 +742,7 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         clipped_errors = np.minimum(abs_errors, self.absolute_error_upper)
         ps = np.power(clipped_errors, self.PER_a)
 
-        for ti, p in zip(tree_idx, ps):
-            self.buffer.update(ti, p)
+        self.buffer.update_many(tree_idx, ps)
 
     @property
     def buffer_size(self):
@@ -261,7 +750,7 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         Retrieve the number of gathered experience
         :return: Current size of the buffer
         """
-        return self.buffer.data_pointer
+        return self.size
 
 
 class PrioritizedExperienceReplay(ReplayBuffer):
@@ -285,23 +774,32 @@ class PrioritizedExperienceReplay(ReplayBuffer):
         ReplayBuffer.__init__(self, obs_shape, size, num_tasks)
         assert alpha > 0.0 and beta >= 0.0
         self._alpha, self._beta = alpha, beta
-        self._max_prio = self._min_prio = 1.0
         self.absolute_error_upper = 1.  # clipped abs error
         self.weight = SegmentTree(size)
         self.__eps = np.finfo(np.float32).eps.item()
         self._weight_norm = weight_norm
 
     def init_weight(self, index: Union[int, np.ndarray]) -> None:
-        self.weight[index] = self._max_prio**self._alpha
+        # New transitions get the maximum weight currently in the tree, or 1 if the tree is still empty
+        self.weight[index] = self.weight.max() if self.size > 0 else 1.0
 
     def store(
             self, obs: np.ndarray, action: np.ndarray, reward: float, next_obs: np.ndarray, done: bool,
             one_hot: np.ndarray
     ) -> None:
-        super().store(obs, action, reward, next_obs, done, one_hot)
         self.init_weight(self.ptr)
-        self.ptr = (self.ptr + 1) % self.max_size
-        self.size = min(self.size + 1, self.max_size)
+        super().store(obs, action, reward, next_obs, done, one_hot)
+
+    def store_batch(
+            self, obs: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_obs: np.ndarray, done: np.ndarray,
+            one_hot: np.ndarray
+    ) -> None:
+        self.init_weight(self.batch_idxs(len(obs)))
+        super().store_batch(obs, actions, rewards, next_obs, done, one_hot)
+
+    def clear(self) -> None:
+        super().clear()
+        self.weight.clear()
 
     def sample_batch(self, batch_size: int) -> Dict[str, tf.Tensor]:
         scalar = np.random.rand(batch_size) * self.weight.reduce()
@@ -330,7 +828,7 @@ class PrioritizedExperienceReplay(ReplayBuffer):
         # important sampling weight calculation
         # original formula: ((p_j/p_sum*N)**(-beta))/((p_min/p_sum*N)**(-beta))
         # simplified formula: (p_j/p_min)**(-beta)
-        return (self.weight[index] / self._min_prio)**(-self._beta)
+        return (self.weight[index] / self.weight.min())**(-self._beta)
 
     def update_weights(self, index: np.ndarray, new_weight: Union[np.ndarray, tf.Tensor]) -> None:
         """Update priority weight by index in this buffer.
@@ -340,8 +838,6 @@ class PrioritizedExperienceReplay(ReplayBuffer):
         """
         weight = np.abs(np.array(new_weight, dtype=np.float64)) + self.__eps
         self.weight[index] = weight**self._alpha
-        self._max_prio = max(self._max_prio, weight.max())
-        self._min_prio = min(self._min_prio, weight.min())
 
     def set_beta(self, beta: float) -> None:
         self._beta = beta
@@ -0,0 +1,54 @@
+import queue
+import threading
+from typing import Callable, Iterator, Tuple
+
+
+class BatchPrefetcher:
+    """Samples a fixed number of batches on a background thread, so that the index gathering and the
+    host-to-tensor copies of the next batches overlap with the current gradient step.
+
+    No transitions are stored while the batches of an update block are consumed, so the sampled indices stay valid
+    until the end of the block. The priorities of a prioritized buffer do change in the meantime, so a prefetched
+    batch may have been drawn with priorities which are a few updates old. Priority updates must hold ``lock``, so
+    that the tree is never read while it is being written.
+
+    Args:
+      sample_fn: Function which returns the next item, e.g. a tuple of the batch and the episodic batch.
+      num_batches: Number of items to produce.
+      prefetch: Maximum number of items prepared ahead. If 0, the items are sampled synchronously on iteration.
+    """
+
+    def __init__(self, sample_fn: Callable[[], Tuple], num_batches: int, prefetch: int = 0) -> None:
+        self.sample_fn = sample_fn
+        self.num_batches = num_batches
+        self.prefetch = prefetch
+        self.lock = threading.Lock()
+        self.queue = None
+        if prefetch > 0:
+            self.queue = queue.Queue(maxsize=prefetch)
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def _sample(self) -> Tuple:
+        with self.lock:
+            return self.sample_fn()
+
+    def _worker(self) -> None:
+        try:
+            for _ in range(self.num_batches):
+                self.queue.put(self._sample())
+        except Exception as e:
+            # Raise it in the consuming thread
+            self.queue.put(e)
+
+    def __iter__(self) -> Iterator[Tuple]:
+        for _ in range(self.num_batches):
+            if self.queue is None:
+                yield self._sample()
+                continue
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        if self.queue is not None:
+            self.thread.join()
@@ -1,5 +1,5 @@
 import numpy as np
-from typing import Union, Optional
+from typing import Optional, Tuple, Union
 
 
 class SumTree(object):
@@ -7,10 +7,9 @@ class SumTree(object):
     This SumTree is a modified version of the implementation by Morvan Zhou:
     https://github.com/MorvanZhou/Reinforcement-learning-with-tensorflow/blob/master/contents/5.2_Prioritized_Replay_DQN/RL_brain.py
     """
-    data_pointer = 0
 
     """
-    Initialize the nodes and data of the tree with zeros
+    Initialize the nodes of the tree with zeros
     """
 
     def __init__(self, capacity):
@@ -23,45 +22,23 @@ class SumTree(object):
         # Leaf nodes = capacity
         self.tree = np.zeros(2 * capacity - 1)
 
-        """ tree:
-            0
-           / \
-          0   0
-         / \ / \
-        0  0 0  0  [Size: capacity] it's at this line that there is the priorities score (aka pi)
-        """
-
-        # Contains [capacity] experiences
-        self.data = np.zeros(capacity, dtype=object)
-
-    """
-    Here we add our priority score in the sumtree leaf and add the experience in data
-    """
-
-    def add(self, priority, data):
-        # Determine the index where the experience will be stored
-        tree_index = self.data_pointer + self.capacity - 1
+        # Parallel trees which store the maximum and minimum priority of the leaves below each node
+        self.max_tree = np.zeros(2 * capacity - 1)
+        self.min_tree = np.zeros(2 * capacity - 1)
 
         """ tree:
             0
            / \
           0   0
          / \ / \
-        0  0 0  0  We fill the leaves from left to right
+        0  0 0  0  [Size: capacity] it's at this line that there is the priorities score (aka pi)
         """
 
-        # Update the data frame
-        self.data[self.data_pointer] = data
-
-        # Update the leaf
-        self.update(tree_index, priority)
-
-        # Increment the data_pointer
-        self.data_pointer += 1
-
-        # Return to first index and start overwriting, if the capacity is breached
-        if self.data_pointer >= self.capacity:
-            self.data_pointer = 0
+    def clear(self) -> None:
+        """Reset all the priorities to zero, keeping the arrays."""
+        self.tree.fill(0)
+        self.max_tree.fill(0)
+        self.min_tree.fill(0)
 
     """
     Update the leaf priority score and propagate the change through tree
@@ -71,6 +48,8 @@ class SumTree(object):
         # Change = new priority score - former priority score
         change = priority - self.tree[tree_index]
         self.tree[tree_index] = priority
+        self.max_tree[tree_index] = priority
+        self.min_tree[tree_index] = priority
 
         # Propagate the change through tree
         while tree_index != 0:  # This is faster than recursively looping
@@ -93,9 +72,46 @@ class SumTree(object):
             """
             tree_index = (tree_index - 1) // 2
             self.tree[tree_index] += change
+            left_child_index = 2 * tree_index + 1
+            right_child_index = left_child_index + 1
+            self.max_tree[tree_index] = max(self.max_tree[left_child_index], self.max_tree[right_child_index])
+            self.min_tree[tree_index] = min(self.min_tree[left_child_index], self.min_tree[right_child_index])
 
     """
-    Here we get the leaf_index, priority value of that leaf and experience associated with that index
+    Update many leaves at once and recompute their ancestors level by level
+    """
+
+    def update_many(self, tree_indices: np.ndarray, priorities: np.ndarray) -> None:
+        """Vectorized version of update.
+
+        If an index appears more than once, its last priority is used. The parents are recomputed as the sum of their
+        children instead of accumulating the changes. The leaves may lie on two different levels, so a parent can be
+        recomputed twice, but its last recomputation always happens after the one of its children.
+        """
+        tree_indices = np.asarray(tree_indices, dtype=np.int64)
+        priorities = np.broadcast_to(np.asarray(priorities, dtype=self.tree.dtype), tree_indices.shape)
+
+        # Keep the last occurrence of every index
+        tree_indices, last = np.unique(tree_indices[::-1], return_index=True)
+        self.tree[tree_indices] = priorities[::-1][last]
+        self.max_tree[tree_indices] = priorities[::-1][last]
+        self.min_tree[tree_indices] = priorities[::-1][last]
+
+        parent_indices = tree_indices
+        while True:
+            parent_indices = np.unique((parent_indices[parent_indices > 0] - 1) // 2)
+            if parent_indices.size == 0:
+                break
+            left_child_indices = 2 * parent_indices + 1
+            right_child_indices = left_child_indices + 1
+            self.tree[parent_indices] = self.tree[left_child_indices] + self.tree[right_child_indices]
+            self.max_tree[parent_indices] = np.maximum(self.max_tree[left_child_indices],
+                                                       self.max_tree[right_child_indices])
+            self.min_tree[parent_indices] = np.minimum(self.min_tree[left_child_indices],
+                                                       self.min_tree[right_child_indices])
+
+    """
+    Here we get the leaf_index and priority value of that leaf
     """
 
     def get_leaf(self, v):
@@ -130,14 +146,43 @@ class SumTree(object):
                     v -= self.tree[left_child_index]
                     parent_index = right_child_index
 
-        data_index = leaf_index - self.capacity + 1
+        return leaf_index, self.tree[leaf_index]
+
+    """
+    Here we get the leaf indexes and priority values for a whole array of values at once
+    """
 
-        return leaf_index, self.tree[leaf_index], self.data[data_index]
+    def get_leaves(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Vectorized version of get_leaf, which descends the tree for all values together.
+
+        The leaves of a tree with a capacity which is not a power of 2 lie on two different levels, so the values
+        which already reached a leaf stay in place until the others catch up.
+        """
+        values = np.array(values, dtype=np.float64)
+        index = np.zeros(values.shape, dtype=np.int64)
+        while True:
+            left_child_index = 2 * index + 1
+            internal = left_child_index < len(self.tree)
+            if not internal.any():
+                break
+            left_priority = self.tree[np.where(internal, left_child_index, 0)]
+            go_right = internal & (values > left_priority)
+            values -= left_priority * go_right
+            index = np.where(internal, left_child_index + go_right, index)
+        return index, self.tree[index]
 
     @property
     def total_priority(self):
         return self.tree[0]  # Returns the root node
 
+    @property
+    def max_priority(self):
+        return self.max_tree[0]  # Maximum priority of all the leaves
+
+    @property
+    def min_priority(self):
+        return self.min_tree[0]  # Minimum priority of all the leaves
+
 
 class SegmentTree:
     """Implementation of Segment Tree.
@@ -150,6 +195,10 @@ class SegmentTree:
     segment tree have the same depth.
     2. Store the segment tree in a binary heap.
 
+    The maximum and minimum of the values which have been set are kept in two
+    parallel heaps, so they can be queried in O(1) and stay correct when a
+    value is overwritten.
+
     :param int size: the size of segment tree.
     """
 
@@ -160,8 +209,16 @@ class SegmentTree:
         self._size = size
         self._bound = bound
         self._value = np.zeros([bound * 2])
+        self._max_value = np.full([bound * 2], -np.inf)
+        self._min_value = np.full([bound * 2], np.inf)
         self._compile()
 
+    def clear(self) -> None:
+        """Reset all the values, keeping the arrays."""
+        self._value.fill(0)
+        self._max_value.fill(-np.inf)
+        self._min_value.fill(np.inf)
+
     def __len__(self) -> int:
         return self._size
 
@@ -186,7 +243,10 @@ class SegmentTree:
         if isinstance(index, int):
             index, value = np.array([index]), np.array([value])
         assert np.all(0 <= index) and np.all(index < self._size)
-        _setitem(self._value, index + self._bound, value)
+        index = index + self._bound
+        _setitem(self._value, index.copy(), value)
+        _setitem_extremum(self._max_value, index.copy(), value, np.maximum)
+        _setitem_extremum(self._min_value, index, value, np.minimum)
 
     def reduce(self, start: int = 0, end: Optional[int] = None) -> float:
         """Return operation(value[start:end])."""
@@ -198,6 +258,14 @@ class SegmentTree:
             end += self._size
         return _reduce(self._value, start + self._bound - 1, end + self._bound)
 
+    def max(self) -> float:
+        """Return the maximum of the values which have been set, -inf if there are none."""
+        return self._max_value[1]
+
+    def min(self) -> float:
+        """Return the minimum of the values which have been set, inf if there are none."""
+        return self._min_value[1]
+
     def get_prefix_sum_idx(self, value: Union[float,
                                               np.ndarray]) -> Union[int, np.ndarray]:
         r"""Find the index with given value.
@@ -267,3 +335,11 @@ def _setitem(tree: np.ndarray, index: np.ndarray, value: np.ndarray) -> None:
     while index[0] > 1:
         index //= 2
         tree[index] = tree[index * 2] + tree[index * 2 + 1]
+
+
+def _setitem_extremum(tree: np.ndarray, index: np.ndarray, value: np.ndarray, op: np.ufunc) -> None:
+    """Same as _setitem, for a heap which stores the maximum or minimum of the children."""
+    tree[index] = value
+    while index[0] > 1:
+        index //= 2
+        tree[index] = op(tree[index * 2], tree[index * 2 + 1])
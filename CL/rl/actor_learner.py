@@ -0,0 +1,339 @@
+import multiprocessing as mp
+import queue
+import time
+import traceback
+from functools import partial
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import gymnasium
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import Model
+from tensorflow_probability.python.distributions import Categorical
+
+from CL.replay.buffers import BufferType, CompactReplayBuffer, FrameReplayBuffer, SharedReplayBuffer
+from CL.rl import models
+from CL.rl.sac import SAC
+from CL.utils.running import create_one_hot_vec, dtype_policy, set_seed
+from CL.utils.shared_memory import SharedArrays
+from CL.utils.vec_env import close_task_env
+
+
+class SharedWeights:
+    """Weights of the actor published by the learner to the collectors through shared memory.
+
+    The version counter tells the collectors whether their copy is stale, so they only copy the weights when the
+    learner has published new ones.
+    """
+
+    def __init__(self, weights: List[np.ndarray], ctx: mp.context.BaseContext) -> None:
+        self.arrays = SharedArrays({str(i): (w.shape, w.dtype) for i, w in enumerate(weights)})
+        self.version = ctx.Value("q", 0, lock=False)
+        self.lock = ctx.Lock()
+
+    def publish(self, weights: List[np.ndarray]) -> None:
+        with self.lock:
+            for i, w in enumerate(weights):
+                self.arrays[str(i)][...] = w
+            self.version.value += 1
+
+    def fetch(self, version: int) -> Tuple[Optional[List[np.ndarray]], int]:
+        """Return a copy of the weights and their version if they are newer than the given version."""
+        if self.version.value == version:
+            return None, version
+        with self.lock:
+            return [self.arrays[str(i)].copy() for i in range(len(self.arrays.specs))], self.version.value
+
+    def close(self) -> None:
+        self.arrays.close()
+
+
+def build_actor(actor_cl: type, policy_kwargs: Dict, shared_encoder: bool, mixed_precision: bool) -> Model:
+    """Create a standalone copy of the actor of an agent, with its own encoder if the agent shares one."""
+    with dtype_policy("mixed_bfloat16" if mixed_precision else "float32"):
+        if shared_encoder:
+            encoder = models.ConvEncoder(policy_kwargs["state_space"], policy_kwargs.get("use_lstm", False))
+            return actor_cl(**policy_kwargs, encoder=encoder, train_encoder=True)
+        return actor_cl(**policy_kwargs)
+
+
+def _chunk(staging: SharedArrays, slot: int, num_stored: int) -> List[np.ndarray]:
+    """Transitions of a staging slot, in the order of the arguments of store_batch."""
+    return [staging[key][slot, :num_stored] for key in ("obs", "actions", "rewards", "next_obs", "done", "one_hot")]
+
+
+def _collector(worker_idx: int, seed: int, env_fn: Callable[[], gymnasium.Env], actor_fn: Callable[[], Model],
+               weights: SharedWeights, staging: SharedArrays, free_slots: mp.Queue, commands: mp.Queue,
+               messages: mp.Queue, replay_buffer: Optional[SharedReplayBuffer], steps_per_task: int, sync_every: int,
+               num_collectors: int) -> None:
+    try:
+        env = env_fn()
+        set_seed(seed, env=env)
+        actor = actor_fn()
+        version = 0
+
+        @tf.function
+        def get_action(obs: tf.Tensor, one_hot_task_id: tf.Tensor) -> tf.Tensor:
+            logits = actor(tf.expand_dims(obs, 0), tf.expand_dims(one_hot_task_id, 0))
+            return Categorical(logits=logits).sample()[0]
+
+        obs, _ = env.reset()
+        episode_return, episode_len, episode_start = 0., 0, time.time()
+        slot, num_stored, episodes = free_slots.get(), 0, []
+        while True:
+            # Wait for the learner to start the next task
+            command, random_steps, max_episode_len = commands.get()
+            if command == "stop":
+                break
+            seq_idx = env.cur_seq_idx
+            one_hot_vec = create_one_hot_vec(env.num_tasks, env.task_id).astype(np.float32)
+            info = {}
+            for task_timestep in range(steps_per_task):
+                if task_timestep % sync_every == 0:
+                    new_weights, version = weights.fetch(version)
+                    if new_weights is not None:
+                        actor.set_weights(new_weights)
+
+                # The steps of all the collectors count towards the random exploration of the task
+                if task_timestep * num_collectors <= random_steps:
+                    action = env.action_space.sample()
+                else:
+                    action = get_action(tf.convert_to_tensor(obs), tf.convert_to_tensor(one_hot_vec)).numpy()
+
+                next_obs, reward, done, _, info = env.step(action)
+                episode_return += reward
+                episode_len += 1
+
+                # Consider also whether episode was truncated
+                done_to_store = False if episode_len == max_episode_len else done
+
+                staging["obs"][slot, num_stored] = obs
+                staging["next_obs"][slot, num_stored] = next_obs
+                staging["actions"][slot, num_stored] = action
+                staging["rewards"][slot, num_stored] = reward
+                staging["done"][slot, num_stored] = done_to_store
+                staging["one_hot"][slot, num_stored] = one_hot_vec
+                num_stored += 1
+                obs = next_obs
+
+                if done:
+                    episodes.append((episode_start, episode_return, episode_len, env.get_statistics('train')))
+                    env.clear_episode_statistics()
+                    episode_return, episode_len, episode_start = 0., 0, time.time()
+                    obs, _ = env.reset()
+
+                # Hand the filled slot over to the learner and wait for the other one to be free
+                if num_stored == staging["actions"].shape[1] or task_timestep == steps_per_task - 1:
+                    if replay_buffer is not None:
+                        replay_buffer.store_batch(*_chunk(staging, slot, num_stored))
+                    messages.put(("chunk", worker_idx, slot, num_stored, episodes, info))
+                    slot, num_stored, episodes = free_slots.get(), 0, []
+            messages.put(("task_end", worker_idx, seq_idx, None, None, info))
+            close_task_env(env, seq_idx)
+    except Exception:
+        messages.put(("error", worker_idx, traceback.format_exc(), None, None, None))
+
+
+class ActorLearner:
+    """Decouples the collection of the experience from the updates of the agent.
+
+    Collector processes step their own copies of the environment with a copy of the actor, and write the
+    transitions to shared memory. Each collector has two staging slots of ``chunk_size`` transitions, so it fills one
+    while the learner stores the other in the replay buffer of the agent. If the agent has a SharedReplayBuffer, the
+    collectors store the transitions of a full slot into it themselves, and the slot is only handed over for the
+    bookkeeping of the learner. The learner performs gradient steps one at
+    a time, as soon as they are allowed, and publishes the weights of the actor, which the collectors load every
+    ``sync_every`` of their steps.
+
+    The replay ratio follows the synchronous schedule of update_after, update_every and n_updates: at any point of
+    a task, the learner has done at most as many gradient steps as SAC.run would have done after the same number of
+    environment steps. The learner stops taking in new experience while it lags more than ``max_update_lag`` steps
+    behind that schedule, which in turn stalls the collectors. At the end of every task the learner catches up,
+    so the total number of updates per task is the same as with the synchronous schedule. The collectors wait at
+    every task boundary for the learner to finish the task.
+
+    Args:
+      agent: The agent to train. Its env is only used for the bookkeeping of the current task.
+      env_fns: Functions creating the environments of the collectors. They must be picklable, and each environment
+        must run steps_per_env / len(env_fns) steps per task.
+      sync_every: Number of steps of a collector between the checks for new weights of the actor.
+      max_update_lag: Number of gradient steps the learner may lag behind the synchronous schedule before it stops
+        taking in new experience.
+      seed: Seed of the first collector, the others use the following ones.
+      chunk_size: Number of transitions of a staging slot.
+      start_method: Start method of the collector processes.
+    """
+
+    def __init__(self, agent: SAC, env_fns: Sequence[Callable[[], gymnasium.Env]], sync_every: int = 100,
+                 max_update_lag: int = 50, seed: int = 0, chunk_size: int = 32, start_method: str = "spawn") -> None:
+        self.num_collectors = len(env_fns)
+        if agent.steps_per_env % self.num_collectors != 0:
+            raise ValueError(f"steps_per_env ({agent.steps_per_env}) must be a multiple of the number of "
+                             f"collectors ({self.num_collectors})")
+        if agent.vec_env is not None or agent.exploration_kind is not None or agent.test_only:
+            raise ValueError("Vectorized environments, exploration kinds and test_only are not supported "
+                             "with collectors")
+        self.agent = agent
+        self.env_fns = env_fns
+        self.sync_every = sync_every
+        self.max_update_lag = max_update_lag
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.ctx = mp.get_context(start_method)
+
+    def allowed_updates(self, task_timestep: int) -> int:
+        """Number of gradient steps SAC.run performs in the first task_timestep steps of a task."""
+        agent = self.agent
+        first_update = -(-agent.update_after // agent.update_every) * agent.update_every
+        if task_timestep <= first_update:
+            return 0
+        return ((task_timestep - 1 - first_update) // agent.update_every + 1) * agent.n_updates
+
+    def _store_chunk(self, staging: SharedArrays, worker_idx: int, slot: int, num_stored: int) -> None:
+        transitions = _chunk(staging, slot, num_stored)
+        replay_buffer = self.agent.replay_buffer
+        if isinstance(replay_buffer, SharedReplayBuffer):
+            # Already stored by the collector
+            return
+        if isinstance(replay_buffer, (CompactReplayBuffer, FrameReplayBuffer)):
+            # The observations shared by consecutive transitions are looked up per collector
+            for transition in zip(*transitions):
+                replay_buffer.store(*transition, env_idx=worker_idx)
+        else:
+            replay_buffer.store_batch(*transitions)
+
+    def _learn(self, current_task_idx: int) -> None:
+        agent = self.agent
+        batch = agent.replay_buffer.sample_batch(agent.batch_size)
+        episodic_batch = agent.get_episodic_batch(current_task_idx)
+        results = agent.learn_on_batch(tf.convert_to_tensor(current_task_idx), batch, episodic_batch)
+        if agent.buffer_type == BufferType.PER or agent.buffer_type == BufferType.PRIORITY:
+            agent.replay_buffer.update_weights(batch['idxs'].numpy(), results['abs_error'].numpy())
+        agent._log_after_update(results)
+
+    def run(self) -> None:
+        agent = self.agent
+        agent.start_time = time.time()
+        obs_shape, num_tasks = agent.obs_shape, agent.num_tasks
+        staging_specs = {
+            "obs": ((2, self.chunk_size, *obs_shape), np.float32),
+            "next_obs": ((2, self.chunk_size, *obs_shape), np.float32),
+            "actions": ((2, self.chunk_size), np.int32),
+            "rewards": ((2, self.chunk_size), np.float32),
+            "done": ((2, self.chunk_size), np.float32),
+            "one_hot": ((2, self.chunk_size, num_tasks), np.float32),
+        }
+        stagings = [SharedArrays(staging_specs) for _ in range(self.num_collectors)]
+        weights = SharedWeights(agent._actor_weights(), self.ctx)
+        free_slots = [self.ctx.Queue() for _ in range(self.num_collectors)]
+        commands = [self.ctx.Queue() for _ in range(self.num_collectors)]
+        messages = self.ctx.Queue()
+        actor_fn = partial(build_actor, agent.actor_cl, agent.policy_kwargs, agent.encoder is not None,
+                           agent.mixed_precision)
+        shared_buffer = agent.replay_buffer if isinstance(agent.replay_buffer, SharedReplayBuffer) else None
+        processes = []
+        for i, env_fn in enumerate(self.env_fns):
+            for slot in (0, 1):
+                free_slots[i].put(slot)
+            process = self.ctx.Process(target=_collector, daemon=True, args=(
+                i, self.seed + i, env_fn, actor_fn, weights, stagings[i], free_slots[i], commands[i], messages,
+                shared_buffer, agent.steps_per_env // self.num_collectors, self.sync_every, self.num_collectors))
+            process.start()
+            processes.append(process)
+
+        try:
+            self._learn_loop(stagings, weights, free_slots, commands, messages, processes)
+            for command_queue in commands:
+                command_queue.put(("stop", None, None))
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for staging in stagings:
+                staging.close()
+            weights.close()
+
+    def _learn_loop(self, stagings: List[SharedArrays], weights: SharedWeights, free_slots: List[mp.Queue],
+                    commands: List[mp.Queue], messages: mp.Queue, processes: List[mp.Process]) -> None:
+        agent = self.agent
+        num_actions = agent.env.action_space.n
+        action_counts = {i: 0 for i in range(num_actions)}
+        global_timestep, episodes, info = 0, 0, {}
+        last_epoch_timestep = 0
+
+        seq_idx = getattr(agent.env, "cur_seq_idx", 0)
+        while global_timestep < agent.steps:
+            # On task change
+            agent.env.cur_seq_idx = seq_idx
+            agent._handle_task_change(seq_idx)
+            weights.publish(agent._actor_weights())
+            random_steps = agent.start_steps
+            if (agent.agent_policy_exploration and seq_idx > 0) or agent.model_path:
+                random_steps = -1
+            for command_queue in commands:
+                command_queue.put(("continue", random_steps, agent.max_episode_len))
+
+            task_timestep, num_updates, last_publish = 0, 0, 0
+            collectors_done = 0
+            while True:
+                allowed_updates = self.allowed_updates(task_timestep)
+                if num_updates < allowed_updates:
+                    self._learn(seq_idx)
+                    num_updates += 1
+                    if task_timestep - last_publish >= self.sync_every:
+                        weights.publish(agent._actor_weights())
+                        last_publish = task_timestep
+                    if num_updates < allowed_updates - self.max_update_lag:
+                        # Too far behind the schedule to take in new experience
+                        continue
+
+                # End of epoch wrap-up, once the updates caught up with the schedule
+                epoch_timestep = (global_timestep // agent.log_every) * agent.log_every
+                if last_epoch_timestep < epoch_timestep and task_timestep < agent.steps_per_env:
+                    if num_updates < allowed_updates:
+                        continue
+                    last_epoch_timestep = epoch_timestep
+                    agent._end_epoch(seq_idx, task_timestep - 1, epoch_timestep - 1, info, action_counts)
+
+                if collectors_done == self.num_collectors:
+                    if num_updates == allowed_updates:
+                        break
+                    continue
+
+                try:
+                    # Only wait for new experience when there is nothing else to do
+                    block = num_updates >= allowed_updates
+                    kind, worker_idx, *data = messages.get(block=block, timeout=1. if block else None)
+                except queue.Empty:
+                    if not all(process.is_alive() for process in processes):
+                        raise RuntimeError("A collector exited unexpectedly")
+                    continue
+
+                if kind == "error":
+                    raise RuntimeError(f"Collector {worker_idx} failed:\n{data[0]}")
+                if kind == "task_end":
+                    collectors_done += 1
+                    info = data[3]
+                    continue
+
+                slot, num_stored, worker_episodes, info = data
+                self._store_chunk(stagings[worker_idx], worker_idx, slot, num_stored)
+                for action in stagings[worker_idx]["actions"][slot, :num_stored]:
+                    action_counts[int(action)] += 1
+                free_slots[worker_idx].put(slot)
+                task_timestep += num_stored
+                global_timestep += num_stored
+                for episode_start, episode_return, episode_len, statistics in worker_episodes:
+                    episodes += 1
+                    agent._log_episode(episodes, episode_start, episode_return, episode_len, statistics)
+
+            if agent.env.name == "ContinualLearningEnv":
+                episodes = 0
+                agent.on_task_end(seq_idx)
+            if last_epoch_timestep < global_timestep // agent.log_every * agent.log_every or (
+                    last_epoch_timestep < global_timestep == agent.steps):
+                last_epoch_timestep = global_timestep
+                agent._end_epoch(seq_idx, task_timestep - 1, global_timestep - 1, info, action_counts)
+            seq_idx += 1
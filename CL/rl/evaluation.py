@@ -0,0 +1,142 @@
+import threading
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import Model
+from tensorflow_probability.python.distributions import Categorical
+
+from CL.utils.running import create_one_hot_vec
+from CL.utils.vec_env import SubprocVecEnv
+
+# Per test environment key prefix, the logger entries and the environment statistics of every episode
+TestResults = Dict[str, List[Tuple[Dict[str, float], Dict[str, float]]]]
+
+
+class ParallelEvaluator:
+    """Evaluates snapshots of the actor on all the test environments at once.
+
+    The test environments are stepped together in the subprocesses of a SubprocVecEnv, and the observations of all
+    of them go through a single forward pass of the actor. The evaluation uses its own copies of the actor, so it can
+    run on a background thread while the training keeps updating the original one. Each test environment gets its own
+    snapshot of the weights, as methods like PackNet use different weights for every task. The environments whose
+    snapshots are identical share a copy of the actor. Contrary to the sequential evaluation, nothing is rendered.
+
+    Args:
+      vec_env: The test environments, in the order of their seq_idx.
+      actor_fn: Function which creates a new actor with the architecture of the evaluated one.
+    """
+
+    def __init__(self, vec_env: SubprocVecEnv, actor_fn: Callable[[], Model]) -> None:
+        self.vec_env = vec_env
+        self.actor_fn = actor_fn
+        self.actors: List[Model] = []
+        self.names = vec_env.get_attr("name")
+        self.one_hot_vecs = np.array([
+            create_one_hot_vec(num_tasks, task_id)
+            for num_tasks, task_id in zip(vec_env.get_attr("num_tasks"), vec_env.get_attr("task_id"))
+        ], dtype=np.float32)
+        self.num_actions = vec_env.action_space.n
+        self.thread = None
+        self.results = None
+        self.error = None
+
+    @tf.function
+    def get_actions(self, actor: Model, obs: tf.Tensor, one_hot_task_id: tf.Tensor,
+                    deterministic: tf.Tensor = tf.constant(False)) -> tf.Tensor:
+        logits = actor(obs, one_hot_task_id)
+        dist = Categorical(logits=logits)
+        return tf.math.argmax(logits, axis=-1, output_type=tf.dtypes.int32) if deterministic else dist.sample()
+
+    def _load_snapshots(self, snapshots: List[List[np.ndarray]]) -> List[np.ndarray]:
+        """Load the distinct snapshots into the copies of the actor and group the environments sharing them."""
+        groups = []
+        for env_idx, weights in enumerate(snapshots):
+            for group in groups:
+                if all(np.array_equal(a, b) for a, b in zip(snapshots[group[0]], weights)):
+                    group.append(env_idx)
+                    break
+            else:
+                groups.append([env_idx])
+        while len(self.actors) < len(groups):
+            self.actors.append(self.actor_fn())
+        for actor, group in zip(self.actors, groups):
+            actor.set_weights(snapshots[group[0]])
+        return [np.array(group) for group in groups]
+
+    def _evaluate(self, groups: List[np.ndarray], mode: str, num_episodes: int) -> TestResults:
+        deterministic = tf.constant(mode == "deterministic")
+        num_envs = self.vec_env.num_envs
+        key_prefixes = [f"test/{mode}/{seq_idx}/{name}" for seq_idx, name in enumerate(self.names)]
+        results = {key_prefix: [] for key_prefix in key_prefixes}
+
+        obs, _ = self.vec_env.reset()
+        episode_returns, episode_lens = np.zeros(num_envs), np.zeros(num_envs, dtype=np.int64)
+        action_counts = np.zeros([num_envs, self.num_actions], dtype=np.int64)
+        episodes_left = np.full(num_envs, num_episodes)
+        active = episodes_left > 0
+        actions = np.zeros(num_envs, dtype=np.int64)
+        while active.any():
+            for actor, group in zip(self.actors, groups):
+                group = group[active[group]]
+                if len(group):
+                    actions[group] = self.get_actions(actor, tf.convert_to_tensor(obs[group], dtype=tf.float32),
+                                                      tf.convert_to_tensor(self.one_hot_vecs[group]),
+                                                      deterministic).numpy()
+
+            idxs = np.flatnonzero(active)
+            next_obs, rewards, dones, _, _ = self.vec_env.step(actions[idxs], indices=idxs)
+            obs[idxs] = next_obs
+            episode_returns[idxs] += rewards
+            episode_lens[idxs] += 1
+            action_counts[idxs, actions[idxs]] += 1
+
+            done_idxs = idxs[dones]
+            for i in done_idxs:
+                key_prefix = key_prefixes[i]
+                episode = {f"{key_prefix}/actions/{a}": action_counts[i, a] for a in range(self.num_actions)}
+                episode[key_prefix + "/return"] = episode_returns[i]
+                episode[key_prefix + "/ep_length"] = episode_lens[i]
+                statistics = self.vec_env.env_method("get_statistics", key_prefix, indices=[i])[0]
+                results[key_prefix].append((episode, statistics))
+                episodes_left[i] -= 1
+            episode_returns[done_idxs], episode_lens[done_idxs], action_counts[done_idxs] = 0, 0, 0
+            active = episodes_left > 0
+
+            reset_idxs = done_idxs[active[done_idxs]]
+            if len(reset_idxs):
+                obs[reset_idxs], _ = self.vec_env.reset(indices=reset_idxs)
+        return results
+
+    def _run(self, groups: List[np.ndarray], mode: str, num_episodes: int) -> None:
+        try:
+            self.results = self._evaluate(groups, mode, num_episodes)
+        except Exception as e:
+            # Raise it in the training thread
+            self.error = e
+
+    def start(self, snapshots: List[List[np.ndarray]], deterministic: bool, num_episodes: int,
+              background: bool = False) -> None:
+        """Start the evaluation of the actor snapshots, one for each of the test environments.
+
+        With background, the evaluation runs on a separate thread and its results are retrieved with ``wait``.
+        """
+        assert self.thread is None, "The previous evaluation is still running"
+        mode = "deterministic" if deterministic else "stochastic"
+        groups = self._load_snapshots(snapshots)
+        if background:
+            self.thread = threading.Thread(target=self._run, args=(groups, mode, num_episodes), daemon=True)
+            self.thread.start()
+        else:
+            self._run(groups, mode, num_episodes)
+
+    def wait(self) -> TestResults:
+        """Wait for the evaluation in progress and return its results, if they have not been returned yet."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        results, self.results = self.results, None
+        return results
@@ -1,4 +1,4 @@
-from typing import Callable, Iterable, List, Tuple
+from typing import Callable, Iterable, List, Optional, Tuple
 
 import gymnasium
 import tensorflow as tf
@@ -8,10 +8,16 @@ from tensorflow.keras.layers import Conv2D, Flatten, Dense, Activation, Concaten
 
 
 def mlp(state_shape: Tuple[int], num_tasks: int, hidden_sizes: Iterable[int], activation: Callable,
-        use_layer_norm: bool = False, use_lstm: bool = False, hide_task_id: bool = False) -> Model:
+        use_layer_norm: bool = False, use_lstm: bool = False, hide_task_id: bool = False,
+        encoder_dim: Optional[int] = None) -> Model:
     task_input = Input(shape=num_tasks, name='task_input', dtype=tf.float32)
-    conv_in = Input(shape=state_shape, name='conv_head_in')
-    conv_head = build_conv_head(conv_in, use_lstm)
+    if encoder_dim is None:
+        conv_in = Input(shape=state_shape, name='conv_head_in')
+        conv_head = build_conv_head(conv_in, use_lstm)
+    else:
+        # The observations are already encoded by a shared encoder
+        conv_in = Input(shape=(encoder_dim,), name='features_in')
+        conv_head = conv_in
 
     model = conv_head if hide_task_id else Concatenate()([conv_head, task_input])
     model = Dense(hidden_sizes[0])(model)
@@ -39,6 +45,42 @@ def build_conv_head(conv_head, use_lstm):
     return conv_head
 
 
+class ConvEncoder(Model):
+    """Convolutional head which is shared by the actor and the critics.
+
+    The features of a batch are computed once and consumed by the heads of all the networks, instead of each of them
+    running its own convolutions over the observations.
+    """
+
+    def __init__(self, state_space: gymnasium.spaces.Box, use_lstm: bool = False) -> None:
+        super(ConvEncoder, self).__init__()
+        conv_in = Input(shape=state_space.shape, name='conv_head_in')
+        self.core = Model(inputs=conv_in, outputs=build_conv_head(conv_in, use_lstm))
+        self.output_dim = self.core.output_shape[-1]
+
+    def call(self, obs: tf.Tensor) -> tf.Tensor:
+        return self.core(obs)
+
+
+class _EncodedModel(Model):
+    """Model whose observations may be encoded by a ConvEncoder shared with other models.
+
+    Only the model trained by the loss which updates the encoder tracks it, so that its variables appear once among
+    the trainable variables of the agent. The other models merely call it.
+    """
+
+    def _set_encoder(self, encoder: Optional[ConvEncoder], train_encoder: bool) -> None:
+        self.encoder = encoder if train_encoder else None
+        self._encode = encoder.__call__ if encoder is not None else None
+
+    def encode(self, obs: tf.Tensor) -> tf.Tensor:
+        return obs if self._encode is None else self._encode(obs)
+
+    @property
+    def encoder_variables(self) -> List[tf.Variable]:
+        return self.encoder.trainable_variables if self.encoder is not None else []
+
+
 def _choose_head(out: tf.Tensor, num_heads: int, one_hot_task_id: tf.Tensor) -> tf.Tensor:
     """For multi-head output, choose appropriate head.
 
@@ -57,7 +99,7 @@ def _choose_head(out: tf.Tensor, num_heads: int, one_hot_task_id: tf.Tensor) ->
     return tf.squeeze(out @ tf.expand_dims(one_hot_task_id, 2), axis=2)
 
 
-class MlpActor(Model):
+class MlpActor(_EncodedModel):
     def __init__(
             self,
             state_space: gymnasium.spaces.Box,
@@ -69,23 +111,32 @@ class MlpActor(Model):
             use_lstm: bool = False,
             num_heads: int = 1,
             hide_task_id: bool = False,
+            encoder: Optional[ConvEncoder] = None,
+            train_encoder: bool = False,
     ) -> None:
         super(MlpActor, self).__init__()
         self.num_heads = num_heads
         # if True, one-hot encoding of the task will not be appended to observation.
         self.hide_task_id = hide_task_id
 
-        self.core = mlp(state_space.shape, num_tasks, hidden_sizes, activation, use_layer_norm, use_lstm, hide_task_id)
+        encoder_dim = encoder.output_dim if encoder is not None else None
+        self.core = mlp(state_space.shape, num_tasks, hidden_sizes, activation, use_layer_norm, use_lstm, hide_task_id,
+                        encoder_dim)
         self.head_mu = Sequential(
             [
                 Input(shape=(hidden_sizes[-1],)),
-                Dense(action_space.n * num_heads),
+                # The logits stay in float32 under mixed precision
+                Dense(action_space.n * num_heads, dtype=tf.float32),
             ]
         )
         self.action_space = action_space
+        self._set_encoder(encoder, train_encoder)
 
     def call(self, obs: tf.Tensor, one_hot_task_id: tf.Tensor) -> tf.Tensor:
-        logits = self.core(obs) if self.hide_task_id else self.core([obs, one_hot_task_id])
+        return self.from_features(self.encode(obs), one_hot_task_id)
+
+    def from_features(self, features: tf.Tensor, one_hot_task_id: tf.Tensor) -> tf.Tensor:
+        logits = self.core(features) if self.hide_task_id else self.core([features, one_hot_task_id])
         mu = self.head_mu(logits)
 
         if self.num_heads > 1:
@@ -98,12 +149,12 @@ class MlpActor(Model):
         """Get model parameters which are shared for each task. This excludes head parameters
         in the multi-head setting, as they are separate for each task."""
         if self.num_heads > 1:
-            return self.core.trainable_variables
+            return self.core.trainable_variables + self.encoder_variables
         elif self.num_heads == 1:
-            return self.core.trainable_variables + self.head_mu.trainable_variables
+            return self.core.trainable_variables + self.head_mu.trainable_variables + self.encoder_variables
 
 
-class MlpCritic(Model):
+class MlpCritic(_EncodedModel):
     def __init__(
             self,
             state_space: gymnasium.spaces.Box,
@@ -115,6 +166,8 @@ class MlpCritic(Model):
             use_lstm: bool = False,
             num_heads: int = 1,
             hide_task_id: bool = False,
+            encoder: Optional[ConvEncoder] = None,
+            train_encoder: bool = False,
     ) -> None:
         super(MlpCritic, self).__init__()
         self.hide_task_id = hide_task_id
@@ -122,13 +175,19 @@ class MlpCritic(Model):
             num_heads  # if True, one-hot encoding of the task will not be appended to observation.
         )
 
-        self.core = mlp(state_space.shape, num_tasks, hidden_sizes, activation, use_layer_norm, use_lstm, hide_task_id)
+        encoder_dim = encoder.output_dim if encoder is not None else None
+        self.core = mlp(state_space.shape, num_tasks, hidden_sizes, activation, use_layer_norm, use_lstm, hide_task_id,
+                        encoder_dim)
         self.head = Sequential(
-            [Input(shape=(hidden_sizes[-1],)), Dense(num_heads * action_space.n)]
+            [Input(shape=(hidden_sizes[-1],)), Dense(num_heads * action_space.n, dtype=tf.float32)]
         )
+        self._set_encoder(encoder, train_encoder)
 
     def call(self, obs: tf.Tensor, one_hot_task_id: tf.Tensor) -> tf.Tensor:
-        logits = self.core(obs) if self.hide_task_id else self.core([obs, one_hot_task_id])
+        return self.from_features(self.encode(obs), one_hot_task_id)
+
+    def from_features(self, features: tf.Tensor, one_hot_task_id: tf.Tensor) -> tf.Tensor:
+        logits = self.core(features) if self.hide_task_id else self.core([features, one_hot_task_id])
         value = self.head(logits)
         if self.num_heads > 1:
             value = _choose_head(value, self.num_heads, one_hot_task_id)
@@ -139,6 +198,6 @@ class MlpCritic(Model):
         """Get model parameters which are shared for each task. This excludes head parameters
         in the multi-head setting, as they are separate for each task."""
         if self.num_heads > 1:
-            return self.core.trainable_variables
+            return self.core.trainable_variables + self.encoder_variables
         elif self.num_heads == 1:
-            return self.core.trainable_variables + self.head.trainable_variables
+            return self.core.trainable_variables + self.head.trainable_variables + self.encoder_variables
@@ -0,0 +1,196 @@
+import random
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+import numpy as np
+import tensorflow as tf
+from tensorflow_probability.python.distributions import Categorical
+
+from CL.replay.buffers import BufferType
+from CL.rl.sac import SAC
+from CL.utils.running import create_one_hot_vec
+
+
+class MultiSeedSAC:
+    """Trains the agents of several seeds together, in a single process.
+
+    The agents step their own environments in lockstep, so they reach the task changes, the updates and the ends of
+    the epochs at the same time. The actions of all the agents are selected in a single graph call, and so is each
+    of their gradient steps. The networks of the agents remain independent Keras models, so these graphs hold one
+    branch per agent, which TensorFlow runs concurrently on its inter-op threads. Every agent keeps its own replay
+    buffer, logger and checkpoints.
+
+    Each agent draws from its own random streams, seeded with its seed: the numpy and Python states, which its replay
+    buffer uses, are swapped in around its work, and its actions are sampled with its own TF generator. The seeds are
+    thus independent, and a multi-seed run is reproducible, but a seed does not reproduce the run it would have as a
+    separate process, whose draws are interleaved differently.
+
+    Args:
+      agents: The agents of every seed. They must share the training schedule, and differ by their seed,
+        environments, logger and timestamp.
+    """
+
+    def __init__(self, agents: List[SAC]) -> None:
+        lead = agents[0]
+        for agent in agents[1:]:
+            for attr in ("steps", "steps_per_env", "start_steps", "update_after", "update_every", "n_updates",
+                         "log_every", "agent_policy_exploration", "model_path"):
+                if getattr(agent, attr) != getattr(lead, attr):
+                    raise ValueError(f"All the seeds must share the same {attr}")
+        for agent in agents:
+            if agent.vec_env is not None or agent.exploration_kind is not None or agent.test_only:
+                raise ValueError("Vectorized environments, exploration kinds and test_only are not supported "
+                                 "with several seeds")
+            if agent.fused_updates > 1 or agent.prefetch_batches > 0 or agent.jit_compile:
+                raise ValueError("Fused updates, prefetched batches and XLA compilation are not supported with "
+                                 "several seeds")
+        self.agents = agents
+        self.learn_on_batches = None
+        self.np_states = [np.random.RandomState(agent.seed).get_state() for agent in agents]
+        self.python_states = [random.Random(agent.seed).getstate() for agent in agents]
+        self.generators = [tf.random.Generator.from_seed(agent.seed) for agent in agents]
+        for agent in agents:
+            agent.logger.log("The seeds are trained together in one process with independent random streams, so "
+                             "the results of a seed do not reproduce a separate run with the same seed", color='yellow')
+
+    @contextmanager
+    def random_state(self, agent_idx: int) -> Iterator[None]:
+        """Make the global numpy and Python random states those of an agent, and save them back afterwards."""
+        np.random.set_state(self.np_states[agent_idx])
+        random.setstate(self.python_states[agent_idx])
+        try:
+            yield
+        finally:
+            self.np_states[agent_idx] = np.random.get_state()
+            self.python_states[agent_idx] = random.getstate()
+
+    @tf.function
+    def get_actions(self, obs: tf.Tensor, one_hot_task_ids: tf.Tensor) -> tf.Tensor:
+        """Sample the action of every agent from its own actor, given the observations stacked along the seeds."""
+        actions = []
+        for i, (agent, generator) in enumerate(zip(self.agents, self.generators)):
+            logits = agent.actor(obs[i:i + 1], one_hot_task_ids[i:i + 1])
+            actions.append(Categorical(logits=logits).sample(seed=generator.uniform_full_int([2], tf.int32)))
+        return tf.concat(actions, axis=0)
+
+    def get_learn_on_batches(self, current_task_idx: int) -> Callable:
+        @tf.function
+        def learn_on_batches(
+                seq_idx: tf.Tensor,
+                batches: List[Dict[str, tf.Tensor]],
+                episodic_batches: List[Dict[str, tf.Tensor]],
+        ) -> List[Dict]:
+            """Perform a gradient step of every agent on its own batch."""
+            return [
+                agent._learn_step(current_task_idx, seq_idx, batch, episodic_batch)
+                for agent, batch, episodic_batch in zip(self.agents, batches, episodic_batches)
+            ]
+
+        return learn_on_batches
+
+    def _update(self, current_task_idx: int) -> None:
+        time_update_start = time.time()
+        for _ in range(self.agents[0].n_updates):
+            batches, episodic_batches = [], []
+            for i, agent in enumerate(self.agents):
+                with self.random_state(i):
+                    batches.append(agent.replay_buffer.sample_batch(agent.batch_size))
+                    episodic_batches.append(agent.get_episodic_batch(current_task_idx))
+            all_results = self.learn_on_batches(tf.convert_to_tensor(current_task_idx), batches, episodic_batches)
+
+            for agent, batch, results in zip(self.agents, batches, all_results):
+                # Update priority in the tree
+                if agent.buffer_type == BufferType.PER or agent.buffer_type == BufferType.PRIORITY:
+                    agent.replay_buffer.update_weights(batch['idxs'].numpy(), results['abs_error'].numpy())
+                agent._log_after_update(results)
+
+        for agent in self.agents:
+            agent.logger.log(f"Time elapsed for a policy update: {time.time() - time_update_start}")
+
+    def run(self) -> None:
+        """Same as the main loop of SAC.run, for all the agents at once."""
+        agents, lead = self.agents, self.agents[0]
+        num_agents = len(agents)
+        for agent in agents:
+            agent.start_time = time.time()
+
+        obs = np.stack([agent.env.reset()[0] for agent in agents])
+        infos = [{} for _ in agents]
+        episodes = np.zeros(num_agents, dtype=np.int64)
+        episode_returns, episode_lens = np.zeros(num_agents), np.zeros(num_agents, dtype=np.int64)
+
+        current_task_timestep = 0
+        current_task_idx = -1
+        episode_starts = np.full(num_agents, time.time())
+
+        num_actions = lead.env.action_space.n
+        action_counts = [{i: 0 for i in range(num_actions)} for _ in agents]
+
+        for global_timestep in range(lead.steps):
+            # On task change. The environments have the same schedule, so they change task together.
+            if current_task_idx != getattr(lead.env, "cur_seq_idx", -1):
+                current_task_timestep = 0
+                current_task_idx = getattr(lead.env, "cur_seq_idx")
+                for i, agent in enumerate(agents):
+                    with self.random_state(i):
+                        agent._handle_task_change(current_task_idx)
+                self.learn_on_batches = self.get_learn_on_batches(current_task_idx)
+                one_hot_vecs = np.stack([create_one_hot_vec(agent.env.num_tasks, agent.env.task_id)
+                                         for agent in agents])
+
+            if current_task_timestep > lead.start_steps or (
+                    lead.agent_policy_exploration and current_task_idx > 0) or lead.model_path:
+                actions = self.get_actions(tf.convert_to_tensor(obs, dtype=tf.dtypes.float32),
+                                           tf.convert_to_tensor(one_hot_vecs, dtype=tf.dtypes.float32)).numpy()
+            else:
+                # Just pure random exploration.
+                actions = np.array([agent.env.action_space.sample() for agent in agents])
+
+            for i, agent in enumerate(agents):
+                # Environment step
+                next_obs, reward, done, _, infos[i] = agent.env.step(actions[i])
+                episode_returns[i] += reward
+                episode_lens[i] += 1
+                action_counts[i][actions[i]] += 1
+
+                # Consider also whether episode was truncated
+                done_to_store = False if episode_lens[i] == agent.max_episode_len else done
+
+                # Store experience to replay buffer
+                with self.random_state(i):
+                    agent.replay_buffer.store(obs[i], actions[i], reward, next_obs, done_to_store, one_hot_vecs[i])
+
+                # Update the most recent observation
+                obs[i] = next_obs
+
+                # End of trajectory handling
+                if done:
+                    episodes[i] += 1
+                    agent._log_episode(episodes[i], episode_starts[i], episode_returns[i], episode_lens[i],
+                                       agent.env.get_statistics('train'))
+                    agent.env.clear_episode_statistics()
+                    episode_returns[i], episode_lens[i] = 0, 0
+                    episode_starts[i] = time.time()
+                    if global_timestep < lead.steps - 1:
+                        obs[i], infos[i] = agent.env.reset()
+
+            # Update handling
+            if current_task_timestep >= lead.update_after and current_task_timestep % lead.update_every == 0:
+                self._update(current_task_idx)
+
+            if lead.env.name == "ContinualLearningEnv" and current_task_timestep + 1 == lead.env.steps_per_env:
+                episodes[:] = 0
+                for i, agent in enumerate(agents):
+                    with self.random_state(i):
+                        agent.on_task_end(current_task_idx)
+
+            # End of epoch wrap-up
+            if ((global_timestep + 1) % lead.log_every == 0) or (global_timestep + 1 == lead.steps):
+                for i, agent in enumerate(agents):
+                    with self.random_state(i):
+                        agent._end_epoch(current_task_idx, current_task_timestep, global_timestep, infos[i],
+                                         action_counts[i])
+                episode_starts[:] = time.time()
+
+            current_task_timestep += 1
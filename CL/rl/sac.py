@@ -1,25 +1,37 @@
+import itertools
 import math
 import os
 import time
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Tuple, Union
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.optimizers.legacy import Adam
 from tensorflow.keras.optimizers.schedules import ExponentialDecay, PolynomialDecay, LearningRateSchedule
 from tensorflow.python.framework import dtypes
+from tensorflow.python.util import nest
 from tensorflow_probability.python.distributions import Categorical
 
 from CL.replay.buffers import ReplayBuffer, ReservoirReplayBuffer, PrioritizedReplayBuffer, BufferType, \
-    PrioritizedExperienceReplay
+    PrioritizedExperienceReplay, CompactReplayBuffer, FrameReplayBuffer, SharedReplayBuffer, DiskReplayBuffer
+from CL.replay.prefetch import BatchPrefetcher
 from CL.rl import models
+from CL.rl.evaluation import ParallelEvaluator, TestResults
 from CL.rl.exploration import ExplorationHelper
 from CL.utils.logging import EpochLogger
-from CL.utils.running import reset_optimizer, reset_weights, set_seed, create_one_hot_vec
+from CL.utils.running import reset_optimizer, reset_weights, set_seed, create_one_hot_vec, get_peak_rss_mb, \
+    dtype_policy
+from CL.utils.vec_env import SubprocVecEnv, close_task_env
 from MHAIA.env.base import BaseEnv
 
 
+def split_next(outputs: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+    """Split the outputs of a forward pass over concatenated observations and next observations."""
+    outputs, outputs_next = tf.split(outputs, 2, axis=0)
+    return outputs, tf.stop_gradient(outputs_next)
+
+
 class SAC:
     def __init__(
             self,
@@ -50,10 +62,14 @@ class SAC:
             update_after: int = 1e4,
             update_every: int = 1000,
             n_updates: int = 50,
+            prefetch_batches: int = 0,
+            fused_updates: int = 1,
             num_test_eps: int = 3,
             save_freq_epochs: int = 25,
             reset_buffer_on_task_change: bool = True,
             buffer_type: BufferType = BufferType.FIFO,
+            frame_stack: int = 4,
+            buffer_dir: Optional[str] = None,
             reset_optimizer_on_task_change: bool = False,
             reset_actor_on_task_change: bool = False,
             reset_critic_on_task_change: bool = False,
@@ -64,6 +80,14 @@ class SAC:
             model_path: str = None,
             timestamp: str = None,
             exploration_kind: str = None,
+            vec_env: SubprocVecEnv = None,
+            test_vec_env: SubprocVecEnv = None,
+            async_test: bool = False,
+            shared_encoder: bool = False,
+            encoder_gradients: str = "critic",
+            concat_next_obs: bool = False,
+            mixed_precision: bool = False,
+            jit_compile: bool = False,
     ):
         """A class for SAC training, for single task or continual learning
         After the instance is created, use run() function to actually run the training.
@@ -97,12 +121,23 @@ class SAC:
             descent updates.  Ensures replay buffer is full enough for useful updates.
           update_every: Number of env interactions that should elapse between gradient descent updates.
           n_updates: Number of consecutive policy gradient descent updates to perform.
+          prefetch_batches: Number of batches to sample ahead on a background thread during the updates.
+            If 0, the batches are sampled synchronously before every gradient step.
+          fused_updates: Number of consecutive updates performed in a single graph call. The batches are sampled
+            in advance and stacked, so the memory needed for the batches grows linearly with this value.
+            Priorities of a prioritized buffer are only updated after each fused call.
           num_test_eps: Number of episodes to test the stochastic policy in each evaluation.
           save_freq_epochs: How often, in epochs, to save the current policy and value function.
             (Epoch is defined as time between two subsequent evaluations, lasting log_every steps)
           reset_buffer_on_task_change: If True, replay buffer will be cleared after every task
             change (in continual learning).
           buffer_type: Type of the replay buffer. Either 'fifo' for regular FIFO buffer or 'reservoir' for reservoir sampling.
+            'compact' is a FIFO buffer which stores the observations as uint8 frames without duplicating next_obs.
+            'frame' is a FIFO buffer which stores every single frame of the stacked observations only once.
+            'shared' is a FIFO buffer in shared memory which several processes can store transitions into.
+          frame_stack: Number of frames stacked in every observation. Used by the 'frame' buffer type.
+          buffer_dir: Directory where the 'reservoir' buffer keeps its observations in memory-mapped files.
+            If None, they are kept in RAM.
           reset_optimizer_on_task_change: If True, optimizer will be reset after every task change (in continual learning).
           reset_actor_on_task_change: If True, actor weights are randomly re-initialized after each task change.
           reset_critic_on_task_change: If True, critic weights are randomly re-initialized after each task change.
@@ -113,8 +148,30 @@ class SAC:
             in the first task (in continual learning). Otherwise, it is used in every task.
           exploration_kind: Kind of exploration to use at the beginning of a new task.
           upload_weights: Whether to send weight to neptune after each task.
+          vec_env: Copies of env stepped in parallel subprocesses to collect the experience. The copies change task
+            together, so each of them must run steps_per_env / vec_env.num_envs steps per task. env is then only
+            used for the bookkeeping of the current task and for the tasks' metadata.
+          test_vec_env: Copies of test_envs, in the same order, stepped in parallel subprocesses. If given, the
+            evaluation runs on all of them at once with batched inference.
+          async_test: Whether the parallel evaluation runs in the background while the training continues. Its
+            results are logged at the following epoch.
+          shared_encoder: Whether the actor and the critics share a single convolutional encoder, so that the
+            observations of a batch are encoded once instead of once per network. The target critics share a target
+            copy of it, updated with the same polyak averaging.
+          encoder_gradients: Loss which trains the shared encoder, either 'critic' or 'actor'. The gradients of the
+            other loss do not flow into the encoder.
+          concat_next_obs: Whether the observations and the next observations go through the actor (or the shared
+            encoder) in a single forward pass over the concatenated batch. The larger batch uses more cores per
+            kernel, but the backward pass also runs over it, so it only pays off when the cores are otherwise idle.
+          mixed_precision: Whether the networks compute in bfloat16 while keeping float32 weights. The outputs of the
+            networks, and hence all the losses and gradients, stay in float32. bfloat16 has the exponent range of
+            float32, so the losses need no scaling.
+          jit_compile: Whether the update steps are compiled with XLA. Every variant of the update function, given by
+            the task, the configuration of the method and the structure of the batches, is traced once with a fixed
+            input signature and cached, so it is not retraced when a task is revisited or the batches change.
         """
         set_seed(seed, env=env)
+        self.seed = seed
 
         if policy_kwargs is None:
             policy_kwargs = {}
@@ -142,10 +199,14 @@ class SAC:
         self.update_after = update_after
         self.update_every = update_every
         self.n_updates = n_updates
+        self.prefetch_batches = prefetch_batches
+        self.fused_updates = fused_updates
         self.num_test_eps = num_test_eps
         self.save_freq_epochs = save_freq_epochs
         self.reset_buffer_on_task_change = reset_buffer_on_task_change
         self.buffer_type = buffer_type
+        self.frame_stack = frame_stack
+        self.buffer_dir = buffer_dir
         self.reset_optimizer_on_task_change = reset_optimizer_on_task_change
         self.reset_actor_on_task_change = reset_actor_on_task_change
         self.reset_critic_on_task_change = reset_critic_on_task_change
@@ -155,6 +216,13 @@ class SAC:
         self.model_path = model_path
         self.timestamp = timestamp
         self.test_threads = []
+        self.vec_env = vec_env
+        if vec_env is not None:
+            if steps_per_env % vec_env.num_envs != 0:
+                raise ValueError(f"steps_per_env ({steps_per_env}) must be a multiple of the number of "
+                                 f"environments ({vec_env.num_envs})")
+            if exploration_kind is not None:
+                raise ValueError("Exploration kinds are not supported with vectorized environments")
         self.obs_shape = env.observation_space.shape
         self.act_dim = env.action_space.n
         # Mario doesn't have episode timeout like DOOM, use a reasonable default
@@ -169,10 +237,16 @@ class SAC:
         policy_kwargs["num_tasks"] = env.num_tasks
 
         # Create experience buffer
+        if buffer_dir is not None and buffer_type != BufferType.RESERVOIR:
+            raise ValueError("Only the 'reservoir' buffer can keep its observations on disk")
         if buffer_type == BufferType.FIFO:
             self.replay_buffer = ReplayBuffer(
                 obs_shape=self.obs_shape, size=replay_size, num_tasks=self.num_tasks
             )
+        elif buffer_type == BufferType.RESERVOIR and buffer_dir is not None:
+            self.replay_buffer = DiskReplayBuffer(
+                obs_shape=self.obs_shape, size=replay_size, num_tasks=self.num_tasks, directory=buffer_dir
+            )
         elif buffer_type == BufferType.RESERVOIR:
             self.replay_buffer = ReservoirReplayBuffer(
                 obs_shape=self.obs_shape, size=replay_size, num_tasks=self.num_tasks
@@ -184,28 +258,75 @@ class SAC:
         elif buffer_type == BufferType.PER:
             self.replay_buffer = PrioritizedExperienceReplay(
                 obs_shape=self.obs_shape, size=self.replay_size, num_tasks=self.num_tasks)
+        elif buffer_type == BufferType.COMPACT:
+            self.replay_buffer = CompactReplayBuffer(
+                obs_shape=self.obs_shape, size=replay_size, num_tasks=self.num_tasks
+            )
+        elif buffer_type == BufferType.FRAME:
+            self.replay_buffer = FrameReplayBuffer(
+                obs_shape=self.obs_shape, size=replay_size, num_tasks=self.num_tasks, frame_stack=frame_stack
+            )
+        elif buffer_type == BufferType.SHARED:
+            self.replay_buffer = SharedReplayBuffer(
+                obs_shape=self.obs_shape, size=replay_size, num_tasks=self.num_tasks
+            )
         else:
             raise ValueError(f"Unknown buffer type: {buffer_type}")
+        logger.log(f"Replay buffer: {self.replay_buffer.nbytes / 2**20:.1f} MB, "
+                   f"{self.replay_buffer.bytes_per_transition:.0f} bytes per transition", color='blue')
 
         # Exploration
         self.exploration_kind = exploration_kind
         self.exploration_helper = None
         self.exploration_actor = None
 
-        # Create actor and critic networks
-        self.actor = actor_cl(**policy_kwargs)
+        # The networks of the agent and all their copies are built with this dtype policy
+        self.mixed_precision = mixed_precision
+        self.dtype_policy = "mixed_bfloat16" if mixed_precision else "float32"
+
+        # Shared encoder
+        self.encoder = None
+        self.target_encoder = None
+        if shared_encoder:
+            if not issubclass(actor_cl, models.MlpActor) or not issubclass(critic_cl, models.MlpCritic):
+                raise ValueError("The shared encoder is only supported by the MLP actor and critic")
+            if encoder_gradients not in ("critic", "actor"):
+                raise ValueError(f"Unknown encoder gradients: {encoder_gradients}")
+        self.actor_owns_encoder = shared_encoder and encoder_gradients == "actor"
+        self.critic_owns_encoder = shared_encoder and encoder_gradients == "critic"
+        self.concat_next_obs = concat_next_obs
+        self.jit_compile = jit_compile
+        self.learn_fns: Dict[Tuple, Callable] = {}
+        self.num_traces = 0
 
-        self.critic1 = critic_cl(**policy_kwargs)
-        self.target_critic1 = critic_cl(**policy_kwargs)
-        self.target_critic1.set_weights(self.critic1.get_weights())
+        # Create actor and critic networks
+        self.actor_cl = actor_cl
+        with dtype_policy(self.dtype_policy):
+            if shared_encoder:
+                self.encoder = self._new_encoder()
+                self.target_encoder = self._new_encoder()
+                self.target_encoder.set_weights(self.encoder.get_weights())
+
+            self.actor_kwargs = self._model_kwargs(self.actor_owns_encoder)
+            self.actor = actor_cl(**self.actor_kwargs)
+
+            self.critic1 = critic_cl(**self._model_kwargs(self.critic_owns_encoder))
+            self.target_critic1 = critic_cl(**self._model_kwargs(self.critic_owns_encoder, target=True))
+            self.target_critic1.set_weights(self.critic1.get_weights())
 
-        self.critic2 = critic_cl(**policy_kwargs)
-        self.target_critic2 = critic_cl(**policy_kwargs)
-        self.target_critic2.set_weights(self.critic2.get_weights())
+            self.critic2 = critic_cl(**self._model_kwargs(False))
+            self.target_critic2 = critic_cl(**self._model_kwargs(False, target=True))
+            self.target_critic2.set_weights(self.critic2.get_weights())
 
         if model_path is not None:
             self.load_model(model_path)
 
+        # Parallel evaluation
+        self.async_test = async_test
+        self.test_evaluator = None
+        if test_vec_env is not None:
+            self.test_evaluator = ParallelEvaluator(test_vec_env, self._new_actor)
+
         self.critic_variables = self.critic1.trainable_variables + self.critic2.trainable_variables
         self.all_common_variables = (
                 self.actor.common_variables
@@ -249,6 +370,40 @@ class SAC:
                         np.prod(env.action_space.n).astype(np.float32) * target_1d_entropy
                 )
 
+    def _new_encoder(self) -> models.ConvEncoder:
+        return models.ConvEncoder(self.policy_kwargs["state_space"], self.policy_kwargs.get("use_lstm", False))
+
+    def _new_actor(self) -> tf.keras.Model:
+        """Standalone copy of the actor, with its own encoder if the agent shares one."""
+        with dtype_policy(self.dtype_policy):
+            return self.actor_cl(**self._model_kwargs(True, new_encoder=True))
+
+    def _model_kwargs(self, train_encoder: bool, target: bool = False, new_encoder: bool = False) -> Dict:
+        """Kwargs of a network which uses the shared encoder, the target one or a new one, if it is enabled."""
+        if self.encoder is None:
+            return self.policy_kwargs
+        if new_encoder:
+            encoder = self._new_encoder()
+        else:
+            encoder = self.target_encoder if target else self.encoder
+        return {**self.policy_kwargs, "encoder": encoder, "train_encoder": train_encoder}
+
+    def _actor_variables(self) -> List[tf.Variable]:
+        """Variables of the actor, including those of the shared encoder even when the actor does not own it."""
+        if self.encoder is None or self.actor_owns_encoder:
+            return self.actor.weights
+        return self.actor.weights + self.encoder.weights
+
+    def _actor_weights(self) -> List[np.ndarray]:
+        return [v.numpy() for v in self._actor_variables()]
+
+    def _test_weights(self, seq_idx: int) -> List[np.ndarray]:
+        """Weights of the actor with which the test environment of a given task is evaluated."""
+        self.on_test_start(seq_idx)
+        weights = self._actor_weights()
+        self.on_test_end(seq_idx)
+        return weights
+
     def adjust_gradients(
             self,
             actor_gradients: List[tf.Tensor],
@@ -276,6 +431,8 @@ class SAC:
     def on_task_end(self, current_task_idx: int) -> None:
         self.logger.log(f'Task {current_task_idx} finished', color='white')
         self.env.envs[current_task_idx].close()
+        if self.vec_env is not None:
+            self.vec_env.apply(close_task_env, current_task_idx)
 
     def get_episodic_batch(self, current_task_idx: int) -> Optional[Dict[str, tf.Tensor]]:
         return None
@@ -291,6 +448,14 @@ class SAC:
         dist = Categorical(logits=logits)
         return tf.math.argmax(logits, axis=-1, output_type=dtypes.int32) if deterministic else dist.sample()
 
+    @tf.function
+    def get_actions(self, obs: tf.Tensor, one_hot_task_id: tf.Tensor,
+                    deterministic: tf.Tensor = tf.constant(False)) -> tf.Tensor:
+        """Batched version of get_action, for observations of several environments."""
+        logits = self.actor(obs, one_hot_task_id)
+        dist = Categorical(logits=logits)
+        return tf.math.argmax(logits, axis=-1, output_type=dtypes.int32) if deterministic else dist.sample()
+
     @tf.function
     def get_exploration_action(self, obs: tf.Tensor, one_hot_task_id: tf.Tensor,
                                deterministic: tf.Tensor = tf.constant(False)) -> tf.Tensor:
@@ -303,34 +468,116 @@ class SAC:
     ) -> tf.Tensor:
         return self.get_action(obs, one_hot_task_id, deterministic).numpy()[0]
 
+    def get_learn_fn_config(self, current_task_idx: int) -> Tuple:
+        """Python state which the graph of the update depends on, besides the structure of the batches.
+
+        The variables of the networks are part of it, as e.g. VCL stops training some layers after the first task.
+        Methods whose update depends on other Python state must extend it.
+        """
+        return current_task_idx, len(self.actor.trainable_variables), len(self.critic_variables)
+
+    def _compile_learn_fn(self, fn: Callable, current_task_idx: int) -> Callable:
+        """Wrap an update function in a tf.function, counting its traces.
+
+        With jit_compile, the update is compiled with XLA and its variants are cached across task changes. The
+        batch dimension is left out of the input signature, so only a change of the batch size triggers an XLA
+        recompilation, never a retracing.
+        """
+        def traced_fn(*args) -> Dict:
+            self.num_traces += 1
+            return fn(*args)
+
+        if not self.jit_compile:
+            return tf.function(traced_fn)
+
+        def dispatch(seq_idx: tf.Tensor, batch: Dict[str, tf.Tensor],
+                     episodic_batch: Optional[Dict[str, tf.Tensor]] = None) -> Dict:
+            # The episodic batch is left out rather than passed as None, as a signature only holds tensors
+            args = (seq_idx, batch) if episodic_batch is None else (seq_idx, batch, episodic_batch)
+            args = tf.nest.map_structure(tf.convert_to_tensor, args)
+            signature = tf.nest.map_structure(lambda x: tf.TensorSpec([None, *x.shape[1:]] if x.shape.rank else [],
+                                                                      x.dtype), args)
+            key = (fn.__name__, self.get_learn_fn_config(current_task_idx),
+                   tuple(nest.flatten_with_joined_string_paths(signature)))
+            if key not in self.learn_fns:
+                self.learn_fns[key] = tf.function(traced_fn, input_signature=signature, jit_compile=True)
+            return self.learn_fns[key](*args)
+
+        return dispatch
+
     def get_learn_on_batch(self, current_task_idx: int) -> Callable:
-        @tf.function
         def learn_on_batch(
                 seq_idx: tf.Tensor,
                 batch: Dict[str, tf.Tensor],
                 episodic_batch: Dict[str, tf.Tensor] = None,
         ) -> Dict:
-            gradients, metrics = self.get_gradients(seq_idx, **batch)
-            # Warning: we refer here to the int task_idx in the parent function, not the passed seq_idx.
-            gradients = self.adjust_gradients(
-                *gradients,
-                current_task_idx=current_task_idx,
-                metrics=metrics,
-                episodic_batch=episodic_batch,
-            )
+            return self._learn_step(current_task_idx, seq_idx, batch, episodic_batch)
 
-            if self.clipnorm is not None:
-                actor_gradients, critic_gradients, alpha_gradient = gradients
-                gradients = (
-                    tf.clip_by_global_norm(actor_gradients, self.clipnorm)[0],
-                    tf.clip_by_global_norm(critic_gradients, self.clipnorm)[0],
-                    tf.clip_by_norm(alpha_gradient, self.clipnorm),
-                )
+        return self._compile_learn_fn(learn_on_batch, current_task_idx)
 
-            self.apply_update(*gradients)
-            return metrics
+    def get_learn_on_batches(self, current_task_idx: int) -> Callable:
+        def learn_on_batches(
+                seq_idx: tf.Tensor,
+                batches: Dict[str, tf.Tensor],
+                episodic_batches: Dict[str, tf.Tensor] = None,
+        ) -> Dict:
+            """Perform a gradient step for each of the batches stacked along the first axis in a single graph call.
+
+            Scalar metrics are averaged over the steps, per-example metrics are concatenated.
+            """
+            num_batches = tf.shape(batches["obs"])[0]
+
+            def get_batches(i: tf.Tensor) -> Tuple[Dict[str, tf.Tensor], Optional[Dict[str, tf.Tensor]]]:
+                batch = tf.nest.map_structure(lambda x: x[i], batches)
+                episodic_batch = None
+                if episodic_batches is not None:
+                    episodic_batch = tf.nest.map_structure(lambda x: x[i], episodic_batches)
+                return batch, episodic_batch
+
+            # The first step is taken outside the loop, so that the optimizer slots are created
+            # before entering it and the structure of the metrics is known.
+            metrics = self._learn_step(current_task_idx, seq_idx, *get_batches(0))
+            metrics = {k: tf.cast(v, tf.float32) for k, v in metrics.items()}
+            all_metrics = {k: tf.TensorArray(tf.float32, size=num_batches).write(0, v) for k, v in metrics.items()}
+
+            def body(i: tf.Tensor, all_metrics: Dict[str, tf.TensorArray]) -> Tuple:
+                metrics = self._learn_step(current_task_idx, seq_idx, *get_batches(i))
+                return i + 1, {k: v.write(i, tf.cast(metrics[k], tf.float32)) for k, v in all_metrics.items()}
+
+            _, all_metrics = tf.while_loop(lambda i, _: i < num_batches, body, (tf.constant(1), all_metrics))
+            return {
+                k: tf.reduce_mean(v.stack(), 0) if metrics[k].shape.rank == 0 else tf.reshape(v.stack(), [-1])
+                for k, v in all_metrics.items()
+            }
+
+        return self._compile_learn_fn(learn_on_batches, current_task_idx)
+
+    def _learn_step(
+            self,
+            current_task_idx: int,
+            seq_idx: tf.Tensor,
+            batch: Dict[str, tf.Tensor],
+            episodic_batch: Dict[str, tf.Tensor] = None,
+    ) -> Dict:
+        gradients, metrics = self.get_gradients(seq_idx, **batch)
+        # Warning: we refer here to the int task_idx in the parent function, not the passed seq_idx.
+        gradients = self.adjust_gradients(
+            *gradients,
+            current_task_idx=current_task_idx,
+            metrics=metrics,
+            episodic_batch=episodic_batch,
+        )
+
+        if self.clipnorm is not None:
+            actor_gradients, critic_gradients, alpha_gradient = gradients
+            gradients = (
+                tf.clip_by_global_norm(actor_gradients, self.clipnorm)[0],
+                tf.clip_by_global_norm(critic_gradients, self.clipnorm)[0],
+                tf.clip_by_norm(alpha_gradient, self.clipnorm),
+            )
 
-        return learn_on_batch
+        self.apply_update(*gradients)
+        return metrics
 
     def get_gradients(
             self,
@@ -350,25 +597,47 @@ class SAC:
                 log_alpha = tf.math.log(self.alpha)
             log_alpha_exp = tf.math.exp(log_alpha)
 
-            logits = self.actor(obs, one_hot)
+            if self.concat_next_obs:
+                # A single forward pass over the observations and the next observations. The next half only feeds
+                # the target, so no gradient flows through it.
+                both_obs = tf.concat([obs, next_obs], axis=0)
+                both_one_hot = tf.concat([one_hot, one_hot], axis=0)
+            if self.encoder is not None:
+                # Encode the observations once for the actor and both critics
+                if self.concat_next_obs:
+                    both_features = self.encoder(both_obs)
+                    features, _ = split_next(both_features)
+                    logits, logits_next = split_next(self.actor.from_features(both_features, both_one_hot))
+                else:
+                    features = self.encoder(obs)
+                    logits = self.actor.from_features(features, one_hot)
+                    logits_next = self.actor.from_features(self.encoder(next_obs), one_hot)
+                target_features_next = self.target_encoder(next_obs)
+                q1 = self.critic1.from_features(features, one_hot)
+                q2 = self.critic2.from_features(features, one_hot)
+                target_q1 = self.target_critic1.from_features(target_features_next, one_hot)
+                target_q2 = self.target_critic2.from_features(target_features_next, one_hot)
+            else:
+                if self.concat_next_obs:
+                    logits, logits_next = split_next(self.actor(both_obs, both_one_hot))
+                else:
+                    logits = self.actor(obs, one_hot)
+                    logits_next = self.actor(next_obs, one_hot)
+                q1 = self.critic1(obs, one_hot)
+                q2 = self.critic2(obs, one_hot)
+                target_q1 = self.target_critic1(next_obs, one_hot)
+                target_q2 = self.target_critic2(next_obs, one_hot)
+
             dist = Categorical(logits=logits)
             entropy = dist.entropy()
 
-            logits_next = self.actor(next_obs, one_hot)
             dist_next = Categorical(logits=logits_next)
             entropy_next = dist_next.entropy()
 
-            q1 = self.critic1(obs, one_hot)
-            q2 = self.critic2(obs, one_hot)
-
             # Q values of actions taken
             q1_vals = tf.gather(q1, actions, axis=1, batch_dims=1)
             q2_vals = tf.gather(q2, actions, axis=1, batch_dims=1)
 
-            # Target Q values
-            target_q1 = self.target_critic1(next_obs, one_hot)
-            target_q2 = self.target_critic2(next_obs, one_hot)
-
             # Min Double-Q:
             min_q = dist.probs_parameter() * tf.stop_gradient(tf.minimum(q1, q2))
             min_target_q = dist_next.probs_parameter() * tf.minimum(target_q1, target_q2)
@@ -437,23 +706,36 @@ class SAC:
             self.optimizer.apply_gradients([(alpha_gradient, self.all_log_alpha)])
 
         # Polyak averaging for target variables
-        for v, target_v in zip(
-                self.critic1.trainable_variables, self.target_critic1.trainable_variables
-        ):
-            target_v.assign(self.polyak * target_v + (1 - self.polyak) * v)
-        for v, target_v in zip(
-                self.critic2.trainable_variables, self.target_critic2.trainable_variables
-        ):
+        variables = self.critic1.trainable_variables + self.critic2.trainable_variables
+        target_variables = self.target_critic1.trainable_variables + self.target_critic2.trainable_variables
+        if self.actor_owns_encoder:
+            variables += self.encoder.trainable_variables
+            target_variables += self.target_encoder.trainable_variables
+        self.update_targets(variables, target_variables)
+
+    @tf.function(jit_compile=True)
+    def update_targets(self, variables: List[tf.Variable], target_variables: List[tf.Variable]) -> None:
+        """Soft update of the target variables of both critics.
+
+        XLA fuses the multiply-adds and assignments of all the variables into a few kernels, instead of issuing
+        separate ops for every variable.
+        """
+        for v, target_v in zip(variables, target_variables):
             target_v.assign(self.polyak * target_v + (1 - self.polyak) * v)
 
     def test_agent(self, deterministic: bool, num_episodes: int) -> None:
+        if self.test_evaluator is not None:
+            self._test_in_parallel(deterministic, num_episodes, background=False)
+            return
+
         mode = "deterministic" if deterministic else "stochastic"
         num_actions = self.test_envs[0].action_space.n
-        total_action_counts = {i: 0 for i in range(num_actions)}
+        results = {}
         for seq_idx, test_env in enumerate(self.test_envs):
             start_time = time.time()
             key_prefix = f"test/{mode}/{seq_idx}/{test_env.name}"
             one_hot_vec = create_one_hot_vec(test_env.num_tasks, test_env.task_id)
+            results[key_prefix] = []
 
             self.on_test_start(seq_idx)
 
@@ -477,20 +759,61 @@ class SAC:
                     action_counts[action] += 1
                 # Log the number of times each action was selected
                 actions_dict = {f"{key_prefix}/actions/{i}": action_counts[i] for i in range(num_actions)}
-                self.logger.store({
+                episode = {
                     **actions_dict,
                     key_prefix + "/return": episode_return,
                     key_prefix + "/ep_length": episode_len,
-                })
-                self.logger.store(test_env.get_statistics(key_prefix))
-                total_action_counts = {i: total_action_counts[i] + action_counts[i] for i in range(num_actions)}
+                }
+                results[key_prefix].append((episode, test_env.get_statistics(key_prefix)))
 
             self.on_test_end(seq_idx)
             self.logger.log(f"Finished testing {key_prefix} in {time.time() - start_time:.2f} seconds", color='yellow')
 
+        self._log_test_results(results)
+
+    def _test_in_parallel(self, deterministic: bool, num_episodes: int, background: bool) -> None:
+        """Evaluate the agent on all the test environments at once with the parallel evaluator.
+
+        The results of a previous evaluation which ran in the background are logged together with those of this one,
+        or on their own if this one starts in the background as well.
+        """
+        results = self.test_evaluator.wait() or {}
+
+        # Each test environment is evaluated with the weights the agent would use for it
+        snapshots = [self._test_weights(seq_idx) for seq_idx in range(len(self.test_envs))]
+
+        self.test_evaluator.start(snapshots, deterministic, num_episodes, background)
+        if not background:
+            for key_prefix, episodes in self.test_evaluator.wait().items():
+                results.setdefault(key_prefix, []).extend(episodes)
+        elif not results:
+            # The progress file takes its header from its first row, so an epoch without results yet logs a
+            # placeholder episode for each test environment, which gives the test columns missing values
+            mode = "deterministic" if deterministic else "stochastic"
+            num_actions = self.test_envs[0].action_space.n
+            for seq_idx, test_env in enumerate(self.test_envs):
+                key_prefix = f"test/{mode}/{seq_idx}/{test_env.name}"
+                episode = {f"{key_prefix}/{key}": np.nan for key in ("return", "ep_length")}
+                episode.update({f"{key_prefix}/actions/{i}": np.nan for i in range(num_actions)})
+                results[key_prefix] = [(episode, dict.fromkeys(test_env.get_statistics(key_prefix), np.nan))]
+        if results:
+            self._log_test_results(results)
+
+    def _log_test_results(self, results: TestResults) -> None:
+        num_actions = self.test_envs[0].action_space.n
+        total_action_counts = {i: 0 for i in range(num_actions)}
+        for key_prefix, episodes in results.items():
+            statistics_keys = {}
+            for episode, statistics in episodes:
+                self.logger.store(episode)
+                self.logger.store(statistics)
+                statistics_keys.update(dict.fromkeys(statistics))
+                for i in range(num_actions):
+                    total_action_counts[i] += episode[f"{key_prefix}/actions/{i}"]
+
             self.logger.log_tabular(key_prefix + "/return", with_min_and_max=True)
             self.logger.log_tabular(key_prefix + "/ep_length", average_only=True)
-            for stat in test_env.get_statistics(key_prefix).keys():
+            for stat in statistics_keys:
                 self.logger.log_tabular(stat, average_only=True)
             for i in range(num_actions):
                 self.logger.log_tabular(f"{key_prefix}/actions/{i}", average_only=True)
@@ -499,6 +822,29 @@ class SAC:
         for i in range(num_actions):
             self.logger.log_tabular(f"test/actions/" + str(i), total_action_counts[i])
 
+    def _learn_on_fused_batches(self, current_task_idx: int, batches: BatchPrefetcher, batch_iter: Iterator) -> None:
+        """Perform the updates in chunks of fused_updates steps, each in a single graph call.
+
+        The remaining updates, if n_updates is not a multiple of fused_updates, are left in batch_iter.
+        """
+        for _ in range(self.n_updates // self.fused_updates):
+            chunk = list(itertools.islice(batch_iter, self.fused_updates))
+            batch = tf.nest.map_structure(lambda *xs: tf.stack(xs), *[b for b, _ in chunk])
+            episodic_batch = None
+            if chunk[0][1] is not None:
+                episodic_batch = tf.nest.map_structure(lambda *xs: tf.stack(xs), *[e for _, e in chunk])
+
+            results = self.learn_on_batches(tf.convert_to_tensor(current_task_idx), batch, episodic_batch)
+
+            # Update priority in the tree
+            if self.buffer_type == BufferType.PER or self.buffer_type == BufferType.PRIORITY:
+                with batches.lock:
+                    self.replay_buffer.update_weights(
+                        batch['idxs'].numpy().reshape(-1), results['abs_error'].numpy().reshape(-1)
+                    )
+
+            self._log_after_update(results)
+
     def _log_after_update(self, results):
         self.logger.store(
             {
@@ -546,6 +892,7 @@ class SAC:
             self.logger.log_tabular("train/active_env", info["seq_idx"])
 
         self.logger.log_tabular("walltime", time.time() - self.start_time)
+        self.logger.log_tabular("peak_rss_mb", get_peak_rss_mb())
         self.logger.dump_tabular()
 
     def save_model(self, current_task_idx):
@@ -566,6 +913,8 @@ class SAC:
             self.target_critic1.save_weights(os.path.join(prefix, "target_critic1"))
             self.critic2.save_weights(os.path.join(prefix, "critic2"))
             self.target_critic2.save_weights(os.path.join(prefix, "target_critic2"))
+            if self.actor_owns_encoder:
+                self.target_encoder.save_weights(os.path.join(prefix, "target_encoder"))
 
     def load_model(self, model_path):
         checkpoint_dir = f'{self.experiment_dir}/checkpoints/{model_path}'
@@ -574,35 +923,34 @@ class SAC:
         self.target_critic1.load_weights(os.path.join(checkpoint_dir, "target_critic1"))
         self.critic2.load_weights(os.path.join(checkpoint_dir, "critic2"))
         self.target_critic2.load_weights(os.path.join(checkpoint_dir, "target_critic2"))
+        if self.actor_owns_encoder:
+            self.target_encoder.load_weights(os.path.join(checkpoint_dir, "target_encoder"))
 
     def _handle_task_change(self, current_task_idx: int):
         if self.start_from_task != current_task_idx:
             self.on_task_start(current_task_idx)
 
-        if self.reset_buffer_on_task_change:
-            if self.buffer_type == BufferType.FIFO:
-                self.replay_buffer = ReplayBuffer(
-                    obs_shape=self.obs_shape, size=self.replay_size, num_tasks=self.num_tasks
-                )
-            elif self.buffer_type == BufferType.PRIORITY:
-                self.replay_buffer = PrioritizedReplayBuffer(
-                    obs_shape=self.obs_shape, size=self.replay_size, num_tasks=self.num_tasks
-                )
-            elif self.buffer_type == BufferType.PER:
-                self.replay_buffer = PrioritizedExperienceReplay(
-                    obs_shape=self.obs_shape, size=self.replay_size, num_tasks=self.num_tasks
-                )
-
-        if self.reset_actor_on_task_change:
-            if self.exploration_kind is not None:
-                self.exploration_actor.set_weights(self.actor.get_weights())
-            reset_weights(self.actor, self.actor_cl, self.actor_kwargs)
-
-        if self.reset_critic_on_task_change:
-            reset_weights(self.critic1, self.critic_cl, self.policy_kwargs)
-            self.target_critic1.set_weights(self.critic1.get_weights())
-            reset_weights(self.critic2, self.critic_cl, self.policy_kwargs)
-            self.target_critic2.set_weights(self.critic2.get_weights())
+        if self.reset_buffer_on_task_change and self.buffer_type != BufferType.RESERVOIR:
+            # The memory of the buffer is reused for the new task instead of being freed and allocated again, and the
+            # processes writing to a shared buffer stay attached to it. The reservoir buffer keeps all the tasks.
+            self.replay_buffer.clear()
+
+        with dtype_policy(self.dtype_policy):
+            if self.reset_actor_on_task_change:
+                if self.exploration_kind is not None:
+                    self.exploration_actor.set_weights(self.actor.get_weights())
+                # The shared encoder is re-initialized together with the network which trains it
+                reset_weights(self.actor, self.actor_cl,
+                              self._model_kwargs(self.actor_owns_encoder, new_encoder=True))
+                if self.actor_owns_encoder:
+                    self.target_encoder.set_weights(self.encoder.get_weights())
+
+            if self.reset_critic_on_task_change:
+                reset_weights(self.critic1, self.critic_cl,
+                              self._model_kwargs(self.critic_owns_encoder, new_encoder=True))
+                self.target_critic1.set_weights(self.critic1.get_weights())
+                reset_weights(self.critic2, self.critic_cl, self._model_kwargs(False))
+                self.target_critic2.set_weights(self.critic2.get_weights())
 
         if self.reset_optimizer_on_task_change:
             self.logger.log(f"Resetting the optimizer", color='cyan')
@@ -613,6 +961,10 @@ class SAC:
         # normalization. We need to recompute the graph in order for TensorFlow
         # to notice this change.
         self.learn_on_batch = self.get_learn_on_batch(current_task_idx)
+        self.learn_on_batches = self.get_learn_on_batches(current_task_idx)
+        self.logger.log(f"Update functions so far: {self.num_traces} traces"
+                        + (f", {len(self.learn_fns)} XLA-compiled variants" if self.jit_compile else ""),
+                        color='cyan')
         self.all_common_variables = (
                 self.actor.common_variables
                 + self.critic1.common_variables
@@ -623,6 +975,72 @@ class SAC:
             self.exploration_helper = ExplorationHelper(self.exploration_kind, num_available_heads=current_task_idx + 1,
                                                         num_tasks=self.num_tasks)
 
+    def _update(self, current_task_idx: int) -> None:
+        time_update_start = time.time()
+
+        batches = BatchPrefetcher(
+            lambda: (self.replay_buffer.sample_batch(self.batch_size),
+                     self.get_episodic_batch(current_task_idx)),
+            self.n_updates, self.prefetch_batches
+        )
+        batch_iter = iter(batches)
+        if self.fused_updates > 1:
+            self._learn_on_fused_batches(current_task_idx, batches, batch_iter)
+        for batch, episodic_batch in batch_iter:
+
+            results = self.learn_on_batch(
+                tf.convert_to_tensor(current_task_idx), batch, episodic_batch
+            )
+
+            # Update priority in the tree
+            abs_errors = results['abs_error'].numpy()
+            if self.buffer_type == BufferType.PER or self.buffer_type == BufferType.PRIORITY:
+                with batches.lock:
+                    self.replay_buffer.update_weights(batch['idxs'].numpy(), abs_errors)
+
+            self._log_after_update(results)
+
+        self.logger.log(f"Time elapsed for a policy update: {time.time() - time_update_start}")
+
+    def _log_episode(self, episodes: int, episode_start: float, episode_return: float, episode_len: int,
+                     statistics: Dict[str, float]) -> None:
+        buffer_capacity = self.replay_buffer.size / self.replay_buffer.max_size * 100  # Percentage
+        self.logger.log(f"Episode {episodes} duration: {(time.time() - episode_start):.4f}. Buffer capacity: "
+                        f"{buffer_capacity:.2f}% ({self.replay_buffer.size}/{self.replay_buffer.max_size})")
+        self.logger.store({"train/return": episode_return, "train/ep_length": episode_len,
+                           "train/episodes": episodes, "buffer_capacity": buffer_capacity})
+        self.logger.store(statistics)
+
+    def _end_epoch(self, current_task_idx: int, current_task_timestep: int, global_timestep: int, info: Dict,
+                   action_counts: Dict[int, int]) -> None:
+        epoch = (global_timestep + 1 + self.log_every - 1) // self.log_every
+
+        # Save model
+        if (epoch % self.save_freq_epochs == 0) or (global_timestep + 1 == self.steps):
+            self.save_model(current_task_idx)
+
+        # Test the performance of stochastic and deterministic version of the agent.
+        if self.test and self.test_envs:
+            test_start_time = time.time()
+            if self.test_evaluator is not None and self.async_test and global_timestep + 1 < self.steps:
+                self._test_in_parallel(deterministic=False, num_episodes=self.num_test_eps, background=True)
+            else:
+                self.test_agent(deterministic=False, num_episodes=self.num_test_eps)
+            self.logger.log(f"Time elapsed for the testing procedure: {time.time() - test_start_time}")
+
+        # Determine the current learning rate of the optimizer
+        lr = self.optimizer.lr
+        if issubclass(type(lr), LearningRateSchedule):
+            lr = self.optimizer._decayed_lr('float32').numpy()
+
+        log_start_time = time.time()
+        # Log the action counts and reset them
+        for i in range(len(action_counts)):
+            self.logger.log_tabular("train/actions/" + str(i), action_counts[i])
+            action_counts[i] = 0
+        self._log_after_epoch(epoch, current_task_timestep, global_timestep, info, lr)
+        self.logger.log(f"Time elapsed for logging: {time.time() - log_start_time}")
+
     def run(self):
         """A method to run the SAC training, after the object has been created."""
         self.start_time = time.time()
@@ -631,6 +1049,10 @@ class SAC:
             self.test_agent(deterministic=True, num_episodes=self.num_test_eps)
             return
 
+        if self.vec_env is not None:
+            self._run_vectorized()
+            return
+
         obs, info = self.env.reset()
         episodes, episode_return, episode_len = 0, 0, 0
         # Set exploration head as "undecided".
@@ -640,6 +1062,7 @@ class SAC:
         current_task_timestep = 0
         current_task_idx = -1
         self.learn_on_batch = self.get_learn_on_batch(current_task_idx)
+        self.learn_on_batches = self.get_learn_on_batches(current_task_idx)
         episode_start = time.time()
 
         one_hot_vec = create_one_hot_vec(self.env.num_tasks, self.env.task_id)
@@ -695,12 +1118,8 @@ class SAC:
             # End of trajectory handling
             if done:
                 episodes += 1
-                buffer_capacity = self.replay_buffer.size / self.replay_buffer.max_size * 100  # Percentage
-                self.logger.log(f"Episode {episodes} duration: {(time.time() - episode_start):.4f}. Buffer capacity: "
-                                f"{buffer_capacity:.2f}% ({self.replay_buffer.size}/{self.replay_buffer.max_size})")
-                self.logger.store({"train/return": episode_return, "train/ep_length": episode_len,
-                                   "train/episodes": episodes, "buffer_capacity": buffer_capacity})
-                self.logger.store(self.env.get_statistics('train'))
+                self._log_episode(episodes, episode_start, episode_return, episode_len,
+                                  self.env.get_statistics('train'))
                 self.env.clear_episode_statistics()
                 episode_return, episode_len = 0, 0
                 if global_timestep < self.steps - 1:
@@ -709,59 +1128,107 @@ class SAC:
 
             # Update handling
             if current_task_timestep >= self.update_after and current_task_timestep % self.update_every == 0:
+                self._update(current_task_idx)
 
-                time_update_start = time.time()
+            if self.env.name == "ContinualLearningEnv" and current_task_timestep + 1 == self.env.steps_per_env:
+                episodes = 0
+                self.on_task_end(current_task_idx)
 
-                for j in range(self.n_updates):
+            # End of epoch wrap-up
+            if ((global_timestep + 1) % self.log_every == 0) or (global_timestep + 1 == self.steps):
+                self._end_epoch(current_task_idx, current_task_timestep, global_timestep, info, action_counts)
+                episode_start = time.time()
 
-                    batch = self.replay_buffer.sample_batch(self.batch_size)
-                    episodic_batch = self.get_episodic_batch(current_task_idx)
+            current_task_timestep += 1
+            if done:
+                episode_start = time.time()
 
-                    results = self.learn_on_batch(
-                        tf.convert_to_tensor(current_task_idx), batch, episodic_batch
-                    )
+    def _run_vectorized(self) -> None:
+        """Same as the main loop of run, but steps all the environments of vec_env at every iteration.
 
-                    # Update priority in the tree
-                    abs_errors = results['abs_error'].numpy()
-                    if self.buffer_type == BufferType.PER or self.buffer_type == BufferType.PRIORITY:
-                        self.replay_buffer.update_weights(batch['idxs'].numpy(), abs_errors)
+        The actions of all the environments come from a single forward pass of the actor, and their transitions are
+        stored with a single call to store_batch. global_timestep and current_task_timestep count the steps of all
+        the environments, so that the update, logging and task schedules do not depend on the number of environments.
+        """
+        num_envs = self.vec_env.num_envs
+        obs, infos = self.vec_env.reset()
+        episodes = 0
+        episode_returns, episode_lens = np.zeros(num_envs), np.zeros(num_envs, dtype=np.int64)
 
-                    self._log_after_update(results)
+        current_task_timestep = 0
+        current_task_idx = -1
+        first_task_idx = getattr(self.env, "cur_seq_idx", 0)
+        self.learn_on_batch = self.get_learn_on_batch(current_task_idx)
+        self.learn_on_batches = self.get_learn_on_batches(current_task_idx)
+        episode_start = time.time()
 
-                self.logger.log(f"Time elapsed for a policy update: {time.time() - time_update_start}")
+        one_hot_vec = create_one_hot_vec(self.env.num_tasks, self.env.task_id)
+        num_actions = self.env.action_space.n
+        action_counts = {i: 0 for i in range(num_actions)}
 
-            if self.env.name == "ContinualLearningEnv" and current_task_timestep + 1 == self.env.steps_per_env:
-                episodes = 0
-                self.on_task_end(current_task_idx)
+        for global_timestep in range(0, self.steps, num_envs):
+            # On task change. The copies change task together every steps_per_env / num_envs of their own steps, as
+            # the step counter tells without asking them. The main env is never stepped, so it is moved along.
+            seq_idx = first_task_idx + global_timestep // self.steps_per_env
+            if current_task_idx != seq_idx:
+                current_task_timestep = 0
+                current_task_idx = seq_idx
+                self.env.cur_seq_idx = seq_idx
+                self._handle_task_change(current_task_idx)
+                one_hot_vec = create_one_hot_vec(self.env.num_tasks, self.env.task_id)
+            one_hot_vecs = np.tile(one_hot_vec, (num_envs, 1))
 
-            # End of epoch wrap-up
-            if ((global_timestep + 1) % self.log_every == 0) or (global_timestep + 1 == self.steps):
-                epoch = (global_timestep + 1 + self.log_every - 1) // self.log_every
+            if current_task_timestep > self.start_steps or (
+                    self.agent_policy_exploration and current_task_idx > 0) or self.model_path:
+                actions = self.get_actions(tf.convert_to_tensor(obs, dtype=tf.dtypes.float32),
+                                           tf.convert_to_tensor(one_hot_vecs, dtype=tf.dtypes.float32)).numpy()
+            else:
+                # Just pure random exploration.
+                actions = np.array([self.vec_env.action_space.sample() for _ in range(num_envs)])
 
-                # Save model
-                if (epoch % self.save_freq_epochs == 0) or (global_timestep + 1 == self.steps):
-                    self.save_model(current_task_idx)
+            # Environment step
+            next_obs, rewards, dones, _, infos = self.vec_env.step(actions)
+            episode_returns += rewards
+            episode_lens += 1
+            for action in actions:
+                action_counts[action] += 1
 
-                # Test the performance of stochastic and deterministic version of the agent.
-                if self.test and self.test_envs:
-                    test_start_time = time.time()
-                    self.test_agent(deterministic=False, num_episodes=self.num_test_eps)
-                    self.logger.log(f"Time elapsed for the testing procedure: {time.time() - test_start_time}")
+            # Consider also whether episode was truncated
+            dones_to_store = np.where(episode_lens == self.max_episode_len, False, dones)
 
-                # Determine the current learning rate of the optimizer
-                lr = self.optimizer.lr
-                if issubclass(type(lr), LearningRateSchedule):
-                    lr = self.optimizer._decayed_lr('float32').numpy()
+            # Store experience to replay buffer
+            self.replay_buffer.store_batch(obs, actions, rewards, next_obs, dones_to_store, one_hot_vecs)
 
-                log_start_time = time.time()
-                # Log the action counts and reset them
-                for i in range(num_actions):
-                    self.logger.log_tabular("train/actions/" + str(i), action_counts[i])
-                    action_counts[i] = 0
-                self._log_after_epoch(epoch, current_task_timestep, global_timestep, info, lr)
-                self.logger.log(f"Time elapsed for logging: {time.time() - log_start_time}")
+            # Update the most recent observation
+            obs = next_obs
+
+            # End of trajectory handling
+            done_idxs = np.flatnonzero(dones)
+            for i in done_idxs:
+                episodes += 1
+                self._log_episode(episodes, episode_start, episode_returns[i], episode_lens[i],
+                                  self.vec_env.env_method("get_statistics", "train", indices=[i])[0])
+                self.vec_env.env_method("clear_episode_statistics", indices=[i])
+            episode_returns[done_idxs], episode_lens[done_idxs] = 0, 0
+            if len(done_idxs) and global_timestep + num_envs < self.steps:
+                obs[done_idxs], _ = self.vec_env.reset(indices=done_idxs)
+
+            # Update handling, once for every multiple of update_every crossed by the steps of this iteration
+            for timestep in range(current_task_timestep, current_task_timestep + num_envs):
+                if timestep >= self.update_after and timestep % self.update_every == 0:
+                    self._update(current_task_idx)
+
+            if self.env.name == "ContinualLearningEnv" and current_task_timestep + num_envs == self.steps_per_env:
+                episodes = 0
+                self.on_task_end(current_task_idx)
+
+            # End of epoch wrap-up
+            last_timestep = global_timestep + num_envs - 1
+            if (last_timestep + 1) // self.log_every > global_timestep // self.log_every or (
+                    last_timestep + 1 == self.steps):
+                self._end_epoch(current_task_idx, current_task_timestep, last_timestep, infos[0], action_counts)
                 episode_start = time.time()
 
-            current_task_timestep += 1
-            if done:
+            current_task_timestep += num_envs
+            if len(done_idxs):
                 episode_start = time.time()
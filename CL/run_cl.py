@@ -1,7 +1,9 @@
 import argparse
 from datetime import datetime
 from enum import Enum
+from functools import partial
 from pathlib import Path
+from typing import Dict, List, Optional
 
 import tensorflow as tf
 
@@ -13,11 +15,14 @@ from CL.methods.mas import MAS_SAC
 from CL.methods.owl import OWL_SAC
 from CL.methods.packnet import PackNet_SAC
 from CL.methods.vcl import VCL_SAC, VclMlpActor
-from CL.replay.buffers import BufferType
+from CL.replay.buffers import BufferType, SharedReplayBuffer
+from CL.rl.actor_learner import ActorLearner
 from CL.rl.models import MlpActor
+from CL.rl.multi_seed import MultiSeedSAC
 from CL.rl.sac import SAC
 from CL.utils.logging import EpochLogger, WandBLogger
 from CL.utils.running import get_activation_from_str
+from CL.utils.vec_env import SubprocVecEnv
 from MHAIA.env.builder import make_envs, build_multi_discrete_actions
 from MHAIA.env.continual import ContinualLearningEnv
 from MHAIA.utils.config import Sequence, Scenario, sequence_scenarios, sequence_tasks, default_wrapper_config, \
@@ -25,17 +30,33 @@ from MHAIA.utils.config import Sequence, Scenario, sequence_scenarios, sequence_
 from config import update_wrapper_config, get_arg_parser
 
 
+def make_test_env(index: int, scenarios: List[Scenario], tasks: List[str], random_order: bool,
+                  task_idx: Optional[int], scenario_kwargs: List[Dict], mario_kwargs: Dict, wrapper_config: Dict):
+    """Create a single test environment in a subprocess of the parallel evaluation, without building the others.
+
+    make_envs builds the environments of all the tasks of each scenario in turn, so the index picks a scenario and a
+    task, and it becomes the task id unless a fixed one is given.
+    """
+    scenario_idx, task_pos = divmod(index, len(tasks))
+    task_id = index if task_idx is None else task_idx
+    return make_envs([scenarios[scenario_idx]], [tasks[task_pos]], random_order, task_id,
+                     [scenario_kwargs[scenario_idx]], mario_kwargs, wrapper_config)[0]
+
+
 class CLMethod(Enum):
     SAC = (SAC, [])
     L2 = (L2_SAC, ['cl_reg_coef', 'regularize_critic'])
-    EWC = (EWC_SAC, ['cl_reg_coef', 'regularize_critic'])
-    MAS = (MAS_SAC, ['cl_reg_coef', 'regularize_critic'])
+    EWC = (EWC_SAC, ['cl_reg_coef', 'regularize_critic', 'importance_samples', 'importance_batch_size',
+                     'importance_time_budget'])
+    MAS = (MAS_SAC, ['cl_reg_coef', 'regularize_critic', 'importance_samples', 'importance_batch_size',
+                     'importance_time_budget'])
     VCL = (VCL_SAC, ['cl_reg_coef', 'regularize_critic', 'vcl_first_task_kl'])
     PACKNET = (PackNet_SAC, ['regularize_critic', 'packnet_retrain_steps'])
-    AGEM = (AGEM_SAC, ['episodic_mem_per_task', 'episodic_batch_size'])
-    OWL = (OWL_SAC, ['cl_reg_coef', 'regularize_critic'])
+    AGEM = (AGEM_SAC, ['episodic_mem_per_task', 'episodic_batch_size', 'episodic_mem_frames'])
+    OWL = (OWL_SAC, ['cl_reg_coef', 'regularize_critic', 'importance_samples', 'importance_batch_size',
+                     'importance_time_budget'])
     CLONEX = (ClonExSAC, ['episodic_mem_per_task', 'episodic_batch_size', 'regularize_critic', 'cl_reg_coef',
-                          'episodic_memory_from_buffer'])
+                          'episodic_memory_from_buffer', 'episodic_mem_frames'])
 
 
 def main(parser: argparse.ArgumentParser):
@@ -49,6 +70,18 @@ def main(parser: argparse.ArgumentParser):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     num_tasks = len(scenarios) * len(tasks)
 
+    if args.num_seeds > 1 and (args.with_wandb or args.num_envs > 1 or args.parallel_test or args.test_only):
+        raise ValueError("Several seeds are not supported with wandb, several environments, parallel testing or "
+                         "test_only")
+    if args.num_seeds > 1 and (args.fused_updates > 1 or args.prefetch_batches > 0 or args.jit_compile):
+        raise ValueError("The seeds take their gradient steps together in a single graph call, so fused updates, "
+                         "prefetched batches and XLA compilation are not supported with several seeds")
+    if args.cl_method == "owl" and (args.parallel_test or args.async_test):
+        raise ValueError("OWL selects the heads with a bandit in its own sequential evaluation, so parallel and "
+                         "asynchronous testing are not supported")
+    if args.num_collectors > 0 and (args.num_envs > 1 or args.num_seeds > 1 or args.random_order):
+        raise ValueError("Collectors are not supported with several environments, several seeds or a random order")
+
     # Logging
     if args.with_wandb:
         WandBLogger.add_cli_args(parser)
@@ -91,13 +124,34 @@ def main(parser: argparse.ArgumentParser):
     wrapper_config['record_dir'] = record_dir
 
     # Create the test tasks
-    test_tasks = make_envs(test_scenarios, test_tasks, args.random_order, task_idx,
-                           scenario_kwargs, mario_kwargs, wrapper_config)
+    test_tasks_args = (test_scenarios, test_tasks, args.random_order, task_idx, scenario_kwargs, mario_kwargs,
+                       wrapper_config)
+    test_tasks = make_envs(*test_tasks_args)
+
+    # Create the copies of the test tasks which are evaluated in parallel
+    test_vec_env = None
+    if args.parallel_test and test_tasks:
+        if args.random_order:
+            raise ValueError("The copies of the test environments must follow the same task order")
+        test_vec_env = SubprocVecEnv([partial(make_test_env, i, *test_tasks_args) for i in range(len(test_tasks))])
+        if test_vec_env.get_attr("task_id") != [test_task.task_id for test_task in test_tasks]:
+            raise ValueError("The copies of the test environments do not match the test tasks")
 
     # Create the continual learning environment
     cl_env = ContinualLearningEnv(sequence, args.steps_per_env, args.start_from, args.random_order,
                                   scenario_kwargs, mario_kwargs, wrapper_config)
 
+    # Create the copies of the environment which collect the experience in parallel
+    vec_env = None
+    if args.num_envs > 1:
+        if args.random_order:
+            raise ValueError("The copies of the environment must follow the same task order")
+        vec_env = SubprocVecEnv([
+            partial(ContinualLearningEnv, sequence, args.steps_per_env // args.num_envs, args.start_from, False,
+                    scenario_kwargs, {**mario_kwargs, 'seed': args.seed + i}, wrapper_config)
+            for i in range(args.num_envs)
+        ])
+
     num_heads = num_tasks if args.multihead_archs else 1
     policy_kwargs = dict(
         hidden_sizes=args.hidden_sizes,
@@ -128,11 +182,15 @@ def main(parser: argparse.ArgumentParser):
         update_after=args.update_after,
         update_every=args.update_every,
         n_updates=args.n_updates,
+        prefetch_batches=args.prefetch_batches,
+        fused_updates=args.fused_updates,
         replay_size=args.replay_size,
         batch_size=args.batch_size,
         actor_cl=actor_cl,
         policy_kwargs=policy_kwargs,
         buffer_type=BufferType(args.buffer_type),
+        frame_stack=args.frame_stack,
+        buffer_dir=args.buffer_dir,
         reset_buffer_on_task_change=args.reset_buffer_on_task_change,
         reset_optimizer_on_task_change=args.reset_optimizer_on_task_change,
         lr=args.lr,
@@ -150,12 +208,51 @@ def main(parser: argparse.ArgumentParser):
         model_path=args.model_path,
         timestamp=timestamp,
         exploration_kind=args.exploration_kind,
+        vec_env=vec_env,
+        test_vec_env=test_vec_env,
+        async_test=args.async_test,
+        shared_encoder=args.shared_encoder,
+        encoder_gradients=args.encoder_gradients,
+        concat_next_obs=args.concat_next_obs,
+        mixed_precision=args.mixed_precision,
+        jit_compile=args.jit_compile,
     )
 
     sac_class, sac_arg_names = CLMethod[cl_method.upper()].value
     cl_args = [vars(args)[arg] for arg in sac_arg_names]
+    if args.num_seeds > 1:
+        sac_kwargs['timestamp'] = f"{timestamp}_seed{args.seed}"
     sac = sac_class(*cl_args, **sac_kwargs)
-    sac.run()
+    agents = [sac]
+    if args.num_collectors > 0:
+        # The collectors follow the same task schedule as the main env, each with its share of the steps
+        ActorLearner(sac, [
+            partial(ContinualLearningEnv, sequence, args.steps_per_env // args.num_collectors, args.start_from, False,
+                    scenario_kwargs, {**mario_kwargs, 'seed': args.seed + i}, wrapper_config)
+            for i in range(args.num_collectors)
+        ], args.sync_weights_every, args.max_update_lag, args.seed).run()
+    elif args.num_seeds == 1:
+        sac.run()
+    else:
+        # Each seed gets its own environments, logs and checkpoints
+        for seed in range(args.seed + 1, args.seed + args.num_seeds):
+            seed_mario_kwargs = {**mario_kwargs, 'seed': seed}
+            agents.append(sac_class(*cl_args, **{
+                **sac_kwargs,
+                'env': ContinualLearningEnv(sequence, args.steps_per_env, args.start_from, args.random_order,
+                                            scenario_kwargs, seed_mario_kwargs, wrapper_config),
+                'test_envs': make_envs(*test_tasks_args[:5], seed_mario_kwargs, wrapper_config),
+                'logger': EpochLogger(args.logger_output, config={**vars(args), 'seed': seed}, group_id=args.group_id),
+                'seed': seed,
+                'timestamp': f"{timestamp}_seed{seed}",
+            }))
+        MultiSeedSAC(agents).run()
+    for env in (vec_env, test_vec_env):
+        if env is not None:
+            env.close()
+    for agent in agents:
+        if isinstance(agent.replay_buffer, SharedReplayBuffer):
+            agent.replay_buffer.close()
 
 
 if __name__ == "__main__":
@@ -83,6 +83,13 @@ def main(parser: argparse.ArgumentParser):
         update_after=args.update_after,
         update_every=args.update_every,
         n_updates=args.n_updates,
+        prefetch_batches=args.prefetch_batches,
+        fused_updates=args.fused_updates,
+        shared_encoder=args.shared_encoder,
+        encoder_gradients=args.encoder_gradients,
+        concat_next_obs=args.concat_next_obs,
+        mixed_precision=args.mixed_precision,
+        jit_compile=args.jit_compile,
         replay_size=args.replay_size,
         batch_size=args.batch_size,
         policy_kwargs=policy_kwargs,
@@ -100,6 +107,8 @@ def main(parser: argparse.ArgumentParser):
         test_only=args.test_only,
         num_test_eps=args.test_episodes,
         buffer_type=BufferType(args.buffer_type),
+        frame_stack=args.frame_stack,
+        buffer_dir=args.buffer_dir,
     )
     sac.run()
 
@@ -0,0 +1,219 @@
+import multiprocessing as mp
+
+import numpy as np
+import pytest
+
+from CL.replay.buffers import CompactReplayBuffer, FrameReplayBuffer, SharedReplayBuffer, to_frames, to_obs
+
+NUM_TASKS = 2
+
+
+def random_obs(rng: np.random.Generator, shape) -> np.ndarray:
+    """Observations rescaled to [-1, 1] from random pixel values, as by the Rescale wrapper."""
+    return (rng.integers(0, 256, size=shape) / 127.5 - 1.).astype(np.float32)
+
+
+def rollout(rng: np.random.Generator, num_envs: int, num_steps: int, reset_prob: float, reset, step):
+    """Transitions of num_envs environments stepped together, whose actions are their unique ids."""
+    obs = [reset() for _ in range(num_envs)]
+    transitions = []
+    for t in range(num_steps):
+        batch = []
+        for env_idx in range(num_envs):
+            done = rng.random() < reset_prob
+            next_obs = step(obs[env_idx])
+            batch.append((obs[env_idx], t * num_envs + env_idx, rng.random(), next_obs, done, np.eye(NUM_TASKS)[0]))
+            obs[env_idx] = reset() if done else next_obs
+        transitions.append([np.array(values) for values in zip(*batch)])
+    return transitions
+
+
+def assert_matches(batch, transitions):
+    """Check that each sampled transition is one of the stored ones, identified by its action."""
+    stored = {int(action): (obs, reward, next_obs, done) for batch_transitions in transitions
+              for obs, action, reward, next_obs, done, _ in zip(*batch_transitions)}
+    for obs, action, reward, next_obs, done in zip(batch["obs"].numpy(), batch["actions"].numpy(),
+                                                    batch["rewards"].numpy(), batch["next_obs"].numpy(),
+                                                    batch["done"].numpy()):
+        expected_obs, expected_reward, expected_next_obs, expected_done = stored[int(action)]
+        np.testing.assert_allclose(obs, expected_obs, atol=1e-6)
+        np.testing.assert_allclose(next_obs, expected_next_obs, atol=1e-6)
+        assert reward == np.float32(expected_reward)
+        assert done == expected_done
+
+
+def test_frames_round_trip():
+    obs = random_obs(np.random.default_rng(0), (16, 8, 3))
+    frames = to_frames(obs)
+    assert frames.dtype == np.uint8
+    np.testing.assert_allclose(to_obs(frames).numpy(), obs, atol=1e-6)
+
+
+def test_frames_clip_rounding_errors():
+    np.testing.assert_array_equal(to_frames(np.array([-1.001, 1.001])), [0, 255])
+
+
+@pytest.mark.parametrize("obs", [np.array([0., 1.5]), np.array([-2., 0.]), np.array([0., 255.])])
+def test_frames_reject_observations_which_are_not_rescaled(obs):
+    with pytest.raises(ValueError):
+        to_frames(obs)
+
+
+@pytest.mark.parametrize("num_envs", [1, 3])
+def test_compact_buffer_samples_stored_transitions(num_envs):
+    rng = np.random.default_rng(num_envs)
+    buffer = CompactReplayBuffer((4, 4, 3), 60, NUM_TASKS)
+    transitions = rollout(rng, num_envs, 100, .1, lambda: random_obs(rng, (4, 4, 3)),
+                          lambda obs: random_obs(rng, (4, 4, 3)))
+    for batch_transitions in transitions:
+        buffer.store_batch(*batch_transitions)
+
+    assert buffer.size == buffer.max_size
+    assert_matches(buffer.sample_batch(256), transitions)
+
+
+@pytest.mark.parametrize("num_envs", [1, 3])
+def test_compact_buffer_takes_one_slot_per_transition(num_envs):
+    rng = np.random.default_rng(num_envs)
+    buffer = CompactReplayBuffer((4, 4, 3), 60, NUM_TASKS)
+    # Without episode ends, only the first observation of each environment takes a slot of its own
+    for batch_transitions in rollout(rng, num_envs, 10, 0., lambda: random_obs(rng, (4, 4, 3)),
+                                     lambda obs: random_obs(rng, (4, 4, 3))):
+        buffer.store_batch(*batch_transitions)
+
+    assert buffer.size == 10 * num_envs + num_envs
+    assert buffer.valid_buf.sum() == 10 * num_envs
+
+
+def test_compact_buffer_clear():
+    rng = np.random.default_rng(0)
+    buffer = CompactReplayBuffer((4, 4, 3), 20, NUM_TASKS)
+    for batch_transitions in rollout(rng, 2, 5, 0., lambda: random_obs(rng, (4, 4, 3)),
+                                     lambda obs: random_obs(rng, (4, 4, 3))):
+        buffer.store_batch(*batch_transitions)
+    buffer.clear()
+    assert buffer.size == 0 and not buffer.valid_buf.any() and not buffer.pending
+
+    transitions = rollout(rng, 2, 5, 0., lambda: random_obs(rng, (4, 4, 3)), lambda obs: random_obs(rng, (4, 4, 3)))
+    for batch_transitions in transitions:
+        buffer.store_batch(*batch_transitions)
+    assert_matches(buffer.sample_batch(64), transitions)
+
+
+def stack_reset(rng: np.random.Generator, frame_stack: int):
+    """First observation of an episode, whose stack is padded with its first frame."""
+    return np.concatenate([random_obs(rng, (4, 4, 3))] * frame_stack, axis=-1)
+
+
+def stack_step(rng: np.random.Generator, obs: np.ndarray):
+    """Next observation, which drops the oldest frame of the stack and appends a new one."""
+    return np.concatenate([obs[..., 3:], random_obs(rng, (4, 4, 3))], axis=-1)
+
+
+@pytest.mark.parametrize("num_envs", [1, 3])
+def test_frame_buffer_rebuilds_stacks(num_envs):
+    rng = np.random.default_rng(num_envs)
+    buffer = FrameReplayBuffer((4, 4, 12), 50, NUM_TASKS, frame_stack=4)
+    transitions = rollout(rng, num_envs, 100, .1, lambda: stack_reset(rng, 4), lambda obs: stack_step(rng, obs))
+    for batch_transitions in transitions:
+        buffer.store_batch(*batch_transitions)
+
+    assert buffer.size == buffer.max_size
+    assert_matches(buffer.sample_batch(256), transitions)
+
+
+def test_frame_buffer_stores_each_frame_once():
+    rng = np.random.default_rng(0)
+    buffer = FrameReplayBuffer((4, 4, 12), 50, NUM_TASKS, frame_stack=4)
+    for batch_transitions in rollout(rng, 1, 10, 0., lambda: stack_reset(rng, 4), lambda obs: stack_step(rng, obs)):
+        buffer.store_batch(*batch_transitions)
+
+    # The padded first stack holds a single frame, and every step adds one
+    assert buffer.num_frames == 1 + 10
+
+
+def test_frame_buffer_stores_windows_which_do_not_overlap():
+    rng = np.random.default_rng(0)
+    buffer = FrameReplayBuffer((4, 4, 12), 20, NUM_TASKS, frame_stack=4)
+    transitions = rollout(rng, 2, 10, 0., lambda: random_obs(rng, (4, 4, 12)),
+                          lambda obs: random_obs(rng, (4, 4, 12)))
+    for batch_transitions in transitions:
+        buffer.store_batch(*batch_transitions)
+
+    assert_matches(buffer.sample_batch(64), transitions)
+
+
+def test_frame_buffer_skips_overwritten_frames():
+    rng = np.random.default_rng(0)
+    buffer = FrameReplayBuffer((4, 4, 12), 50, NUM_TASKS, frame_stack=4, frame_capacity=20)
+    transitions = rollout(rng, 1, 60, .1, lambda: stack_reset(rng, 4), lambda obs: stack_step(rng, obs))
+    for batch_transitions in transitions:
+        buffer.store_batch(*batch_transitions)
+
+    assert_matches(buffer.sample_batch(256), transitions)
+
+
+def store_numbered(buffer: SharedReplayBuffer, first: int, num_transitions: int) -> None:
+    """Store transitions whose fields are all derived from their number."""
+    values = np.arange(first, first + num_transitions, dtype=np.float32)
+    obs = np.broadcast_to(values[:, None, None], (num_transitions, 4, 4)).copy()
+    buffer.store_batch(obs, values.astype(np.int32), values, obs + .5, np.zeros(num_transitions),
+                       np.ones((num_transitions, NUM_TASKS)))
+
+
+def assert_numbered(batch) -> None:
+    obs = batch["obs"].numpy().reshape(len(batch["actions"]), -1)
+    np.testing.assert_array_equal(obs, obs[:, :1].repeat(obs.shape[1], 1))
+    np.testing.assert_array_equal(batch["next_obs"].numpy().reshape(obs.shape), obs + .5)
+    np.testing.assert_array_equal(batch["actions"].numpy(), obs[:, 0].astype(np.int32))
+    np.testing.assert_array_equal(batch["rewards"].numpy(), obs[:, 0])
+
+
+@pytest.fixture
+def shared_buffer():
+    buffer = SharedReplayBuffer((4, 4), 64, NUM_TASKS)
+    yield buffer
+    buffer.close()
+
+
+def test_shared_buffer_is_a_fifo(shared_buffer):
+    store_numbered(shared_buffer, 1, 40)
+    assert (shared_buffer.size, shared_buffer.ptr) == (40, 40)
+    store_numbered(shared_buffer, 41, 40)
+    assert (shared_buffer.size, shared_buffer.ptr) == (64, 16)
+
+    batch = shared_buffer.sample_batch(256)
+    assert_numbered(batch)
+    # Only the latest 64 transitions are kept
+    assert batch["actions"].numpy().min() >= 80 - 64 + 1
+
+    shared_buffer.clear()
+    assert (shared_buffer.size, shared_buffer.ptr) == (0, 0)
+
+
+def batch_sizes(producer_idx: int, num_batches: int):
+    rng = np.random.default_rng(producer_idx)
+    return [int(rng.integers(1, 5)) for _ in range(num_batches)]
+
+
+def produce(buffer: SharedReplayBuffer, producer_idx: int, num_batches: int) -> None:
+    for batch_idx, batch_size in enumerate(batch_sizes(producer_idx, num_batches)):
+        store_numbered(buffer, producer_idx * 100000 + batch_idx * 10 + 1, batch_size)
+
+
+def test_shared_buffer_with_spawned_producers(shared_buffer):
+    ctx = mp.get_context("spawn")
+    producers = [ctx.Process(target=produce, args=(shared_buffer, producer_idx + 1, 200)) for producer_idx in range(3)]
+    for producer in producers:
+        producer.start()
+    # Sample while the producers overwrite the slots, every sampled transition must be complete
+    while any(producer.is_alive() for producer in producers):
+        if shared_buffer.size > 0:
+            assert_numbered(shared_buffer.sample_batch(32))
+    for producer in producers:
+        producer.join()
+        assert producer.exitcode == 0
+
+    num_stored = sum(sum(batch_sizes(producer_idx + 1, 200)) for producer_idx in range(3))
+    assert shared_buffer.counters.tolist() == [num_stored, num_stored]
+    assert_numbered(shared_buffer.sample_batch(256))
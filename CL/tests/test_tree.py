@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from CL.replay.tree import SumTree
+
+
+@pytest.mark.parametrize("capacity", [1, 8, 13])
+def test_update_many_matches_update(capacity):
+    rng = np.random.default_rng(0)
+    tree, expected = SumTree(capacity), SumTree(capacity)
+    for _ in range(5):
+        # Duplicate indices keep their last priority, as with consecutive updates
+        tree_indices = rng.integers(capacity - 1, 2 * capacity - 1, size=2 * capacity)
+        priorities = rng.uniform(0, 10, size=len(tree_indices))
+        tree.update_many(tree_indices, priorities)
+        for tree_index, priority in zip(tree_indices, priorities):
+            expected.update(tree_index, priority)
+
+        np.testing.assert_allclose(tree.tree, expected.tree)
+        np.testing.assert_array_equal(tree.max_tree, expected.max_tree)
+        np.testing.assert_array_equal(tree.min_tree, expected.min_tree)
+
+
+def test_update_many_broadcasts_a_single_priority():
+    tree = SumTree(6)
+    tree.update_many(np.arange(5, 11), 2.)
+    assert tree.total_priority == 12.
+    assert tree.max_priority == tree.min_priority == 2.
+
+
+@pytest.mark.parametrize("capacity", [1, 8, 13])
+def test_get_leaves_matches_get_leaf(capacity):
+    rng = np.random.default_rng(1)
+    tree = SumTree(capacity)
+    tree.update_many(np.arange(capacity - 1, 2 * capacity - 1), rng.uniform(0, 10, size=capacity))
+    values = np.concatenate([rng.uniform(0, tree.total_priority, size=100), [0., tree.total_priority]])
+
+    leaf_indices, priorities = tree.get_leaves(values)
+
+    for value, leaf_index, priority in zip(values, leaf_indices, priorities):
+        assert (leaf_index, priority) == tree.get_leaf(value)
@@ -1,8 +1,11 @@
 import argparse
 import random
+import resource
 import string
+import sys
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Union, Callable, Type, Dict, Optional
+from typing import Union, Callable, Type, Dict, Iterator, Optional
 
 import gymnasium
 import numpy as np
@@ -67,6 +70,18 @@ def reset_weights(model: tf.keras.Model, model_cl: Type[tf.keras.Model], model_k
     model.set_weights(dummy_model.get_weights())
 
 
+@contextmanager
+def dtype_policy(policy: str) -> Iterator[None]:
+    """Build the Keras models created inside the context with the given dtype policy, and restore the previous
+    global policy when leaving it."""
+    previous_policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(policy)
+    try:
+        yield
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous_policy)
+
+
 def get_readable_timestamp() -> str:
     return datetime.now().strftime("%Y_%m_%d__%H_%M_%S")
 
@@ -87,3 +102,10 @@ def create_one_hot_vec(num_tasks, task_id):
     one_hot_vec = np.zeros(num_tasks)
     one_hot_vec[task_id] = 1.0
     return one_hot_vec
+
+
+def get_peak_rss_mb() -> float:
+    """Peak resident set size of the process so far, in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
@@ -0,0 +1,57 @@
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+ArraySpecs = Dict[str, Tuple[Sequence[int], np.dtype]]
+
+# Alignment of the arrays inside the block, in bytes
+_ALIGNMENT = 64
+
+
+class SharedArrays:
+    """Named numpy arrays allocated in a single block of shared memory.
+
+    The process which creates the arrays owns the block and unlinks it on ``close``. Pickling an instance, e.g. to
+    pass it to a subprocess, only sends the name of the block and the layout of the arrays, and unpickling attaches
+    to the same memory without copying it. The subprocesses share the resource tracker of their parent, which only
+    releases the block if the owner exits without closing it.
+
+    Args:
+      specs: Shape and dtype of each array.
+      name: Name of an existing block to attach to. If None, a new block is created.
+    """
+
+    def __init__(self, specs: ArraySpecs, name: Optional[str] = None) -> None:
+        self.specs = {key: (tuple(shape), np.dtype(dtype)) for key, (shape, dtype) in specs.items()}
+        offsets, size = {}, 0
+        for key, (shape, dtype) in self.specs.items():
+            offsets[key] = size
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            size += -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+        self.owner = name is None
+        self.shm = SharedMemory(name=name, create=self.owner, size=max(size, 1))
+        self.arrays = {
+            key: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offsets[key])
+            for key, (shape, dtype) in self.specs.items()
+        }
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self.arrays[key]
+
+    def __getstate__(self) -> Dict:
+        return {"specs": self.specs, "name": self.shm.name}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__init__(state["specs"], state["name"])
+
+    @property
+    def nbytes(self) -> int:
+        return self.shm.size
+
+    def close(self) -> None:
+        # The views must be released before the memory is unmapped
+        self.arrays = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
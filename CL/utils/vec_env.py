@@ -0,0 +1,116 @@
+import multiprocessing as mp
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import gymnasium
+import numpy as np
+
+
+def _worker(remote: Connection, parent_remote: Connection, env_fn: Callable[[], gymnasium.Env]) -> None:
+    parent_remote.close()
+    env = env_fn()
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                remote.send(env.step(data))
+            elif cmd == "reset":
+                remote.send(env.reset())
+            elif cmd == "get_attr":
+                remote.send(getattr(env, data))
+            elif cmd == "env_method":
+                name, args, kwargs = data
+                remote.send(getattr(env, name)(*args, **kwargs))
+            elif cmd == "apply":
+                fn, args = data
+                remote.send(fn(env, *args))
+            elif cmd == "close":
+                env.close()
+                break
+            else:
+                raise NotImplementedError(f"Unknown command {cmd}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+class SubprocVecEnv:
+    """Steps several copies of an environment in parallel, each in its own subprocess.
+
+    The emulator only supports a single game per process, and stepping the copies concurrently uses the available cores.
+    Contrary to the gymnasium vector environments, finished episodes are not reset automatically, so the final
+    observation and the statistics of the episode can still be retrieved before calling ``reset`` on those copies.
+
+    Args:
+      env_fns: Functions which create the environments. They are sent to the subprocesses, so they must be picklable,
+        e.g. a ``functools.partial`` of the environment class.
+      start_method: Start method of the subprocesses. Forking a process which already runs TensorFlow is unsafe,
+        hence the default.
+    """
+
+    def __init__(self, env_fns: Sequence[Callable[[], gymnasium.Env]], start_method: str = "spawn") -> None:
+        self.num_envs = len(env_fns)
+        ctx = mp.get_context(start_method)
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.processes = []
+        for work_remote, remote, env_fn in zip(work_remotes, self.remotes, env_fns):
+            process = ctx.Process(target=_worker, args=(work_remote, remote, env_fn), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+        self.closed = False
+
+        self.observation_space = self.get_attr("observation_space", [0])[0]
+        self.action_space = self.get_attr("action_space", [0])[0]
+
+    def _indices(self, indices: Optional[Sequence[int]]) -> Sequence[int]:
+        return range(self.num_envs) if indices is None else indices
+
+    def step(self, actions: np.ndarray, indices: Optional[Sequence[int]] = None
+             ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, List[Dict]]:
+        indices = self._indices(indices)
+        for i, action in zip(indices, actions):
+            self.remotes[i].send(("step", action))
+        obs, rewards, dones, truncated, infos = zip(*[self.remotes[i].recv() for i in indices])
+        return np.stack(obs), np.array(rewards), np.array(dones), np.array(truncated), list(infos)
+
+    def reset(self, indices: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, List[Dict]]:
+        indices = self._indices(indices)
+        for i in indices:
+            self.remotes[i].send(("reset", None))
+        obs, infos = zip(*[self.remotes[i].recv() for i in indices])
+        return np.stack(obs), list(infos)
+
+    def get_attr(self, name: str, indices: Optional[Sequence[int]] = None) -> List[Any]:
+        indices = self._indices(indices)
+        for i in indices:
+            self.remotes[i].send(("get_attr", name))
+        return [self.remotes[i].recv() for i in indices]
+
+    def env_method(self, name: str, *args, indices: Optional[Sequence[int]] = None, **kwargs) -> List[Any]:
+        indices = self._indices(indices)
+        for i in indices:
+            self.remotes[i].send(("env_method", (name, args, kwargs)))
+        return [self.remotes[i].recv() for i in indices]
+
+    def apply(self, fn: Callable, *args, indices: Optional[Sequence[int]] = None) -> List[Any]:
+        """Call ``fn(env, *args)`` on the environments. fn must be picklable, i.e. defined at the module level."""
+        indices = self._indices(indices)
+        for i in indices:
+            self.remotes[i].send(("apply", (fn, args)))
+        return [self.remotes[i].recv() for i in indices]
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+
+def close_task_env(env: gymnasium.Env, task_idx: int) -> None:
+    """Close the environment of a finished task inside a ContinualLearningEnv."""
+    env.envs[task_idx].close()